@@ -16,6 +16,8 @@ global defalt_anchor_map
 global default_anchor_center_set
 global num_anchors
 global num_links
+global link_seg_src
+global link_seg_dst
 
 
 global batch_size
@@ -43,6 +45,36 @@ prior_scaling = [0.2, 0.5, 0.2, 0.5, 20.0]
 
 max_neg_pos_ratio = 3
 
+# the method of hard negative mining on links: 
+#    'exact': sort all negative links of an image
+#    'histogram': pick the threshold from a fixed-bin histogram of negative scores. 
+link_ohnm_method = 'exact'
+ohnm_num_bins = 1000
+
+# if True, the link classification loss is computed only on links with at least one end segment 
+# being positive or a mined hard negative, plus a random `link_neg_sample_rate` fraction of the other links.
+# The hard negatives among them are mined by the exact OHNM, so it requires link_ohnm_method = 'exact'.
+sparse_link_loss = False
+link_neg_sample_rate = 0.01
+
+# the blocks of the base net whose inner activations are recomputed in the backward pass instead of being kept, 
+# trading computation for memory. e.g., ['conv1', 'conv2'] for vgg, see nets/vgg.py
+basenet_recompute_blocks = []
+# the blocks of the base net that are not trained, e.g., when fine-tuning. 
+basenet_frozen_blocks = []
+
+# summary levels. Summaries in tf.GraphKeys.SUMMARIES, e.g., losses, are cheap and run by the summary op of training. 
+# The more expensive ones are added into the following collections, and run at lower frequencies, see train_seglink.py
+VARIABLE_SUMMARIES = 'variable_summaries' # scalars of every variable and its gradient
+HISTOGRAM_SUMMARIES = 'histogram_summaries' # histograms of variables, gradients and network outputs
+
+# the dtype of the convolutions: 'float32', or 'float16' for mixed precision training, 
+# in which variables, seglink outputs and losses are still in float32.
+compute_dtype = 'float32'
+
+# whether to compile the seglink layers and the loss with XLA, see nets/seglink_symbol.py
+xla_jit = False
+
 data_format = 'NHWC'
 def _set_image_shape(shape):
     global image_shape
@@ -73,14 +105,133 @@ def  _set_train_with_ignored(train_with_ignored_):
     global train_with_ignored    
     train_with_ignored = train_with_ignored_
 
-def _build_anchor_map():
-    global default_anchor_map
-    global default_anchor_center_set
+def _set_link_ohnm(method, num_bins):
+    global link_ohnm_method
+    global ohnm_num_bins
+    if method not in ['exact', 'histogram']:
+        raise ValueError('Invalid link_ohnm_method: %s'%(method))
+    link_ohnm_method = method
+    ohnm_num_bins = num_bins
+
+def _set_sparse_link_loss(sparse, neg_sample_rate):
+    global sparse_link_loss
+    global link_neg_sample_rate
+    if neg_sample_rate < 0 or neg_sample_rate > 1:
+        raise ValueError('Invalid link_neg_sample_rate: %f'%(neg_sample_rate))
+    # the exact OHNM is always done on the gathered links of the sparse loss.
+    if sparse and link_ohnm_method != 'exact':
+        raise ValueError('sparse_link_loss can not be used with link_ohnm_method %s'%(link_ohnm_method))
+    sparse_link_loss = sparse
+    link_neg_sample_rate = neg_sample_rate
+
+def _set_basenet_recompute_blocks(blocks):
+    global basenet_recompute_blocks
+    basenet_recompute_blocks = list(blocks or [])
+
+def _set_compute_dtype(dtype):
+    global compute_dtype
+    if dtype == 'bfloat16':
+        raise ValueError('compute_dtype bfloat16 is not supported: tensorflow 1.x has no bfloat16 convolution kernels on cpu or gpu')
+    if dtype not in ['float32', 'float16']:
+        raise ValueError('Invalid compute_dtype: %s'%(dtype))
+    compute_dtype = dtype
+
+def _set_xla_jit(jit):
+    global xla_jit
+    xla_jit = jit
+
+def _set_basenet_frozen_blocks(blocks):
+    global basenet_frozen_blocks
+    basenet_frozen_blocks = list(blocks or [])
+    
+def _build_anchor_map(anchors):
     import collections
-    default_anchor_map = collections.defaultdict(list)
-    for anchor_idx, anchor in enumerate(default_anchors):
-        default_anchor_map[(int(anchor[1]), int(anchor[0]))].append(anchor_idx)
-    default_anchor_center_set = set(default_anchor_map.keys())
+    anchor_map = collections.defaultdict(list)
+    for anchor_idx, anchor in enumerate(anchors):
+        anchor_map[(int(anchor[1]), int(anchor[0]))].append(anchor_idx)
+    anchor_center_set = set(anchor_map.keys())
+    return anchor_map, anchor_center_set
+
+def _build_link_endpoints(feat_shapes):
+    """The indices of the two end segments of every link, in the same order as links 
+    are laid out in SegLinkNet.link_scores. Links pointing outside the feature map 
+    have -1 as the index of their destination segment.
+    """
+    seg_offsets = np.cumsum([0] + [np.prod(feat_shapes[layer]) for layer in feat_layers])
+    
+    def grid(layer):
+        h, w = feat_shapes[layer]
+        y, x = np.meshgrid(np.arange(h), np.arange(w), indexing = 'ij')
+        return x.reshape(-1, 1), y.reshape(-1, 1), h, w
+    
+    srcs, dsts = [], []
+    # within-layer links: 8 neighbours, see seglink.get_inter_layer_neighbours
+    dx = np.asarray([-1, 0, 1, -1, 1, -1, 0, 1])
+    dy = np.asarray([-1, -1, -1, 0, 0, 1, 1, 1])
+    for layer_idx, layer in enumerate(feat_layers):
+        x, y, h, w = grid(layer)
+        nx, ny = x + dx, y + dy
+        valid = (nx >= 0) & (nx < w) & (ny >= 0) & (ny < h)
+        srcs.append(np.broadcast_to(seg_offsets[layer_idx] + y * w + x, nx.shape))
+        dsts.append(np.where(valid, seg_offsets[layer_idx] + ny * w + nx, -1))
+    
+    # cross-layer links: 4 neighbours in the former layer, see seglink.get_cross_layer_neighbours
+    dx = np.asarray([0, 1, 0, 1])
+    dy = np.asarray([0, 0, 1, 1])
+    for layer_idx, layer in enumerate(feat_layers[1:], 1):
+        x, y, h, w = grid(layer)
+        ph, pw = feat_shapes[feat_layers[layer_idx - 1]]
+        nx, ny = 2 * x + dx, 2 * y + dy
+        valid = (nx >= 0) & (nx < pw) & (ny >= 0) & (ny < ph)
+        srcs.append(np.broadcast_to(seg_offsets[layer_idx] + y * w + x, nx.shape))
+        dsts.append(np.where(valid, seg_offsets[layer_idx - 1] + ny * pw + nx, -1))
+    
+    link_seg_src = np.concatenate([s.reshape(-1) for s in srcs]).astype(np.int32)
+    link_seg_dst = np.concatenate([d.reshape(-1) for d in dsts]).astype(np.int32)
+    return link_seg_src, link_seg_dst
+
+class ShapeConfig(object):
+    """The anchors and link tables of one input shape. 
+    They are built once by `init_config`, and looked up by `get_shape_config`.
+    """
+    def __init__(self, image_shape, feat_shapes):
+        from nets import anchor_layer
+        self.image_shape = tuple(image_shape)
+        self.feat_shapes = feat_shapes
+        self.default_anchors, _ = anchor_layer.generate_anchors(self.image_shape, feat_shapes)
+        self.num_anchors = len(self.default_anchors)
+        self.default_anchor_map, self.default_anchor_center_set = _build_anchor_map(self.default_anchors)
+        self.num_links = self.num_anchors * 8 + (self.num_anchors - np.prod(feat_shapes[feat_layers[0]])) * 4
+        self.link_seg_src, self.link_seg_dst = _build_link_endpoints(feat_shapes)
+        assert len(self.link_seg_src) == self.num_links
+
+_shape_configs = {}
+
+def get_shape_config(shape = None):
+    """The ShapeConfig of an input shape, `image_shape` by default."""
+    if shape is None:
+        shape = image_shape
+    shape = tuple(shape)
+    if shape not in _shape_configs:
+        raise ValueError('The anchors of image shape %s have not been built by init_config.'%(str(shape)))
+    return _shape_configs[shape]
+
+def _build_shape_config(shape, weight_decay, in_new_graph):
+    """Get the feature map shapes by building a fake net. 
+    If `in_new_graph` is False, it is built in the default graph, creating the variables of SegLinkNet.
+    """
+    from nets import seglink_symbol
+    def get_feat_shapes():
+        h, w = shape
+        fake_image = tf.ones((1, h, w, 3))
+        fake_net = seglink_symbol.SegLinkNet(inputs = fake_image, weight_decay = weight_decay, do_summary = False)
+        return fake_net.get_shapes();
+    if in_new_graph:
+        with tf.Graph().as_default():
+            feat_shapes = get_feat_shapes()
+    else:
+        feat_shapes = get_feat_shapes()
+    _shape_configs[tuple(shape)] = ShapeConfig(shape, feat_shapes)
     
 def init_config(image_shape, batch_size = 1, 
                 weight_decay = 0.0005, 
@@ -89,34 +240,52 @@ def init_config(image_shape, batch_size = 1,
                 seg_loc_loss_weight = 1.0,
                 link_cls_loss_weight = 1.0,
                 seg_conf_threshold = 0.5,
-                link_conf_threshold = 0.5):
+                link_conf_threshold = 0.5,
+                link_ohnm_method = 'exact',
+                ohnm_num_bins = 1000,
+                sparse_link_loss = False,
+                link_neg_sample_rate = 0.01,
+                basenet_recompute_blocks = None,
+                basenet_frozen_blocks = None,
+                xla_jit = False,
+                compute_dtype = 'float32',
+                extra_image_shapes = None):
 
     _set_det_th(seg_conf_threshold, link_conf_threshold)
+    _set_link_ohnm(link_ohnm_method, ohnm_num_bins)
+    _set_sparse_link_loss(sparse_link_loss, link_neg_sample_rate)
+    _set_basenet_recompute_blocks(basenet_recompute_blocks)
+    _set_basenet_frozen_blocks(basenet_frozen_blocks)
+    _set_xla_jit(xla_jit)
+    _set_compute_dtype(compute_dtype)
     _set_loss_weight(seg_loc_loss_weight, link_cls_loss_weight)
     _set_train_with_ignored(train_with_ignored)
 
-    h, w = image_shape
-    from nets import anchor_layer
-    from nets import seglink_symbol
-    fake_image = tf.ones((1, h, w, 3))
-    fake_net = seglink_symbol.SegLinkNet(inputs = fake_image, weight_decay = weight_decay)
-    feat_shapes = fake_net.get_shapes();
+    # the tables of all shapes are built once here. The variables are created with the default shape.
+    _build_shape_config(image_shape, weight_decay, in_new_graph = False)
+    for shape in extra_image_shapes or []:
+        if tuple(shape) != tuple(image_shape):
+            _build_shape_config(shape, weight_decay, in_new_graph = True)
     
-    # the placement of the following lines are extremely important
-    _set_image_shape(image_shape)
-    _set_feat_shapes(feat_shapes)
+    # the tables of the default shape are also exposed as module-level globals.
+    shape_config = get_shape_config(image_shape)
+    _set_image_shape(shape_config.image_shape)
+    _set_feat_shapes(shape_config.feat_shapes)
 
-    anchors, _ = anchor_layer.generate_anchors()
     global default_anchors
-    default_anchors = anchors
-    
+    global default_anchor_map
+    global default_anchor_center_set
     global num_anchors
-    num_anchors = len(anchors)
-    
-    _build_anchor_map()
-    
     global num_links
-    num_links = num_anchors * 8 + (num_anchors - np.prod(feat_shapes[feat_layers[0]])) * 4
+    global link_seg_src
+    global link_seg_dst
+    default_anchors = shape_config.default_anchors
+    default_anchor_map = shape_config.default_anchor_map
+    default_anchor_center_set = shape_config.default_anchor_center_set
+    num_anchors = shape_config.num_anchors
+    num_links = shape_config.num_links
+    link_seg_src = shape_config.link_seg_src
+    link_seg_dst = shape_config.link_seg_dst
     
     #init batch size
     global gpus
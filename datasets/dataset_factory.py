@@ -62,3 +62,38 @@ def get_dataset(dataset_name, split_name, dataset_dir, reader=None):
     file_pattern = dataset_config.file_pattern
     num_samples = dataset_config.split_sizes[split_name]
     return dataset_utils.get_split(split_name, dataset_dir,file_pattern, num_samples, reader)
+
+
+class MultiDataset(object):
+    """Several datasets to be mixed by sampling weights. 
+    They share the same decoder, and each of them is read by its own readers.
+    """
+    def __init__(self, names, datasets, weights):
+        self.names = names
+        self.datasets = datasets
+        self.weights = [w * 1.0 / sum(weights) for w in weights]
+        self.data_sources = [dataset.data_sources for dataset in datasets]
+        self.decoder = datasets[0].decoder
+        self.num_samples = sum([dataset.num_samples for dataset in datasets])
+
+
+def get_multi_dataset(dataset_names, split_name, dataset_dirs, weights = None, reader=None):
+    """Get several datasets to be mixed.
+    Args:
+        dataset_names: a list of dataset names.
+        split_name: A train/test split dataset_name, shared by all datasets.
+        dataset_dirs: a list of directories, one for each dataset.
+        weights: a list of sampling weights, one for each dataset. 
+            If None, the weights are proportional to the numbers of samples, as if the datasets were concatenated.
+        reader: see `get_dataset`.
+    Returns:
+        A `MultiDataset`.
+    """
+    if len(dataset_dirs) != len(dataset_names):
+        raise ValueError('%d dataset directories are given for %d datasets' % (len(dataset_dirs), len(dataset_names)))
+    datasets = [get_dataset(name, split_name, dataset_dir, reader) for name, dataset_dir in zip(dataset_names, dataset_dirs)]
+    if weights is None:
+        weights = [dataset.num_samples for dataset in datasets]
+    if len(weights) != len(datasets) or min(weights) < 0 or sum(weights) <= 0:
+        raise ValueError('invalid dataset weights: %s' % (weights, ))
+    return MultiDataset(dataset_names, datasets, weights)
@@ -0,0 +1,122 @@
+"""An on-disk cache of preprocessed evaluation inputs.
+
+preprocess_for_eval is deterministic, so the decoded, whitened and resized images,
+together with their ground truth, can be computed once per (dataset, split, eval shape)
+and stored as memory-mapped .npy files. Later evaluations read them back without
+decoding any JPEG.
+"""
+import numpy as np
+import tensorflow as tf
+
+import util
+
+_COMPLETE_FLAG = 'complete'
+
+def get_cache_dir(cache_root, dataset_name, split_name, image_shape):
+    h, w = image_shape
+    return util.io.join_path(cache_root, '%s_%s_%dx%d'%(dataset_name, split_name, h, w))
+
+def exists(cache_dir):
+    return util.io.exists(util.io.join_path(cache_dir, _COMPLETE_FLAG))
+
+def _path(cache_dir, name):
+    return util.io.join_path(cache_dir, name + '.npy')
+
+def build_cache(cache_dir, tensors, num_samples, sess_config = None):
+    """Run the eval input tensors `num_samples` times and write the results into `cache_dir`.
+    Args:
+        tensors: (image, seg_label, seg_loc, link_gt, filename, shape, gignored, gxs, gys),
+            as returned by `eval_seglink.read_dataset`. They must be in the default graph.
+    """
+    util.io.mkdir(cache_dir)
+    image, seg_label, seg_loc, link_gt = tensors[:4]
+    fixed_arrays = {}
+    for name, t in zip(['images', 'seg_labels', 'seg_offsets', 'link_labels'], [image, seg_label, seg_loc, link_gt]):
+        shape = [num_samples] + t.get_shape().as_list()
+        fixed_arrays[name] = np.lib.format.open_memmap(_path(cache_dir, name), mode = 'w+',
+                                             dtype = t.dtype.as_numpy_dtype, shape = tuple(shape))
+    shapes = np.zeros((num_samples, 3), dtype = np.int64)
+    filenames = []
+    gt_offsets = np.zeros((num_samples + 1, ), dtype = np.int64)
+    all_gxs, all_gys, all_gignored = [], [], []
+
+    with tf.Session(config = sess_config) as sess:
+        sess.run(tf.local_variables_initializer())
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess = sess, coord = coord)
+        try:
+            for idx in xrange(num_samples):
+                values = sess.run(tensors)
+                for name, value in zip(['images', 'seg_labels', 'seg_offsets', 'link_labels'], values[:4]):
+                    fixed_arrays[name][idx, ...] = value
+                filename, shape, gignored, gxs, gys = values[4:]
+                filenames.append(filename)
+                shapes[idx, :] = shape
+                all_gignored.append(gignored)
+                all_gxs.append(gxs)
+                all_gys.append(gys)
+                gt_offsets[idx + 1] = gt_offsets[idx] + len(gignored)
+                if idx % 100 == 0:
+                    tf.logging.info('%d/%d images cached into %s'%(idx, num_samples, cache_dir))
+        finally:
+            coord.request_stop()
+            coord.join(threads)
+
+    for array in fixed_arrays.values():
+        array.flush()
+    np.save(_path(cache_dir, 'shapes'), shapes)
+    np.save(_path(cache_dir, 'filenames'), np.asarray(filenames))
+    np.save(_path(cache_dir, 'gt_offsets'), gt_offsets)
+    np.save(_path(cache_dir, 'gignored'), np.hstack(all_gignored).astype(np.int64))
+    np.save(_path(cache_dir, 'gxs'), np.vstack(all_gxs).astype(np.float32).reshape(-1, 4))
+    np.save(_path(cache_dir, 'gys'), np.vstack(all_gys).astype(np.float32).reshape(-1, 4))
+    # written at last, so that an interrupted building will not be taken as a valid cache.
+    util.io.write_lines(util.io.join_path(cache_dir, _COMPLETE_FLAG), ['%d'%(num_samples)])
+
+
+class EvalCache(object):
+    """Read a cache built by `build_cache`. Images and ground truths are memory-mapped,
+    so reading one sample costs no more than copying it from the page cache.
+    """
+    def __init__(self, cache_dir):
+        if not exists(cache_dir):
+            raise ValueError('No complete eval cache found in %s'%(cache_dir))
+        load = lambda name: np.load(_path(cache_dir, name), mmap_mode = 'r')
+        self.images = load('images')
+        self.seg_labels = load('seg_labels')
+        self.seg_offsets = load('seg_offsets')
+        self.link_labels = load('link_labels')
+        self.shapes = load('shapes')
+        self.filenames = load('filenames')
+        self.gt_offsets = load('gt_offsets')
+        self.gignored = load('gignored')
+        self.gxs = load('gxs')
+        self.gys = load('gys')
+        self.num_samples = len(self.images)
+        self.next_idx = 0
+
+    def get(self, idx):
+        start, end = self.gt_offsets[idx], self.gt_offsets[idx + 1]
+        return (self.images[idx], self.seg_labels[idx], self.seg_offsets[idx], self.link_labels[idx],
+                self.filenames[idx], self.shapes[idx],
+                self.gignored[start:end], self.gxs[start:end], self.gys[start:end])
+
+    def next(self):
+        """Return the next sample. It loops over the cache forever, like a data provider.
+        """
+        idx = self.next_idx
+        self.next_idx = (self.next_idx + 1) % self.num_samples
+        return self.get(idx)
+
+    def tf_next(self):
+        """The tensors of the next sample, in the same order and with the same static shapes as `eval_seglink.read_dataset`.
+        It is not zero-copy: the py_func copies every sample from the memory-mapped arrays into its output tensors.
+        """
+        dtypes = [tf.as_dtype(self.images.dtype), tf.int32, tf.float32, tf.int32,
+                  tf.string, tf.int64, tf.int64, tf.float32, tf.float32]
+        tensors = tf.py_func(self.next, [], dtypes, stateful = True)
+        shapes = [self.images.shape[1:], self.seg_labels.shape[1:], self.seg_offsets.shape[1:],
+                  self.link_labels.shape[1:], [], [3], [None], [None, 4], [None, 4]]
+        for t, shape in zip(tensors, shapes):
+            t.set_shape(shape)
+        return tensors
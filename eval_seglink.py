@@ -1,13 +1,14 @@
 #encoding = utf-8
 
+import collections
 import numpy as np
 import math
 import tensorflow as tf
 from tensorflow.python.ops import control_flow_ops
 from tensorflow.contrib.training.python.training import evaluation
-from datasets import dataset_factory
+from datasets import dataset_factory, eval_cache
 from preprocessing import ssd_vgg_preprocessing
-from tf_extended import seglink, metrics as tfe_metrics, bboxes as tfe_bboxes
+from tf_extended import seglink, metrics as tfe_metrics
 import util
 import cv2
 from nets import seglink_symbol, anchor_layer
@@ -48,6 +49,9 @@ tf.app.flags.DEFINE_bool('using_moving_average', False,
    'Whether to use ExponentionalMovingAverage')
 tf.app.flags.DEFINE_float('moving_average_decay', 0.9999, 
     'The decay rate of ExponentionalMovingAverage')
+tf.app.flags.DEFINE_integer('num_checkpoints', 1, 
+   'the number of the most recent checkpoints in `checkpoint_path` to be evaluated at once, \
+   sharing one input pipeline. If 1, only the checkpoint in `checkpoint_path` or the latest one is evaluated.')
 
 # =========================================================================== #
 # I/O and preprocessing Flags.
@@ -58,6 +62,28 @@ tf.app.flags.DEFINE_integer(
 tf.app.flags.DEFINE_integer(
     'num_preprocessing_threads', 1,
     'The number of threads used to create the batches.')
+tf.app.flags.DEFINE_integer(
+    'num_decode_workers', 0,
+    'The number of worker processes decoding network outputs into bboxes and matching them with ground truth, \
+    while the next image is being processed. If 0, they are done in the main process.')
+
+# =========================================================================== #
+# Subset evaluation Flags.
+# =========================================================================== #
+tf.app.flags.DEFINE_float('eval_subset_ratio', 1.0, 
+   'the fraction of images in a stratified deterministic subset to be evaluated, \
+   with a bootstrap confidence interval of F-mean. If 1, the whole dataset is evaluated.')
+tf.app.flags.DEFINE_integer('eval_ci_every_n_images', 100, 
+   'the number of images evaluated between two computations of the confidence interval.')
+tf.app.flags.DEFINE_integer('eval_num_bootstrap', 1000, 
+   'the number of bootstrap resamplings for the confidence interval.')
+tf.app.flags.DEFINE_float('eval_ci_level', 0.95, 'the confidence level of the confidence interval.')
+tf.app.flags.DEFINE_float('eval_ci_tolerance', 0.01, 
+   'subset evaluation stops early once the half width of the confidence interval is not larger than it.')
+tf.app.flags.DEFINE_integer('eval_min_images', 200, 
+   'the minimal number of images evaluated before stopping early.')
+tf.app.flags.DEFINE_integer('eval_max_images', 0, 
+   'the maximal number of images in subset evaluation. If 0, there is no limit.')
 
 # =========================================================================== #
 # Dataset Flags.
@@ -70,6 +96,9 @@ tf.app.flags.DEFINE_string(
     'dataset_dir', None, 'The directory where the dataset files are stored.')
 tf.app.flags.DEFINE_string(
     'model_name', 'seglink_vgg', 'The name of the architecture to train.')
+tf.app.flags.DEFINE_string('eval_cache_dir', None, 
+   'the root directory of the preprocessed input caches. If set, a cache of the decoded, resized \
+   and whitened images with their ground truth is built there on the first run, and read by later runs.')
 tf.app.flags.DEFINE_integer('eval_image_width', 1280, 'Train image size')
 tf.app.flags.DEFINE_integer('eval_image_height', 768, 'Train image size')
 
@@ -100,26 +129,52 @@ def config_initialization():
     
     return dataset
 
-def read_dataset(dataset):
-    with tf.name_scope(FLAGS.dataset_name +'_'  + FLAGS.dataset_split_name + '_data_provider'):
-        provider = slim.dataset_data_provider.DatasetDataProvider(
-            dataset,
-            num_readers=FLAGS.num_readers,
-            shuffle=False)
-        
-    [image, shape, filename, gignored, gbboxes, x1, x2, x3, x4, y1, y2, y3, y4] = provider.get([
-                                                     'image', 'shape', 'filename',
-                                                     'object/ignored',
-                                                     'object/bbox', 
-                                                     'object/oriented_bbox/x1',
-                                                     'object/oriented_bbox/x2',
-                                                     'object/oriented_bbox/x3',
-                                                     'object/oriented_bbox/x4',
-                                                     'object/oriented_bbox/y1',
-                                                     'object/oriented_bbox/y2',
-                                                     'object/oriented_bbox/y3',
-                                                     'object/oriented_bbox/y4'
-                                                     ])
+def get_eval_cache_dir():
+    return eval_cache.get_cache_dir(FLAGS.eval_cache_dir, FLAGS.dataset_name, FLAGS.dataset_split_name, 
+                                    config.image_shape)
+
+def prepare_eval_cache(dataset):
+    """Build the preprocessed input cache in a separate graph, if it does not exist yet.
+    """
+    cache_dir = get_eval_cache_dir()
+    if eval_cache.exists(cache_dir):
+        return
+    tf.logging.info('building eval cache in %s'%(cache_dir))
+    with tf.Graph().as_default():
+        tensors = read_dataset(dataset, use_cache = False)
+        eval_cache.build_cache(cache_dir, tensors, dataset.num_samples)
+
+def read_dataset(dataset, serialized = None, use_cache = True):
+    """
+    If `serialized` is given, the tf.train.Example in it is decoded instead of reading from a data provider.
+    If `eval_cache_dir` is set, samples are read from the preprocessed input cache.
+    """
+    items = ['image', 'shape', 'filename',
+             'object/ignored',
+             'object/bbox', 
+             'object/oriented_bbox/x1',
+             'object/oriented_bbox/x2',
+             'object/oriented_bbox/x3',
+             'object/oriented_bbox/x4',
+             'object/oriented_bbox/y1',
+             'object/oriented_bbox/y2',
+             'object/oriented_bbox/y3',
+             'object/oriented_bbox/y4'
+             ]
+    if serialized is None and use_cache and FLAGS.eval_cache_dir:
+        cache = eval_cache.EvalCache(get_eval_cache_dir())
+        return cache.tf_next()
+    
+    if serialized is None:
+        with tf.name_scope(FLAGS.dataset_name +'_'  + FLAGS.dataset_split_name + '_data_provider'):
+            provider = slim.dataset_data_provider.DatasetDataProvider(
+                dataset,
+                num_readers=FLAGS.num_readers,
+                shuffle=False)
+        values = provider.get(items)
+    else:
+        values = dataset.decoder.decode(serialized, items)
+    [image, shape, filename, gignored, gbboxes, x1, x2, x3, x4, y1, y2, y3, y4] = values
     gxs = tf.transpose(tf.stack([x1, x2, x3, x4])) #shape = (N, 4)
     gys = tf.transpose(tf.stack([y1, y2, y3, y4]))
     image = tf.identity(image, 'input_image')
@@ -137,15 +192,50 @@ def read_dataset(dataset):
         
     return image, seg_label, seg_loc, link_gt, filename, shape, gignored, gxs, gys
 
-def eval(dataset):
+def get_threshold_grid():
+    if FLAGS.do_grid_search:
+        # grid search            
+        seg_ths = np.arange(0.5, 0.91, 0.1)
+        link_ths = seg_ths
+    else:
+        seg_ths = [FLAGS.seg_conf_threshold]
+        link_ths = [FLAGS.link_conf_threshold]
+    return seg_ths, link_ths
+
+def put_to_decode_pool(decode_pool, counts, key, outputs):
+    """Put the network outputs of an image into `decode_pool` once for every pair of thresholds, 
+    and add the results which are ready into `counts`.
+    Args:
+        outputs: (seg_scores, link_scores, seg_offsets, shape, gxs, gys, gignored) of the image.
+    """
+    seg_scores, link_scores, seg_offsets, shape, gxs, gys, gignored = outputs
+    seg_ths, link_ths = get_threshold_grid()
+    for seg_th in seg_ths:
+        for link_th in link_ths:
+            results = decode_pool.put((key, seg_th, link_th), seg_scores, link_scores, seg_offsets, shape, 
+                                      seg_th, link_th, gxs, gys, gignored)
+            add_decode_results(counts, results)
+
+def add_decode_results(counts, results):
+    """Add the numbers of ground truth bboxes, true positives and false positives in decode `results`
+    into `counts`, a dict from (key, seg_th, link_th) to their sums.
+    """
+    for result_key, (_, num_gt_bboxes, num_tp, num_fp) in results:
+        counts[result_key] += [num_gt_bboxes, num_tp, num_fp]
+
+def create_counts():
+    return collections.defaultdict(lambda: np.zeros((3, ), dtype = np.int64))
+
+def eval(dataset, decode_pool):
     dict_metrics = {} 
     checkpoint_dir = util.io.get_dir(FLAGS.checkpoint_path)
     logdir = util.io.join_path(checkpoint_dir, 
                                'eval',  
                                "%s_%s"%(FLAGS.dataset_name, FLAGS.dataset_split_name))
+    eval_result_path = util.io.join_path(logdir, 'eval_on_%s_%s.log'%(FLAGS.dataset_name, FLAGS.dataset_split_name))
     
     global_step = slim.get_or_create_global_step()
-    with tf.name_scope('evaluation_%dx%d'%(FLAGS.eval_image_height, FLAGS.eval_image_width)):
+    with tf.name_scope('evaluation_%dx%d'%(FLAGS.eval_image_height, FLAGS.eval_image_width)) as eval_scope:
         with tf.variable_scope(tf.get_variable_scope(), reuse = True):# the variables has been created in config.init_config
             # get input tensor
             image, seg_label, seg_loc, link_gt, filename, shape, gignored, gxs, gys = read_dataset(dataset)
@@ -154,14 +244,13 @@ def eval(dataset):
             b_seg_label = tf.expand_dims(seg_label, axis = 0)
             b_seg_loc = tf.expand_dims(seg_loc, axis = 0)
             b_link_gt = tf.expand_dims(link_gt, axis = 0)
-            b_shape = tf.expand_dims(shape, axis = 0)
             
             # build seglink loss
             net = seglink_symbol.SegLinkNet(inputs = b_image, data_format = config.data_format)
             net.build_loss(seg_labels = b_seg_label, 
                            seg_offsets = b_seg_loc, 
                            link_labels = b_link_gt,
-                           do_summary = False) # the summary will be added in the following lines
+                           do_summary = False) # the summary will be written after evaluation
             
             # gather seglink losses
             losses = tf.get_collection(tf.GraphKeys.LOSSES)
@@ -172,53 +261,12 @@ def eval(dataset):
             seglink_loss = tf.add_n(losses)
             dict_metrics['seglink_loss'] = slim.metrics.streaming_mean(seglink_loss)
             
-            # Add metrics to summaries.
-            for name, metric in dict_metrics.items():
-                tf.summary.scalar(name, metric[0])
-            
+            # the xs and ys from tfrecord is 0~1, resize them to absolute length before matching.
             # shape = (height, width, channels) when format = NHWC TODO
             gxs = gxs * tf.cast(shape[1], gxs.dtype)
             gys = gys * tf.cast(shape[0], gys.dtype)
-            if FLAGS.do_grid_search:
-                # grid search            
-                seg_ths = np.arange(0.5, 0.91, 0.1)
-                link_ths = seg_ths
-            else:
-                seg_ths = [FLAGS.seg_conf_threshold]
-                link_ths = [FLAGS.link_conf_threshold]
-            
-            eval_result_path = util.io.join_path(logdir, 'eval_on_%s_%s.log'%(FLAGS.dataset_name, FLAGS.dataset_split_name))
-            for seg_th in seg_ths:
-                for link_th in link_ths:
-                    config._set_det_th(seg_th, link_th)
-                    
-                    eval_result_msg = 'seg_conf_threshold=%f, link_conf_threshold = %f, '\
-                                            %(config.seg_conf_threshold, config.link_conf_threshold)
-                    eval_result_msg += 'iter = %r, recall = %r, precision = %f, fmean = %r'
-                    
-                    with tf.name_scope('seglink_conf_th_%f_%f'\
-                                       %(config.seg_conf_threshold, config.link_conf_threshold)):
-                        # decode seglink to bbox output, with absolute length, instead of being within [0,1]
-                        bboxes_pred = seglink.tf_seglink_to_bbox(net.seg_scores, net.link_scores, net.seg_offsets,
-                                                                  b_shape, seg_conf_threshold = seg_th, link_conf_threshold = link_th)
-#                         bboxes_pred = tf.Print(bboxes_pred, [tf.shape(bboxes_pred)], '%f_%f, shape of bboxes = '%(seg_th, link_th))
-                        # calculate true positive and false positive
-                        # the xs and ys from tfrecord is 0~1, resize them to absolute length before matching.
-                        num_gt_bboxes, tp, fp = tfe_bboxes.bboxes_matching(bboxes_pred, gxs, gys, gignored)
-                        tp_fp_metric = tfe_metrics.streaming_tp_fp_arrays(num_gt_bboxes, tp, fp)
-                        dict_metrics['tp_fp_%f_%f'%(config.seg_conf_threshold, config.link_conf_threshold)] = (tp_fp_metric[0], tp_fp_metric[1])
-                         
-                        # precision and recall
-                        precision, recall = tfe_metrics.precision_recall(*tp_fp_metric[0])
-                         
-                        fmean = tfe_metrics.fmean(precision, recall)
-                        fmean = util.tf.Print(fmean, data = [global_step, recall, precision, fmean], 
-                                                msg = eval_result_msg, 
-                                                file = eval_result_path, mode = 'a')
-                        fmean = tf.Print(fmean, [recall, precision, fmean], '%f_%f, Recall, Precision, Fmean = '%(seg_th, link_th))
-                        tf.summary.scalar('Precision', precision)
-                        tf.summary.scalar('Recall', recall)
-                        tf.summary.scalar('F-mean', fmean)
+            # bboxes are decoded and matched in decode workers, outside of the session.
+            outputs = [net.seg_scores[0, :, 1], net.link_scores[0, :, 1], net.seg_offsets[0, ...], shape, gxs, gys, gignored]
             
     names_to_values, names_to_updates = slim.metrics.aggregate_metric_map(dict_metrics)
 
@@ -238,30 +286,291 @@ def eval(dataset):
         variables_to_restore[global_step.op.name] = global_step
     else:
         variables_to_restore = slim.get_variables_to_restore()
+    saver = tf.train.Saver(variables_to_restore)
 
     if util.io.is_dir(FLAGS.checkpoint_path):
-        slim.evaluation.evaluation_loop(
-            master = '',
-            eval_op=list(names_to_updates.values()),
-            num_evals=dataset.num_samples,
-            variables_to_restore=variables_to_restore,
-            checkpoint_dir = checkpoint_dir,
-            logdir = logdir,
-            session_config=sess_config)
+        # wait for new checkpoints and evaluate them, like slim.evaluation.evaluation_loop
+        checkpoints = tf.contrib.training.checkpoints_iterator(checkpoint_dir)
     else:
-        slim.evaluation.evaluate_once(
-            master = '',
-            eval_op=list(names_to_updates.values()),
-            variables_to_restore=variables_to_restore,
-            num_evals=2,#dataset.num_samples,
-            checkpoint_path = FLAGS.checkpoint_path,
-            logdir = logdir,
-            session_config=sess_config)
+        checkpoints = [FLAGS.checkpoint_path]
+    
+    summary_writer = tf.summary.FileWriter(logdir)
+    for checkpoint in checkpoints:
+        counts = create_counts()
+        with tf.Session(config = sess_config) as sess:
+            sess.run(tf.local_variables_initializer())
+            saver.restore(sess, checkpoint)
+            coord = tf.train.Coordinator()
+            threads = tf.train.start_queue_runners(sess = sess, coord = coord)
+            try:
+                for step in xrange(dataset.num_samples):
+                    _, image_outputs = sess.run([list(names_to_updates.values()), outputs])
+                    put_to_decode_pool(decode_pool, counts, None, image_outputs)
+                    if step % 100 == 0:
+                        tf.logging.info('%d/%d images evaluated'%(step, dataset.num_samples))
+            finally:
+                coord.request_stop()
+                coord.join(threads)
+            add_decode_results(counts, decode_pool.flush())
+            step_value, metric_values = sess.run([global_step, names_to_values])
+        
+        summary = tf.Summary()
+        for name, value in metric_values.items():
+            summary.value.add(tag = name, simple_value = value)
+        util.io.mkdir(logdir)
+        for _, seg_th, link_th in sorted(counts.keys()):
+            num_gt_bboxes, num_tp, num_fp = counts[(None, seg_th, link_th)]
+            precision, recall = tfe_metrics.np_precision_recall(num_gt_bboxes, num_tp, num_fp)
+            fmean = tfe_metrics.np_fmean(num_gt_bboxes, num_tp, num_fp)
+            eval_result_msg = 'seg_conf_threshold=%f, link_conf_threshold = %f, '\
+                              'iter = %r, recall = %r, precision = %f, fmean = %r'\
+                              %(seg_th, link_th, step_value, recall, precision, fmean)
+            tf.logging.info(eval_result_msg)
+            with open(eval_result_path, 'a') as f:
+                f.write(eval_result_msg + '\n')
+            th_scope = '%sseglink_conf_th_%f_%f/'%(eval_scope, seg_th, link_th)
+            for name, value in [('Precision', precision), ('Recall', recall), ('F-mean', fmean)]:
+                summary.value.add(tag = th_scope + name, simple_value = value)
+        summary_writer.add_summary(summary, step_value)
+        summary_writer.flush()
+
 
-                
+def get_recent_checkpoints(checkpoint_dir, num_checkpoints):
+    ckpt_state = tf.train.get_checkpoint_state(checkpoint_dir)
+    if ckpt_state is None or not ckpt_state.all_model_checkpoint_paths:
+        raise ValueError('No checkpoint found in %s'%(checkpoint_dir))
+    return list(ckpt_state.all_model_checkpoint_paths)[-num_checkpoints:]
+
+def get_replica_variables_to_restore(replica_scope):
+    """Map the names in checkpoint files to the variables of a replica.
+    """
+    if FLAGS.using_moving_average:
+        variable_averages = tf.train.ExponentialMovingAverage(FLAGS.moving_average_decay)
+    variables_to_restore = {}
+    for var in slim.get_model_variables(replica_scope + "/"):
+        name = var.op.name[len(replica_scope) + 1:]
+        if FLAGS.using_moving_average:
+            name = variable_averages.average_name(var)[len(replica_scope) + 1:]
+        variables_to_restore[name] = var
+    return variables_to_restore
+
+def eval_checkpoints(dataset, checkpoints, decode_pool):
+    """Evaluate several checkpoints against one shared input stream.
+    A replica of SegLinkNet is built for each checkpoint in its own variable scope, 
+    so the decoding, preprocessing and ground truth calculation are done only once for all of them.
+    """
+    checkpoint_dir = util.io.get_dir(checkpoints[-1])
+    logdir = util.io.join_path(checkpoint_dir, 
+                               'eval',  
+                               "%s_%s"%(FLAGS.dataset_name, FLAGS.dataset_split_name))
+    eval_result_path = util.io.join_path(logdir, 'eval_on_%s_%s.log'%(FLAGS.dataset_name, FLAGS.dataset_split_name))
+    
+    with tf.name_scope('evaluation_%dx%d'%(FLAGS.eval_image_height, FLAGS.eval_image_width)):
+        with tf.variable_scope(tf.get_variable_scope(), reuse = True):
+            image, seg_label, seg_loc, link_gt, filename, shape, gignored, gxs, gys = read_dataset(dataset)
+        b_image =  tf.expand_dims(image, axis = 0);
+        b_seg_label = tf.expand_dims(seg_label, axis = 0)
+        b_seg_loc = tf.expand_dims(seg_loc, axis = 0)
+        b_link_gt = tf.expand_dims(link_gt, axis = 0)
+        gxs = gxs * tf.cast(shape[1], gxs.dtype)
+        gys = gys * tf.cast(shape[0], gys.dtype)
+    
+    replicas = []
+    for replica_idx, checkpoint in enumerate(checkpoints):
+        dict_metrics = {}
+        # new variables are created for each replica, so do not reuse the ones created in config.init_config
+        with tf.variable_scope('replica_%d'%(replica_idx)) as replica_scope:
+            net = seglink_symbol.SegLinkNet(inputs = b_image, data_format = config.data_format)
+            net.build_loss(seg_labels = b_seg_label, 
+                           seg_offsets = b_seg_loc, 
+                           link_labels = b_link_gt,
+                           do_summary = False)
+            losses = tf.get_collection(tf.GraphKeys.LOSSES, replica_scope.name + "/")
+            assert len(losses) ==  3  # 3 is the number of seglink losses: seg_cls, seg_loc, link_cls
+            dict_metrics['seglink_loss'] = slim.metrics.streaming_mean(tf.add_n(losses))
+            # bboxes are decoded and matched in decode workers, outside of the session.
+            outputs = [net.seg_scores[0, :, 1], net.link_scores[0, :, 1], net.seg_offsets[0, ...]]
+                        
+        names_to_values, names_to_updates = slim.metrics.aggregate_metric_map(dict_metrics)
+        saver = tf.train.Saver(get_replica_variables_to_restore(replica_scope.name))
+        replicas.append((checkpoint, saver, names_to_values, names_to_updates, outputs))
+    
+    eval_ops = [list(replica[3].values()) for replica in replicas]
+    replica_outputs = [replica[4] for replica in replicas]
+    sess_config = tf.ConfigProto(log_device_placement = False, allow_soft_placement = True)
+    if FLAGS.gpu_memory_fraction < 0:
+        sess_config.gpu_options.allow_growth = True
+    elif FLAGS.gpu_memory_fraction > 0:
+        sess_config.gpu_options.per_process_gpu_memory_fraction = FLAGS.gpu_memory_fraction;
+    
+    counts = create_counts()
+    with tf.Session(config = sess_config) as sess:
+        sess.run(tf.local_variables_initializer())
+        for checkpoint, saver, _, _, _ in replicas:
+            tf.logging.info('restoring %s'%(checkpoint))
+            saver.restore(sess, checkpoint)
+            
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess = sess, coord = coord)
+        try:
+            for step in xrange(dataset.num_samples):
+                _, image_outputs, gt = sess.run([eval_ops, replica_outputs, [shape, gxs, gys, gignored]])
+                for replica_idx, net_outputs in enumerate(image_outputs):
+                    put_to_decode_pool(decode_pool, counts, replica_idx, net_outputs + gt)
+                if step % 100 == 0:
+                    tf.logging.info('%d/%d images evaluated'%(step, dataset.num_samples))
+        finally:
+            coord.request_stop()
+            coord.join(threads)
+        add_decode_results(counts, decode_pool.flush())
         
+        util.io.mkdir(logdir)
+        seg_ths, link_ths = get_threshold_grid()
+        for replica_idx, (checkpoint, _, names_to_values, _, _) in enumerate(replicas):
+            seglink_loss = sess.run(names_to_values['seglink_loss'])
+            for seg_th in seg_ths:
+                for link_th in link_ths:
+                    num_gt_bboxes, num_tp, num_fp = counts[(replica_idx, seg_th, link_th)]
+                    precision, recall = tfe_metrics.np_precision_recall(num_gt_bboxes, num_tp, num_fp)
+                    fmean = tfe_metrics.np_fmean(num_gt_bboxes, num_tp, num_fp)
+                    eval_result_msg = 'checkpoint = %s, seg_conf_threshold=%f, link_conf_threshold = %f, '\
+                                      'seglink_loss = %f, recall = %r, precision = %f, fmean = %r'\
+                                      %(checkpoint, seg_th, link_th, seglink_loss, recall, precision, fmean)
+                    tf.logging.info(eval_result_msg)
+                    with open(eval_result_path, 'a') as f:
+                        f.write(eval_result_msg + '\n')
+
+def get_stratum(example, file_idx):
+    """The stratum of an image: the data file it comes from, and its text density.
+    """
+    num_bboxes = len(example.features.feature['image/object/bbox/x1'].float_list.value)
+    density = np.searchsorted([1, 3, 6, 11], num_bboxes, side = 'right')
+    return (file_idx, density)
+
+def iterate_subset(dataset, ratio):
+    """Yield (serialized example, stratum) of a stratified deterministic subset of `dataset`.
+    Images are sampled systematically within each stratum: a fraction `ratio` of the images 
+    of every stratum is selected, evenly spread over its images in reading order, so the strata 
+    keep their proportions in the subset. Data files are sorted and visited in a round robin way, 
+    so that the subset is the same in every run and every file is represented in any prefix of it.
+    """
+    from tensorflow.contrib.slim.python.slim.data import parallel_reader
+    data_files = sorted(parallel_reader.get_data_files(dataset.data_sources))
+    iterators = [(file_idx, tf.python_io.tf_record_iterator(path)) for file_idx, path in enumerate(data_files)]
+    # the selected share of every stratum, starting from 0.5 so that round(ratio * num_images) are selected.
+    shares = collections.defaultdict(lambda: 0.5)
+    while len(iterators) > 0:
+        for file_idx, iterator in list(iterators):
+            try:
+                serialized = next(iterator)
+            except StopIteration:
+                iterators.remove((file_idx, iterator))
+                continue
+            example = tf.train.Example.FromString(serialized)
+            stratum = get_stratum(example, file_idx)
+            shares[stratum] += ratio
+            if shares[stratum] >= 1:
+                shares[stratum] -= 1
+                yield serialized, stratum
+
+def eval_subset(dataset, decode_pool):
+    """Quick-look evaluation on a stratified deterministic subset, 
+    stopping early once the bootstrap confidence interval of F-mean is tight enough.
+    """
+    checkpoint_dir = util.io.get_dir(FLAGS.checkpoint_path)
+    logdir = util.io.join_path(checkpoint_dir, 
+                               'eval',  
+                               "%s_%s"%(FLAGS.dataset_name, FLAGS.dataset_split_name))
+    eval_result_path = util.io.join_path(logdir, 'subset_eval_on_%s_%s.log'%(FLAGS.dataset_name, FLAGS.dataset_split_name))
+    
+    with tf.name_scope('subset_evaluation_%dx%d'%(FLAGS.eval_image_height, FLAGS.eval_image_width)):
+        with tf.variable_scope(tf.get_variable_scope(), reuse = True):
+            serialized = tf.placeholder(dtype = tf.string, shape = [])
+            image, _, _, _, filename, shape, gignored, gxs, gys = read_dataset(dataset, serialized)
+            b_image =  tf.expand_dims(image, axis = 0);
+            net = seglink_symbol.SegLinkNet(inputs = b_image, data_format = config.data_format)
+            gxs = gxs * tf.cast(shape[1], gxs.dtype)
+            gys = gys * tf.cast(shape[0], gys.dtype)
+            # bboxes are decoded and matched in decode workers, outside of the session.
+            outputs = [net.seg_scores[0, :, 1], net.link_scores[0, :, 1], net.seg_offsets[0, ...], shape, gxs, gys, gignored]
+    
+    sess_config = tf.ConfigProto(log_device_placement = False, allow_soft_placement = True)
+    if FLAGS.gpu_memory_fraction < 0:
+        sess_config.gpu_options.allow_growth = True
+    elif FLAGS.gpu_memory_fraction > 0:
+        sess_config.gpu_options.per_process_gpu_memory_fraction = FLAGS.gpu_memory_fraction;
+    
+    if FLAGS.using_moving_average:
+        variable_averages = tf.train.ExponentialMovingAverage(FLAGS.moving_average_decay)
+        variables_to_restore = variable_averages.variables_to_restore(slim.get_model_variables())
+    else:
+        variables_to_restore = slim.get_model_variables()
+    saver = tf.train.Saver(variables_to_restore)
+    if util.io.is_dir(FLAGS.checkpoint_path):
+        checkpoint = util.tf.get_latest_ckpt(FLAGS.checkpoint_path)
+    else:
+        checkpoint = FLAGS.checkpoint_path
+    
+    counts = [] # (num_gt_bboxes, num_tp, num_fp) of every image
+    strata = []
+    fmean, lower, upper = 0, 0, 1
+    with tf.Session(config = sess_config) as sess:
+        saver.restore(sess, checkpoint)
+        for image_data, stratum in iterate_subset(dataset, FLAGS.eval_subset_ratio):
+            seg_scores, link_scores, seg_offsets, image_shape, image_gxs, image_gys, image_gignored = \
+                    sess.run(outputs, feed_dict = {serialized: image_data})
+            results = decode_pool.put(stratum, seg_scores, link_scores, seg_offsets, image_shape, 
+                                      FLAGS.seg_conf_threshold, FLAGS.link_conf_threshold, 
+                                      image_gxs, image_gys, image_gignored)
+            num_checks = len(counts) / FLAGS.eval_ci_every_n_images
+            for image_stratum, (_, num_gt_bboxes, num_tp, num_fp) in results:
+                counts.append([num_gt_bboxes, num_tp, num_fp])
+                strata.append(image_stratum)
+            if len(counts) / FLAGS.eval_ci_every_n_images > num_checks:
+                num_images = len(counts)
+                fmean, lower, upper = tfe_metrics.np_bootstrap_fmean(np.asarray(counts), strata, 
+                                          num_bootstrap = FLAGS.eval_num_bootstrap, 
+                                          confidence = FLAGS.eval_ci_level)
+                tf.logging.info('%d images evaluated, fmean = %f, %.0f%% confidence interval = [%f, %f]'
+                                %(num_images, fmean, FLAGS.eval_ci_level * 100, lower, upper))
+                if num_images >= FLAGS.eval_min_images and (upper - lower) / 2 <= FLAGS.eval_ci_tolerance:
+                    break
+            if FLAGS.eval_max_images and len(counts) + len(decode_pool.pending) >= FLAGS.eval_max_images:
+                break
+    for image_stratum, (_, num_gt_bboxes, num_tp, num_fp) in decode_pool.flush():
+        counts.append([num_gt_bboxes, num_tp, num_fp])
+        strata.append(image_stratum)
+    
+    fmean, lower, upper = tfe_metrics.np_bootstrap_fmean(np.asarray(counts), strata, 
+                                          num_bootstrap = FLAGS.eval_num_bootstrap, 
+                                          confidence = FLAGS.eval_ci_level)
+    eval_result_msg = 'checkpoint = %s, seg_conf_threshold=%f, link_conf_threshold = %f, '\
+                      'num_images = %d, fmean = %f, %.0f%% confidence interval = [%f, %f]'\
+                      %(checkpoint, FLAGS.seg_conf_threshold, FLAGS.link_conf_threshold,
+                        len(counts), fmean, FLAGS.eval_ci_level * 100, lower, upper)
+    tf.logging.info(eval_result_msg)
+    util.io.mkdir(logdir)
+    with open(eval_result_path, 'a') as f:
+        f.write(eval_result_msg + '\n')
+
 def main(_):
-    eval(config_initialization())
+    dataset = config_initialization()
+    # fork the decode workers before any session, including the one building the eval cache, starts its threads.
+    decode_pool = seglink.DecodePool(FLAGS.num_decode_workers)
+    try:
+        if FLAGS.eval_cache_dir:
+            prepare_eval_cache(dataset)
+        if FLAGS.eval_subset_ratio < 1:
+            eval_subset(dataset, decode_pool)
+        elif FLAGS.num_checkpoints > 1:
+            if not util.io.is_dir(FLAGS.checkpoint_path):
+                raise ValueError('`checkpoint_path` must be a directory when `num_checkpoints` > 1')
+            eval_checkpoints(dataset, get_recent_checkpoints(FLAGS.checkpoint_path, FLAGS.num_checkpoints), 
+                             decode_pool)
+        else:
+            eval(dataset, decode_pool)
+    finally:
+        decode_pool.close()
     
     
 if __name__ == '__main__':
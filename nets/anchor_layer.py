@@ -1,14 +1,16 @@
 import numpy as np
 import config 
-def generate_anchors():
+def generate_anchors(image_shape = None, feat_shapes = None):
     """
-    
+    Generate the anchors of an input shape. By default, the anchors of `config.image_shape`.
     """
     all_anchors = []
     layer_anchors = {}
-    h_I, w_I = config.image_shape;
+    image_shape = image_shape or config.image_shape
+    feat_shapes = feat_shapes or config.feat_shapes
+    h_I, w_I = image_shape;
     for layer_name in config.feat_layers:
-        feat_shape = config.feat_shapes[layer_name];
+        feat_shape = feat_shapes[layer_name];
         h_l, w_l = feat_shape
         anchors = _generate_anchors_one_layer(h_I, w_I, h_l, w_l)
         all_anchors.append(anchors)
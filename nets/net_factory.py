@@ -4,6 +4,11 @@ net_dict = {
     "vgg": vgg
 }
 
-def get_basenet(name, inputs):
+def get_basenet(name, inputs, recompute_blocks = None, frozen_blocks = None):
     net = net_dict[name];
-    return net.basenet(inputs);
+    return net.basenet(inputs, recompute_blocks = recompute_blocks, frozen_blocks = frozen_blocks);
+
+def get_block_scopes(name, blocks):
+    """The variable scopes of the given blocks, relative to the scope of the base net."""
+    net = net_dict[name];
+    return [scope for block in blocks for scope in net.block_scopes[block]]
@@ -1,13 +1,56 @@
+import contextlib
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
 import net_factory
 import config
 
+# ops left out of XLA clusters when `config.xla_jit` is on: ops without XLA kernels, 
+# and ops whose outputs have data-dependent shapes or need data-dependent compile-time constants, e.g., `k` of top_k in OHNM.
+# They run as ordinary TF ops between the compiled clusters.
+_NON_XLA_OPS = set(['PyFunc', 'PyFuncStateless', 'EagerPyFunc', 
+                    'ScalarSummary', 'HistogramSummary', 'ImageSummary', 'MergeSummary',
+                    'TopKV2', 'Where', 'InvertPermutation', 'UnsortedSegmentSum', 'UnsortedSegmentMin', 
+                    'RandomUniform'])
+
+def _xla_compilable(node_def):
+    return node_def.op not in _NON_XLA_OPS
+
+def _float32_variable_getter(getter, name, shape = None, dtype = None, *args, **kwargs):
+    """Variables are always created and stored in float32, the master weights, 
+    and cast to the dtype requested by the layer, i.e., the dtype of its inputs.
+    """
+    var = getter(name, shape, tf.float32, *args, **kwargs)
+    if dtype is not None and dtype != tf.float32:
+        var = tf.cast(var, dtype)
+    return var
+
+@contextlib.contextmanager
+def _no_op_scope():
+    yield
+
+def xla_jit_scope():
+    """The ops created in this scope are compiled by XLA if `config.xla_jit` is True."""
+    if config.xla_jit:
+        return tf.contrib.compiler.jit.experimental_jit_scope(compile_ops = _xla_compilable)
+    return _no_op_scope()
+
 
 class SegLinkNet(object):
     def __init__(self, inputs, weight_decay = None, basenet_type = 'vgg', data_format = 'NHWC',  
-                                weights_initializer = None, biases_initializer = None):
+                                weights_initializer = None, biases_initializer = None, do_summary = True):
+        """
+        Args:
+            do_summary: whether to add the histograms of the network outputs. Running them runs the input pipeline 
+                of `inputs`, so they should be added for one tower only.
+        """
         self.inputs = inputs;
+        self.do_summary = do_summary
+        # the input shape, to look up the anchor and link tables in config.get_shape_config when building loss.
+        # it is not asserted to be fully defined here, since it is not needed for inference.
+        if data_format == 'NCHW':
+            self.image_shape = tuple(inputs.get_shape().as_list()[2:4])
+        else:
+            self.image_shape = tuple(inputs.get_shape().as_list()[1:3])
         self.weight_decay = weight_decay
         self.feat_layers = config.feat_layers
         self.basenet_type = basenet_type;
@@ -31,6 +74,14 @@ class SegLinkNet(object):
         return self.shapes[name] 
     
     def _build_network(self):
+        # in mixed precision mode, the convolutions are computed in `config.compute_dtype`, 
+        # while the variables, the seglink outputs and the loss are kept in float32.
+        compute_dtype = tf.as_dtype(config.compute_dtype)
+        inputs = self.inputs
+        custom_getter = None
+        if compute_dtype != tf.float32:
+            inputs = tf.cast(inputs, compute_dtype)
+            custom_getter = _float32_variable_getter
             
         with slim.arg_scope([slim.conv2d],
                         activation_fn=tf.nn.relu,
@@ -40,13 +91,15 @@ class SegLinkNet(object):
             with slim.arg_scope([slim.conv2d, slim.max_pool2d],
                                 padding='SAME',
                                 data_format = self.data_format):
-                with tf.variable_scope(self.basenet_type):
-                    basenet, end_points = net_factory.get_basenet(self.basenet_type, self.inputs);
+                with tf.variable_scope(self.basenet_type, custom_getter = custom_getter):
+                    basenet, end_points = net_factory.get_basenet(self.basenet_type, inputs, 
+                                                    recompute_blocks = config.basenet_recompute_blocks, 
+                                                    frozen_blocks = config.basenet_frozen_blocks);
                     
-                with tf.variable_scope('extra_layers'):
+                with tf.variable_scope('extra_layers', custom_getter = custom_getter):
                     self.net, self.end_points = self._add_extra_layers(basenet, end_points);
                 
-                with tf.variable_scope('seglink_layers'):
+                with tf.variable_scope('seglink_layers', custom_getter = custom_getter), xla_jit_scope():
                     self._add_seglink_layers();
         
     def _add_extra_layers(self, inputs, end_points):
@@ -84,7 +137,8 @@ class SegLinkNet(object):
         batch_size, h, w = tensor_shape(net)[:-1]
         
         if layer_name == 'conv4_3':
-            net = tf.nn.l2_normalize(net, -1) * 20
+            # the sum of squares may overflow in float16
+            net = tf.cast(tf.nn.l2_normalize(tf.cast(net, tf.float32), -1) * 20, net.dtype)
             
         with slim.arg_scope([slim.conv2d],
                 activation_fn = None,
@@ -123,6 +177,10 @@ class SegLinkNet(object):
         for layer_name in self.feat_layers:
             with tf.variable_scope(layer_name):
                 seg_scores, seg_offsets, within_layer_link_scores, cross_layer_link_scores = self._build_seg_link_layer(layer_name)
+            # the outputs are always in float32, whatever the compute dtype of the convolutions is.
+            to_float32 = lambda t: None if t is None else tf.cast(t, tf.float32)
+            seg_scores, seg_offsets, within_layer_link_scores, cross_layer_link_scores = map(to_float32, 
+                            [seg_scores, seg_offsets, within_layer_link_scores, cross_layer_link_scores])
             all_seg_scores.append(seg_scores)
             all_seg_offsets.append(seg_offsets)
             all_within_layer_link_scores.append(within_layer_link_scores)
@@ -136,12 +194,15 @@ class SegLinkNet(object):
         self.link_score_logits = tf.concat([self.within_layer_link_scores, self.cross_layer_link_scores], axis = 1)
         self.link_scores = slim.softmax(self.link_score_logits)
         
-        tf.summary.histogram('link_scores', self.link_scores)
-        tf.summary.histogram('seg_scores', self.seg_scores)
+        if self.do_summary:
+            tf.summary.histogram('link_scores', self.link_scores, collections = [config.HISTOGRAM_SUMMARIES])
+            tf.summary.histogram('seg_scores', self.seg_scores, collections = [config.HISTOGRAM_SUMMARIES])
         
     def build_loss(self, seg_labels, seg_offsets, link_labels, do_summary = True):
-        batch_size = config.batch_size_per_gpu
-        
+        with xla_jit_scope():
+            self._build_loss(seg_labels, seg_offsets, link_labels, do_summary)
+    
+    def _build_loss(self, seg_labels, seg_offsets, link_labels, do_summary = True):
         # note that for label values in both seg_labels and link_labels:
         #    -1 stands for negative
         #     1 stands for positive
@@ -156,108 +217,205 @@ class SegLinkNet(object):
             
             return pos_mask, neg_mask
         
-        def OHNM_single_image(scores, n_pos, neg_mask):
-            """Online Hard Negative Mining.
-                scores: the scores of being predicted as negative cls
-                n_pos: the number of positive samples 
+        def OHNM_batch(neg_conf, pos_mask, neg_mask):
+            """Online Hard Negative Mining on the whole batch at once.
+                neg_conf: (batch_size, N), the scores of being predicted as negative cls
+                pos_mask: mask of positive samples
                 neg_mask: mask of negative samples
                 Return:
-                    the mask of selected negative samples.
-                    if n_pos == 0, no negative samples will be selected.
+                    the mask of selected positive and negative samples.
+                    if there is no positive sample in an image, no negative samples will be selected in it.
             """
-            def has_pos():
-                n_neg = n_pos * config.max_neg_pos_ratio
-                max_neg_entries = tf.reduce_sum(tf.cast(neg_mask, tf.int32))
-                n_neg = tf.minimum(n_neg, max_neg_entries)
-                n_neg = tf.cast(n_neg, tf.int32)
-                neg_conf = tf.boolean_mask(scores, neg_mask)
-                vals, _ = tf.nn.top_k(-neg_conf, k=n_neg)
-                threshold = vals[-1]# a negtive value
-                selected_neg_mask = tf.logical_and(neg_mask, scores <= -threshold)
-                return tf.cast(selected_neg_mask, tf.float32)
-                
-            def no_pos():
-                return tf.zeros_like(neg_mask, tf.float32)
+            n_pos = tf.reduce_sum(tf.cast(pos_mask, tf.int32), axis = 1)
+            n_neg = n_pos * config.max_neg_pos_ratio
+            max_neg_entries = tf.reduce_sum(tf.cast(neg_mask, tf.int32), axis = 1)
+            n_neg = tf.minimum(n_neg, max_neg_entries) # (batch_size, )
             
-            return tf.cond(n_pos > 0, has_pos, no_pos) 
-        
-        def OHNM_batch(neg_conf, pos_mask, neg_mask):
-            selected_neg_mask = []
-            for image_idx in xrange(batch_size):
-                image_neg_conf = neg_conf[image_idx, :]
-                image_neg_mask = neg_mask[image_idx, :]
-                image_pos_mask = pos_mask[image_idx, :]
-                n_pos = tf.reduce_sum(tf.cast(image_pos_mask, tf.int32))
-                selected_neg_mask.append(OHNM_single_image(image_neg_conf, n_pos, image_neg_mask))
-                
-            selected_neg_mask = tf.stack(selected_neg_mask)
-            selected_mask = tf.cast(pos_mask, tf.float32) + selected_neg_mask
+            # hard negatives are the ones with the lowest negative scores. The scores of non-negative 
+            # entries are set to a value larger than any score, so that they are sorted after all negatives.
+            masked_neg_conf = tf.where(neg_mask, neg_conf, tf.ones_like(neg_conf) * 2)
+            k = tf.maximum(tf.reduce_max(n_neg), 1)
+            vals, _ = tf.nn.top_k(-masked_neg_conf, k = k) # (batch_size, k)
+            
+            # the threshold of each image is the score of its n_neg-th hardest negative
+            threshold_idx = tf.stack([tf.range(tf.shape(vals)[0]), tf.maximum(n_neg - 1, 0)], axis = 1)
+            threshold = tf.expand_dims(-tf.gather_nd(vals, threshold_idx), axis = 1)
+            selected_neg_mask = tf.logical_and(neg_mask, neg_conf <= threshold)
+            selected_neg_mask = tf.logical_and(selected_neg_mask, tf.expand_dims(n_neg > 0, axis = 1))
+            selected_mask = tf.cast(pos_mask, tf.float32) + tf.cast(selected_neg_mask, tf.float32)
             return selected_mask
-                
 
+        def OHNM_batch_histogram(neg_conf, pos_mask, neg_mask):
+            """Approximate Online Hard Negative Mining. 
+                Instead of sorting all negatives, the threshold of each image is picked from 
+                a histogram of its negative scores with `config.ohnm_num_bins` fixed bins over [0, 1].
+                All negatives in the bin containing the n_neg-th hardest one are selected, so the number of 
+                selected negatives is at least n_neg, and the excess is bounded by the count of that bin.
+                Return:
+                    the mask of selected positive and negative samples, 
+                    and the ratio of the number of selected negatives to n_neg
+            """
+            num_bins = config.ohnm_num_bins
+            n_pos = tf.reduce_sum(tf.cast(pos_mask, tf.int32), axis = 1)
+            n_neg = n_pos * config.max_neg_pos_ratio
+            max_neg_entries = tf.reduce_sum(tf.cast(neg_mask, tf.int32), axis = 1)
+            n_neg = tf.minimum(n_neg, max_neg_entries) # (batch_size, )
+            
+            # batched histogram: the bins of image i are [i * num_bins, (i + 1) * num_bins)
+            batch_size = tf.shape(neg_conf)[0]
+            bin_idx = tf.cast(tf.minimum(neg_conf * num_bins, num_bins - 1), tf.int32)
+            hist_idx = bin_idx + tf.expand_dims(tf.range(batch_size) * num_bins, axis = 1)
+            hist = tf.unsorted_segment_sum(tf.reshape(tf.cast(neg_mask, tf.int32), [-1]), 
+                                           tf.reshape(hist_idx, [-1]), batch_size * num_bins)
+            cum_hist = tf.cumsum(tf.reshape(hist, [batch_size, num_bins]), axis = 1)
+            
+            # the threshold bin is the first bin where the cumulative count reaches n_neg
+            threshold_bin = tf.reduce_sum(tf.cast(cum_hist < tf.expand_dims(n_neg, axis = 1), tf.int32), axis = 1)
+            selected_neg_mask = tf.logical_and(neg_mask, bin_idx <= tf.expand_dims(threshold_bin, axis = 1))
+            selected_neg_mask = tf.logical_and(selected_neg_mask, tf.expand_dims(n_neg > 0, axis = 1))
+            selected_mask = tf.cast(pos_mask, tf.float32) + tf.cast(selected_neg_mask, tf.float32)
+            
+            n_selected_neg = tf.reduce_sum(tf.cast(selected_neg_mask, tf.float32))
+            neg_ratio = n_selected_neg / tf.maximum(tf.cast(tf.reduce_sum(n_neg), tf.float32), 1.0)
+            return selected_mask, neg_ratio
+
+        # the losses of every image are also kept, each normalized by the number of its own positives,
+        # so that it does not depend on the other images in the batch. They are not used for training.
+        batch_size = tf.shape(seg_labels)[0]
+        
         # OHNM on segments
         seg_neg_scores = self.seg_scores[:, :, 0]
         seg_pos_mask, seg_neg_mask = get_pos_and_neg_masks(seg_labels)
         seg_selected_mask = OHNM_batch(seg_neg_scores, seg_pos_mask, seg_neg_mask)
         n_seg_pos = tf.reduce_sum(tf.cast(seg_pos_mask, tf.float32))
+        image_n_seg_pos = tf.maximum(tf.reduce_sum(tf.cast(seg_pos_mask, tf.float32), axis = 1), 1.0)
         
         with tf.name_scope('seg_cls_loss'):            
             def has_pos():
                 seg_cls_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
                     logits = self.seg_score_logits, 
                     labels = tf.cast(seg_pos_mask, dtype = tf.int32))
-                return tf.reduce_sum(seg_cls_loss * seg_selected_mask) / n_seg_pos
+                seg_cls_loss = seg_cls_loss * seg_selected_mask
+                return tf.reduce_sum(seg_cls_loss) / n_seg_pos, tf.reduce_sum(seg_cls_loss, axis = 1)
             def no_pos():
-                return tf.constant(.0);
-            seg_cls_loss = tf.cond(n_seg_pos > 0, has_pos, no_pos)
+                return tf.constant(.0), tf.zeros([batch_size])
+            seg_cls_loss, image_seg_cls_loss = tf.cond(n_seg_pos > 0, has_pos, no_pos)
             tf.add_to_collection(tf.GraphKeys.LOSSES, seg_cls_loss)
         
         def smooth_l1_loss(pred, target, weights):
-                diff = pred - target
-                abs_diff = tf.abs(diff)
-                abs_diff_lt_1 = tf.less(abs_diff, 1)
-                if len(target.shape) != len(weights.shape):
-                    loss = tf.reduce_sum(tf.where(abs_diff_lt_1, 0.5 * tf.square(abs_diff), abs_diff - 0.5), axis = 2)
-                    return tf.reduce_sum(loss * tf.cast(weights, tf.float32))
-                else:
-                    loss = tf.where(abs_diff_lt_1, 0.5 * tf.square(abs_diff), abs_diff - 0.5)
-                    return tf.reduce_sum(loss * tf.cast(weights, tf.float32))
+            """Weighted smooth L1 loss, summed over all segments of each image, 
+            but not over the last dimension, i.e., one loss for each image and offset component.
+            """
+            diff = pred - target
+            abs_diff = tf.abs(diff)
+            abs_diff_lt_1 = tf.less(abs_diff, 1)
+            loss = tf.where(abs_diff_lt_1, 0.5 * tf.square(abs_diff), abs_diff - 0.5)
+            weights = tf.expand_dims(tf.cast(weights, tf.float32), axis = -1)
+            return tf.reduce_sum(loss * weights, axis = 1)
 
         with tf.name_scope('seg_loc_loss'):            
+            # the per-component losses are computed by a single reduction, 
+            # and both the total loss and the summaries are derived from them.
             def has_pos():
-                seg_loc_loss = smooth_l1_loss(self.seg_offsets, seg_offsets, seg_pos_mask) * config.seg_loc_loss_weight / n_seg_pos
-                names= ['loc_cx_loss', 'loc_cy_loss', 'loc_w_loss', 'loc_h_loss', 'loc_theta_loss']
-                sub_loc_losses = []
-                from tensorflow.python.ops import control_flow_ops
-                for idx, name in enumerate(names):
-                    name_loss = smooth_l1_loss(self.seg_offsets[:, :, idx], seg_offsets[:,:, idx], seg_pos_mask) * config.seg_loc_loss_weight / n_seg_pos 
-                    name_loss = tf.identity(name_loss, name = name)
-                    if do_summary:
-                        tf.summary.scalar(name, name_loss)
-                    sub_loc_losses.append(name_loss)
-                seg_loc_loss = control_flow_ops.with_dependencies(sub_loc_losses, seg_loc_loss)
-                return seg_loc_loss
+                image_sub_loc_losses = smooth_l1_loss(self.seg_offsets, seg_offsets, seg_pos_mask) * config.seg_loc_loss_weight
+                return tf.reduce_sum(image_sub_loc_losses, axis = 0) / n_seg_pos, tf.reduce_sum(image_sub_loc_losses, axis = 1)
             def no_pos():
-                return tf.constant(.0);
-            seg_loc_loss = tf.cond(n_seg_pos > 0, has_pos, no_pos)
+                return tf.zeros([5]), tf.zeros([batch_size])
+            sub_loc_losses, image_seg_loc_loss = tf.cond(n_seg_pos > 0, has_pos, no_pos)
+            seg_loc_loss = tf.reduce_sum(sub_loc_losses)
             tf.add_to_collection(tf.GraphKeys.LOSSES, seg_loc_loss)
+            if do_summary:
+                names= ['loc_cx_loss', 'loc_cy_loss', 'loc_w_loss', 'loc_h_loss', 'loc_theta_loss']
+                for idx, name in enumerate(names):
+                    tf.summary.scalar(name, sub_loc_losses[idx])
 
         
+        def OHNM_ragged(neg_conf, pos_mask, neg_mask, image_ids, num_images):
+            """Exact Online Hard Negative Mining on a flat list of samples gathered from a batch.
+                neg_conf, pos_mask, neg_mask: (N, ), the samples of all images
+                image_ids: (N, ), the image each sample comes from
+                Return:
+                    the mask of selected positive and negative samples.
+            """
+            n_pos = tf.unsorted_segment_sum(tf.cast(pos_mask, tf.int32), image_ids, num_images)
+            n_neg = n_pos * config.max_neg_pos_ratio
+            max_neg_entries = tf.unsorted_segment_sum(tf.cast(neg_mask, tf.int32), image_ids, num_images)
+            n_neg = tf.minimum(n_neg, max_neg_entries) # (num_images, )
+            
+            # sort by (image, masked score) with one composite key. Scores lie in [0, 2], 
+            # so the keys of different images never overlap.
+            masked_neg_conf = tf.where(neg_mask, neg_conf, tf.ones_like(neg_conf) * 2)
+            keys = tf.cast(image_ids, tf.float32) * 4 + masked_neg_conf
+            _, order = tf.nn.top_k(-keys, k = tf.shape(keys)[0])
+            position = tf.invert_permutation(order)
+            
+            # the rank of a sample within its image
+            first_position = tf.unsorted_segment_min(position, image_ids, num_images)
+            rank = position - tf.gather(first_position, image_ids)
+            selected_neg_mask = tf.logical_and(neg_mask, rank < tf.gather(n_neg, image_ids))
+            selected_mask = tf.cast(pos_mask, tf.float32) + tf.cast(selected_neg_mask, tf.float32)
+            return selected_mask
+        
         link_neg_scores = self.link_scores[:,:,0]
         link_pos_mask, link_neg_mask = get_pos_and_neg_masks(link_labels)
-        link_selected_mask = OHNM_batch(link_neg_scores, link_pos_mask, link_neg_mask)
+        link_score_logits = self.link_score_logits
+        link_cls_labels = tf.cast(link_pos_mask, tf.int32)
+        link_image_ids = None # the image of every link in the loss, if they are gathered into a flat list
+        if config.sparse_link_loss:
+            with tf.name_scope('sparse_link_loss'):
+                # a link is relevant if any of its end segments is positive or selected as a hard negative.
+                # The appended column stands for the destination of links pointing outside the feature map.
+                seg_relevant = tf.concat([seg_selected_mask > 0, tf.zeros([batch_size, 1], dtype = tf.bool)], axis = 1)
+                seg_relevant = tf.transpose(seg_relevant) # gather along the first axis
+                shape_config = config.get_shape_config(self.image_shape)
+                link_seg_dst = tf.constant(shape_config.link_seg_dst)
+                link_seg_dst = tf.where(link_seg_dst < 0, tf.ones_like(link_seg_dst) * shape_config.num_anchors, link_seg_dst)
+                link_relevant = tf.logical_or(tf.gather(seg_relevant, shape_config.link_seg_src), 
+                                              tf.gather(seg_relevant, link_seg_dst))
+                link_relevant = tf.transpose(link_relevant)
+                link_sampled = tf.random_uniform(tf.shape(link_neg_scores)) < config.link_neg_sample_rate
+                link_candidates = tf.where(tf.logical_or(tf.logical_or(link_relevant, link_sampled), link_pos_mask))
+                
+                link_score_logits = tf.gather_nd(link_score_logits, link_candidates)
+                link_cls_labels = tf.gather_nd(link_cls_labels, link_candidates)
+                link_image_ids = tf.cast(link_candidates[:, 0], tf.int32)
+                link_selected_mask = OHNM_ragged(tf.gather_nd(link_neg_scores, link_candidates), 
+                                                 tf.gather_nd(link_pos_mask, link_candidates), 
+                                                 tf.gather_nd(link_neg_mask, link_candidates), 
+                                                 link_image_ids, batch_size)
+                if do_summary:
+                    tf.summary.scalar('link_candidate_ratio', 
+                        tf.cast(tf.shape(link_candidates)[0], tf.float32) / tf.cast(tf.size(link_neg_scores), tf.float32))
+        elif config.link_ohnm_method == 'histogram':
+            link_selected_mask, link_ohnm_neg_ratio = OHNM_batch_histogram(link_neg_scores, link_pos_mask, link_neg_mask)
+            if do_summary:
+                # 1.0 means exactly the expected number of negatives are selected.
+                tf.summary.scalar('link_ohnm_neg_ratio', link_ohnm_neg_ratio)
+        else:
+            link_selected_mask = OHNM_batch(link_neg_scores, link_pos_mask, link_neg_mask)
         n_link_pos = tf.reduce_sum(tf.cast(link_pos_mask, dtype = tf.float32))
+        image_n_link_pos = tf.maximum(tf.reduce_sum(tf.cast(link_pos_mask, tf.float32), axis = 1), 1.0)
         with tf.name_scope('link_cls_loss'):
             def has_pos():
                 link_cls_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
-                    logits = self.link_score_logits, 
-                    labels = tf.cast(link_pos_mask, tf.int32))
-                return tf.reduce_sum(link_cls_loss * link_selected_mask) / n_link_pos
+                    logits = link_score_logits, 
+                    labels = link_cls_labels)
+                link_cls_loss = link_cls_loss * link_selected_mask
+                if link_image_ids is None:
+                    image_link_cls_loss = tf.reduce_sum(link_cls_loss, axis = 1)
+                else:
+                    image_link_cls_loss = tf.unsorted_segment_sum(link_cls_loss, link_image_ids, batch_size)
+                return tf.reduce_sum(link_cls_loss) / n_link_pos, image_link_cls_loss
             def no_pos():
-                return tf.constant(.0);
-            link_cls_loss = tf.cond(n_link_pos > 0, has_pos, no_pos) * config.link_cls_loss_weight
+                return tf.constant(.0), tf.zeros([batch_size])
+            link_cls_loss, image_link_cls_loss = tf.cond(n_link_pos > 0, has_pos, no_pos)
+            link_cls_loss = link_cls_loss * config.link_cls_loss_weight
             tf.add_to_collection(tf.GraphKeys.LOSSES, link_cls_loss)
         
+        # (batch_size, ), the loss of every image, e.g., to find the hard ones.
+        self.image_losses = (image_seg_cls_loss + image_seg_loc_loss) / image_n_seg_pos + \
+                            image_link_cls_loss * config.link_cls_loss_weight / image_n_link_pos
+        
         if do_summary:
             tf.summary.scalar('seg_cls_loss', seg_cls_loss)
             tf.summary.scalar('seg_loc_loss', seg_loc_loss)
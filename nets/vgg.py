@@ -1,44 +1,116 @@
+import contextlib
+
 import tensorflow as tf
 
 slim = tf.contrib.slim
 
+# blocks that can be recomputed in the backward pass or frozen, see `basenet`.
+blocks = ['conv1', 'conv2', 'conv3', 'conv4', 'conv5', 'fc']
+
+# the variable scopes of each block, relative to the scope of the base net.
+block_scopes = {'conv1': ['conv1'], 'conv2': ['conv2'], 'conv3': ['conv3'], 
+                'conv4': ['conv4'], 'conv5': ['conv5'], 'fc': ['fc6', 'fc7']}
+
+def _conv_block(inputs, num_layers, num_outputs, scope):
+    return slim.repeat(inputs, num_layers, slim.conv2d, num_outputs, [3, 3], scope=scope)
+
+def _fc_block(inputs, end_points):
+    # fc6 as conv, dilation is added
+    net = slim.conv2d(inputs, 1024, [3, 3], rate=6, scope='fc6')
+    end_points['fc6'] = net
 
-def basenet(inputs):
+    # fc7 as conv
+    net = slim.conv2d(net, 1024, [1, 1], scope='fc7')
+    return net
+
+@contextlib.contextmanager
+def _no_op_scope():
+    yield
+
+def _resource_variable_scope(use_resource):
+    """recompute_grad only supports resource variables, so they are used if any block is recomputed."""
+    if use_resource:
+        return tf.variable_scope(tf.get_variable_scope(), use_resource = True, auxiliary_name_scope = False)
+    return _no_op_scope()
+
+def _maybe_recompute(block_fn, recompute):
+    """If `recompute` is True, only the input and output of the block are kept for backprop, 
+    and the activations inside it are recomputed from the input during the backward pass.
+    """
+    if recompute:
+        return tf.contrib.layers.recompute_grad(block_fn)
+    return block_fn
+
+def get_stop_gradient_block(frozen_blocks):
+    """The deepest block such that itself and all blocks before it are frozen. 
+    No gradient needs to be propagated into the base net through its output.
+    """
+    stop_block = None
+    for block in blocks:
+        if block not in frozen_blocks:
+            break
+        stop_block = block
+    return stop_block
+
+def basenet(inputs, recompute_blocks = None, frozen_blocks = None):
     """
     backbone net of vgg16
+    Args:
+        recompute_blocks: names of the blocks in `blocks` to be checkpointed at their boundaries.
+            The pooling layers are out of the blocks, so the features used by SegLink layers, e.g. conv4_3, 
+            are always kept.
+        frozen_blocks: names of the blocks in `blocks` not to be trained. `tf.stop_gradient` is placed at the output 
+            of the deepest block of the frozen prefix, see `get_stop_gradient_block`, so that no backward pass is 
+            built for it. Frozen blocks after it still propagate gradients, but their variables should be 
+            excluded from training by the caller.
     """
+    recompute_blocks = recompute_blocks or []
+    frozen_blocks = frozen_blocks or []
+    for block in recompute_blocks + frozen_blocks:
+        if block not in blocks:
+            raise ValueError('Invalid vgg block: %s'%(block))
+    stop_block = get_stop_gradient_block(frozen_blocks)
+    
+    def maybe_stop_gradient(net, block):
+        if block == stop_block:
+            return tf.stop_gradient(net)
+        return net
+    
+    def conv_block(net, num_layers, num_outputs, scope):
+        block_fn = lambda x: _conv_block(x, num_layers, num_outputs, scope)
+        net = _maybe_recompute(block_fn, scope in recompute_blocks)(net)
+        return maybe_stop_gradient(net, scope)
+
     # End_points collect relevant activations for external use.
     end_points = {}
     # Original VGG-16 blocks.
-    with slim.arg_scope([slim.conv2d, slim.max_pool2d], padding='SAME'):
-        net = slim.repeat(inputs, 2, slim.conv2d, 64, [3, 3], scope='conv1')
+    with _resource_variable_scope(len(recompute_blocks) > 0), \
+            slim.arg_scope([slim.conv2d, slim.max_pool2d], padding='SAME'):
+        net = conv_block(inputs, 2, 64, 'conv1')
         end_points['conv1_2'] = net
         net = slim.max_pool2d(net, [2, 2], scope='pool1')
         # Block 2.
-        net = slim.repeat(net, 2, slim.conv2d, 128, [3, 3], scope='conv2')
+        net = conv_block(net, 2, 128, 'conv2')
         end_points['conv2_2'] = net
         net = slim.max_pool2d(net, [2, 2], scope='pool2')
         # Block 3.
-        net = slim.repeat(net, 3, slim.conv2d, 256, [3, 3], scope='conv3')
+        net = conv_block(net, 3, 256, 'conv3')
         end_points['conv3_3'] = net
         net = slim.max_pool2d(net, [2, 2], scope='pool3')
         # Block 4.
-        net = slim.repeat(net, 3, slim.conv2d, 512, [3, 3], scope='conv4')
+        net = conv_block(net, 3, 512, 'conv4')
         end_points['conv4_3'] = net
         net = slim.max_pool2d(net, [2, 2], scope='pool4')
         # Block 5.
-        net = slim.repeat(net, 3, slim.conv2d, 512, [3, 3], scope='conv5')
+        net = conv_block(net, 3, 512, 'conv5')
         end_points['conv5_3'] = net
         net = slim.max_pool2d(net, [3, 3], 1, scope='pool5')
 
-        # fc6 as conv, dilation is added
-        net = slim.conv2d(net, 1024, [3, 3], rate=6, scope='fc6')
-        end_points['fc6'] = net
-
-        # fc7 as conv
-        net = slim.conv2d(net, 1024, [1, 1], scope='fc7')
+        # fc6 and fc7
+        fc_end_points = {}
+        net = _maybe_recompute(lambda x: _fc_block(x, fc_end_points), 'fc' in recompute_blocks)(net)
+        net = maybe_stop_gradient(net, 'fc')
+        end_points.update(fc_end_points)
         end_points['fc7'] = net
 
     return net, end_points;    
-
-
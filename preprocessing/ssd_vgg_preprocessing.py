@@ -233,6 +233,7 @@ def distorted_bounding_box_crop(image,
 
 def preprocess_for_train(image, labels, bboxes, xs, ys,
                          out_shape, data_format='NHWC',
+                         crop_aspect_ratio_range=CROP_ASPECT_RATIO_RANGE,
                          scope='ssd_preprocessing_train'):
     """Preprocesses the given image for training.
 
@@ -247,6 +248,8 @@ def preprocess_for_train(image, labels, bboxes, xs, ys,
             aspect-preserving resizing.
         resize_side_max: The upper bound for the smallest side of the image for
             aspect-preserving resizing.
+        crop_aspect_ratio_range: The range of the aspect ratio, width / height, of the random crop.
+            Narrow it around the aspect ratio of `out_shape` to reduce the distortion of resizing.
 
     Returns:
         A preprocessed image.
@@ -266,7 +269,7 @@ def preprocess_for_train(image, labels, bboxes, xs, ys,
         dst_image, labels, bboxes, xs, ys, distort_bbox = \
             distorted_bounding_box_crop(image, labels, bboxes, xs, ys,
                                         min_object_covered = MIN_OBJECT_COVERED,
-                                        aspect_ratio_range = CROP_ASPECT_RATIO_RANGE, 
+                                        aspect_ratio_range = crop_aspect_ratio_range, 
                                         area_range = AREA_RANGE)
             
         # Resize image to output size.
@@ -359,7 +362,8 @@ def preprocess_image(image,
     if is_training:
         return preprocess_for_train(image, labels, bboxes, xs, ys,
                                     out_shape=out_shape,
-                                    data_format=data_format)
+                                    data_format=data_format,
+                                    **kwargs)
     else:
         return preprocess_for_eval(image, labels, bboxes, xs, ys,
                                    out_shape=out_shape,
@@ -0,0 +1,51 @@
+#benchmark the training step time with and without XLA JIT compilation of the seglink layers and loss, on cpu.
+import time
+import numpy as np
+import tensorflow as tf
+
+from nets import seglink_symbol
+import config
+from validation_util import random_labels
+slim = tf.contrib.slim
+
+tf.app.flags.DEFINE_integer('image_size', 384, 'the height and width of the input images.')
+tf.app.flags.DEFINE_integer('batch_size', 1, 'the number of images in each batch.')
+tf.app.flags.DEFINE_integer('num_steps', 20, 'the number of timed training steps.')
+tf.app.flags.DEFINE_integer('num_warmup_steps', 5, 'the number of untimed steps before timing, including XLA compilation.')
+tf.app.flags.DEFINE_float('pos_ratio', 0.05, 'the ratio of positive segments and links in the random labels.')
+FLAGS = tf.app.flags.FLAGS
+
+def benchmark(use_jit):
+    with tf.Graph().as_default(), tf.device('/cpu:0'):
+        config.init_config((FLAGS.image_size, FLAGS.image_size), batch_size = FLAGS.batch_size, xla_jit = use_jit)
+        np.random.seed(0)
+        b_image = tf.constant(np.random.rand(FLAGS.batch_size, FLAGS.image_size, FLAGS.image_size, 3).astype(np.float32))
+        b_seg_label = tf.constant(random_labels((FLAGS.batch_size, config.num_anchors), FLAGS.pos_ratio))
+        b_seg_loc = tf.constant(np.random.randn(FLAGS.batch_size, config.num_anchors, 5).astype(np.float32))
+        b_link_label = tf.constant(random_labels((FLAGS.batch_size, config.num_links), FLAGS.pos_ratio))
+
+        with tf.variable_scope(tf.get_variable_scope(), reuse = True):
+            net = seglink_symbol.SegLinkNet(inputs = b_image, data_format = config.data_format)
+            net.build_loss(seg_labels = b_seg_label, seg_offsets = b_seg_loc,
+                           link_labels = b_link_label, do_summary = False)
+        loss = tf.add_n(tf.get_collection(tf.GraphKeys.LOSSES))
+        train_op = tf.train.MomentumOptimizer(0.0001, momentum = 0.9).minimize(loss)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in xrange(FLAGS.num_warmup_steps):
+                sess.run(train_op)
+            start = time.time()
+            for _ in xrange(FLAGS.num_steps):
+                sess.run(train_op)
+            return (time.time() - start) / FLAGS.num_steps
+
+def main(_):
+    step_time = benchmark(use_jit = False)
+    jit_step_time = benchmark(use_jit = True)
+    print 'image size = %d, batch size = %d'%(FLAGS.image_size, FLAGS.batch_size)
+    print 'without XLA: %.4f s/step'%(step_time)
+    print 'with XLA: %.4f s/step, speedup = %.2fx'%(jit_step_time, step_time / jit_step_time)
+
+if __name__ == '__main__':
+    tf.app.run()
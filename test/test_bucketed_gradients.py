@@ -0,0 +1,43 @@
+#test code to make sure that the bucketed gradient sum equals the per-variable add_n,
+# using multiple virtual cpu devices as clones.
+import numpy as np
+import tensorflow as tf
+
+from tf_extended import gradients as tfe_gradients
+
+tf.app.flags.DEFINE_integer('num_clones', 4, 'the number of virtual cpu devices, one clone on each.')
+tf.app.flags.DEFINE_integer('bucket_size', 10000, 'the maximal number of elements in a bucket.')
+FLAGS = tf.app.flags.FLAGS
+
+def main(_):
+    np.random.seed(0)
+    shapes = [(3, 3, 3, 64), (64, ), (3, 3, 64, 64), (64, ), (1, 1, 64, 1024), (1024, ), (7, ), (3, 3, 1024, 2)]
+    with tf.device('/cpu:0'):
+        variables = [tf.Variable(np.random.randn(*shape).astype(np.float32), name = 'var_%d'%(idx))
+                     for idx, shape in enumerate(shapes)]
+
+    clone_grads = []
+    for clone_idx in xrange(FLAGS.num_clones):
+        with tf.device('/cpu:%d'%(clone_idx)), tf.name_scope('clone_%d'%(clone_idx)):
+            loss = tf.add_n([tf.reduce_sum(tf.square(v) * (clone_idx + 1) + tf.sin(v) * clone_idx) for v in variables])
+            clone_grads.append(tf.train.GradientDescentOptimizer(0.1).compute_gradients(loss, var_list = variables))
+
+    expected = [tf.add_n([grads[idx][0] for grads in clone_grads]) for idx in xrange(len(variables))]
+    summed = tfe_gradients.bucketed_sum(clone_grads, bucket_size = FLAGS.bucket_size)
+    buckets = tfe_gradients._make_buckets(variables, FLAGS.bucket_size)
+    print '%d variables packed into %d buckets: %s'%(len(variables), len(buckets), buckets)
+    assert [v for _, v in summed] == variables
+
+    sess_config = tf.ConfigProto(device_count = {'CPU': FLAGS.num_clones}, log_device_placement = False)
+    with tf.Session(config = sess_config) as sess:
+        sess.run(tf.global_variables_initializer())
+        devices = [d.name for d in sess.list_devices()] if hasattr(sess, 'list_devices') else []
+        print 'devices: %s'%(devices)
+        expected_values, summed_values = sess.run([expected, [g for g, _ in summed]])
+        for var, e, s in zip(variables, expected_values, summed_values):
+            assert e.shape == s.shape, var.op.name
+            np.testing.assert_allclose(s, e, rtol = 1e-5, atol = 1e-5)
+    print 'bucketed sum equals per-variable sum.'
+
+if __name__ == '__main__':
+    tf.app.run()
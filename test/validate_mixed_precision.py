@@ -0,0 +1,82 @@
+#validate the mixed precision mode against float32 on cpu:
+# 1. the outputs, losses and gradients computed in float16 are close to the float32 ones, with the same weights;
+# 2. a step with overflowed gradients is skipped, and the loss scale is decreased.
+import numpy as np
+import tensorflow as tf
+
+from nets import seglink_symbol
+import config
+from validation_util import random_labels, relative_error
+slim = tf.contrib.slim
+
+tf.app.flags.DEFINE_integer('image_size', 384, 'the height and width of the input images.')
+tf.app.flags.DEFINE_integer('batch_size', 2, 'the number of images in each batch.')
+tf.app.flags.DEFINE_float('pos_ratio', 0.05, 'the ratio of positive segments and links in the random labels.')
+tf.app.flags.DEFINE_float('tolerance', 0.1, 
+    'the maximal relative error allowed. Gradients may differ more than outputs, since OHNM may select a few different negatives.')
+FLAGS = tf.app.flags.FLAGS
+
+def build_loss(compute_dtype, b_image, b_seg_label, b_seg_loc, b_link_label):
+    config._set_compute_dtype(compute_dtype)
+    with tf.variable_scope(tf.get_variable_scope(), reuse = True):# the variables has been created in config.init_config
+        with tf.name_scope(compute_dtype) as scope:
+            net = seglink_symbol.SegLinkNet(inputs = b_image, data_format = config.data_format)
+            net.build_loss(seg_labels = b_seg_label, seg_offsets = b_seg_loc,
+                           link_labels = b_link_label, do_summary = False)
+            loss = tf.add_n(tf.get_collection(tf.GraphKeys.LOSSES, scope))
+    return net, loss
+
+def main(_):
+    config.init_config((FLAGS.image_size, FLAGS.image_size), batch_size = FLAGS.batch_size)
+    np.random.seed(0)
+    b_image = tf.constant(np.random.rand(FLAGS.batch_size, FLAGS.image_size, FLAGS.image_size, 3).astype(np.float32))
+    b_seg_label = tf.constant(random_labels((FLAGS.batch_size, config.num_anchors), FLAGS.pos_ratio))
+    b_seg_loc = tf.constant(np.random.randn(FLAGS.batch_size, config.num_anchors, 5).astype(np.float32))
+    b_link_label = tf.constant(random_labels((FLAGS.batch_size, config.num_links), FLAGS.pos_ratio))
+
+    net32, loss32 = build_loss('float32', b_image, b_seg_label, b_seg_loc, b_link_label)
+    net16, loss16 = build_loss('float16', b_image, b_seg_label, b_seg_loc, b_link_label)
+    variables = tf.trainable_variables()
+    for var in variables:
+        assert var.dtype.base_dtype == tf.float32, var.op.name
+    grads32 = tf.gradients(loss32, variables)
+    # scaled by a fixed loss scale, or small gradients underflow in float16.
+    grads16 = [g / 1024. for g in tf.gradients(loss16 * 1024., variables)]
+
+    global_step = slim.create_global_step()
+    loss_scale_manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+                            init_loss_scale = 2 ** 60, incr_every_n_steps = 1000, decr_every_n_nan_or_inf = 1)
+    optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(
+                            tf.train.MomentumOptimizer(0.0001, momentum = 0.9), loss_scale_manager)
+    train_op = optimizer.minimize(loss16, global_step = global_step)
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        outputs = [net32.seg_scores, net32.link_scores, net32.seg_offsets, loss32]
+        outputs16 = [net16.seg_scores, net16.link_scores, net16.seg_offsets, loss16]
+        values = sess.run(outputs + outputs16 + grads32 + grads16)
+        num_outputs = len(outputs)
+        for name, v32, v16 in zip(['seg_scores', 'link_scores', 'seg_offsets', 'loss'],
+                                  values[:num_outputs], values[num_outputs: 2 * num_outputs]):
+            err = relative_error(v16, v32)
+            print '%s: relative error = %f'%(name, err)
+            assert err < FLAGS.tolerance, name
+        values = values[2 * num_outputs:]
+        for var, g32, g16 in zip(variables, values[:len(variables)], values[len(variables):]):
+            err = relative_error(g16, g32)
+            print 'gradient of %s: relative error = %f'%(var.op.name, err)
+            assert err < FLAGS.tolerance, var.op.name
+
+        # the loss scale of 2^60 overflows float16, so the step must be skipped.
+        values_before = sess.run(variables)
+        sess.run(train_op)
+        values_after = sess.run(variables)
+        for var, v_before, v_after in zip(variables, values_before, values_after):
+            assert np.all(v_before == v_after), var.op.name
+        assert sess.run(global_step) == 0
+        loss_scale = sess.run(loss_scale_manager.get_loss_scale())
+        assert loss_scale < 2 ** 60
+        print 'overflowed step skipped, loss scale decreased to %f'%(loss_scale)
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,52 @@
+#validate the recomputation of vgg blocks in the backward pass:
+# the gradients of the base net with all blocks recomputed must exist and be close to the ones without recomputation.
+import numpy as np
+import tensorflow as tf
+
+from nets import vgg
+from validation_util import relative_error
+slim = tf.contrib.slim
+
+tf.app.flags.DEFINE_integer('image_size', 64, 'the height and width of the input images.')
+tf.app.flags.DEFINE_integer('batch_size', 2, 'the number of images in each batch.')
+tf.app.flags.DEFINE_float('tolerance', 1e-4, 'the maximal relative error allowed.')
+FLAGS = tf.app.flags.FLAGS
+
+def build_loss(inputs, weights, recompute_blocks, reuse):
+    with tf.variable_scope('vgg', reuse = reuse):
+        net, _ = vgg.basenet(inputs, recompute_blocks = recompute_blocks)
+    return tf.reduce_sum(net * weights)
+
+def main(_):
+    np.random.seed(0)
+    inputs = tf.constant(np.random.rand(FLAGS.batch_size, FLAGS.image_size, FLAGS.image_size, 3).astype(np.float32))
+    feat_size = FLAGS.image_size / 16
+    weights = tf.constant(np.random.randn(FLAGS.batch_size, feat_size, feat_size, 1024).astype(np.float32))
+
+    # the variables are created by the net with recomputed blocks, like the one built by config.init_config in training.
+    recompute_loss = build_loss(inputs, weights, recompute_blocks = vgg.blocks, reuse = False)
+    variables = tf.trainable_variables()
+    for var in variables:
+        assert var.op.type == 'VarHandleOp', '%s is not a resource variable'%(var.op.name)
+    loss = build_loss(inputs, weights, recompute_blocks = None, reuse = True)
+    assert tf.trainable_variables() == variables
+    grads = tf.gradients(loss, [inputs] + variables)
+    recompute_grads = tf.gradients(recompute_loss, [inputs] + variables)
+    for var, grad, recompute_grad in zip([inputs] + variables, grads, recompute_grads):
+        assert grad is not None, var.op.name
+        assert recompute_grad is not None, 'no gradient of %s with recomputation'%(var.op.name)
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        loss_value, recompute_loss_value = sess.run([loss, recompute_loss])
+        print 'loss = %f, loss with recomputation = %f'%(loss_value, recompute_loss_value)
+        assert relative_error(recompute_loss_value, loss_value) < FLAGS.tolerance
+        values = sess.run(grads + recompute_grads)
+        for var, g, recompute_g in zip([inputs] + variables, values[:len(grads)], values[len(grads):]):
+            err = relative_error(recompute_g, g)
+            print 'gradient of %s: relative error = %f'%(var.op.name, err)
+            assert err < FLAGS.tolerance, var.op.name
+    print 'the gradients with recomputed blocks match the ones without recomputation.'
+
+if __name__ == '__main__':
+    tf.app.run()
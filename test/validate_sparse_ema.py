@@ -0,0 +1,56 @@
+#validate the moving averages updated every K steps against the ones updated every step, on a noisy linear regression:
+# the averaged weights and their losses on held-out data must be close to the per-step ones.
+import numpy as np
+import tensorflow as tf
+
+from tf_extended import moving_averages as tfe_moving_averages
+from validation_util import relative_error
+slim = tf.contrib.slim
+
+tf.app.flags.DEFINE_integer('num_steps', 5000, 'the number of training steps.')
+tf.app.flags.DEFINE_integer('every_n_steps', 10, 'the update interval of the sparse moving averages.')
+tf.app.flags.DEFINE_float('decay', 0.999, 'the decay of the per-step moving averages.')
+tf.app.flags.DEFINE_float('tolerance', 0.05, 'the maximal relative error allowed.')
+FLAGS = tf.app.flags.FLAGS
+
+def main(_):
+    np.random.seed(0)
+    dim = 32
+    true_w = np.random.randn(dim, 1).astype(np.float32)
+    test_x = np.random.randn(1000, dim).astype(np.float32)
+    test_y = test_x.dot(true_w)
+
+    global_step = slim.create_global_step()
+    w = tf.Variable(tf.zeros([dim, 1]), name = 'w')
+    x = tf.random_normal([8, dim])
+    y = tf.matmul(x, true_w) + tf.random_normal([8, 1]) * 0.5
+    loss = tf.reduce_mean(tf.square(tf.matmul(x, w) - y))
+    update_op = tf.train.GradientDescentOptimizer(0.01).minimize(loss, global_step = global_step)
+
+    ema = tf.train.ExponentialMovingAverage(FLAGS.decay, name = 'PerStepAverage')
+    with tf.control_dependencies([update_op]):
+        ema_op = ema.apply([w])
+    sparse_ema = tfe_moving_averages.SparseMovingAverage(FLAGS.decay, every_n_steps = FLAGS.every_n_steps, device = '/cpu:0')
+    sparse_ema.apply([w])
+    with tf.control_dependencies([update_op]):
+        sparse_ema_op = sparse_ema.update(global_step)
+    train_op = tf.group(ema_op, sparse_ema_op)
+
+    with tf.Session() as sess:
+        sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+        for _ in xrange(FLAGS.num_steps):
+            sess.run(train_op)
+        w_value, ema_w, sparse_ema_w = sess.run([w, ema.average(w), sparse_ema.average(w)])
+
+    def test_loss(weights):
+        return np.mean(np.square(test_x.dot(weights) - test_y))
+    print 'test loss: raw = %f, per-step average = %f, sparse average = %f'%(
+                    test_loss(w_value), test_loss(ema_w), test_loss(sparse_ema_w))
+    err = relative_error(sparse_ema_w, ema_w)
+    print 'relative error of the sparse average = %f'%(err)
+    assert err < FLAGS.tolerance
+    assert abs(test_loss(sparse_ema_w) - test_loss(ema_w)) < FLAGS.tolerance * max(test_loss(ema_w), 1e-3) + 1e-3
+    print 'the moving averages updated every %d steps match the per-step ones.'%(FLAGS.every_n_steps)
+
+if __name__ == '__main__':
+    tf.app.run()
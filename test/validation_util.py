@@ -0,0 +1,13 @@
+"""Helpers shared by the validation and benchmark scripts in this directory."""
+import numpy as np
+
+
+def random_labels(shape, pos_ratio):
+    """Random segment or link labels, a fraction `pos_ratio` of which are positive (1), and the others negative (-1)."""
+    labels = np.ones(shape, dtype = np.int32) * -1
+    labels[np.random.rand(*shape) < pos_ratio] = 1
+    return labels
+
+def relative_error(x, y):
+    """The norm of `x - y`, relative to the norm of `y`."""
+    return np.linalg.norm(x - y) / max(np.linalg.norm(y), 1e-8)
@@ -30,6 +30,9 @@ tf.app.flags.DEFINE_float('link_conf_threshold', 0.7,
 tf.app.flags.DEFINE_string('checkpoint_path', None, 
    'the path of checkpoint to be evaluated. If it is a directory containing many checkpoints, the lastest will be evaluated.')
 tf.app.flags.DEFINE_float('gpu_memory_fraction', -1, 'the gpu memory fraction to be used. If less than 0, allow_growth = True is used.')
+tf.app.flags.DEFINE_integer('num_decode_workers', 0, 
+   'The number of worker processes decoding network outputs into bboxes, while the next image is being processed. \
+   If 0, decoding is done in the main process.')
 
 
 # =========================================================================== #
@@ -79,19 +82,14 @@ def eval():
     with tf.name_scope('test'):
         with tf.variable_scope(tf.get_variable_scope(), reuse = True):# the variables has been created in config.init_config
             image = tf.placeholder(dtype=tf.int32, shape = [None, None, 3])
-            image_shape = tf.placeholder(dtype = tf.int32, shape = [3, ])
             processed_image, _, _, _, _ = ssd_vgg_preprocessing.preprocess_image(image, None, None, None, None, 
                                                        out_shape = config.image_shape,
                                                        data_format = config.data_format, 
                                                        is_training = False)
             b_image = tf.expand_dims(processed_image, axis = 0)
-            b_shape = tf.expand_dims(image_shape, axis = 0)
             net = seglink_symbol.SegLinkNet(inputs = b_image, data_format = config.data_format)
-            bboxes_pred = seglink.tf_seglink_to_bbox(net.seg_scores, net.link_scores, 
-                                                     net.seg_offsets, 
-                                                     image_shape = b_shape, 
-                                                     seg_conf_threshold = config.seg_conf_threshold,
-                                                     link_conf_threshold = config.link_conf_threshold)
+            # bboxes are decoded in decode workers, outside of the session.
+            outputs = [net.seg_scores[0, :, 1], net.link_scores[0, :, 1], net.seg_offsets[0, ...]]
 
     image_names = util.io.ls(FLAGS.dataset_dir)
     
@@ -112,6 +110,8 @@ def eval():
         
     tf.logging.info('testing', checkpoint)
 
+    # fork the decode workers before the session starts its threads.
+    decode_pool = seglink.DecodePool(FLAGS.num_decode_workers)
     with tf.Session(config = sess_config) as sess:
         saver.restore(sess, checkpoint)
         checkpoint_name = util.io.get_filename(str(checkpoint));
@@ -135,9 +135,14 @@ def eval():
         for iter, image_name in enumerate(image_names):
             image_data = util.img.imread(util.io.join_path(FLAGS.dataset_dir, image_name), rgb = True)
             image_name = image_name.split('.')[0]
-            image_bboxes = sess.run([bboxes_pred], feed_dict = {image:image_data, image_shape:image_data.shape})
+            seg_scores, link_scores, seg_offsets = sess.run(outputs, feed_dict = {image:image_data})
             print '%d/%d: %s'%(iter + 1, len(image_names), image_name)
-            write_result_as_txt(image_name, image_bboxes[0], txt_path)
+            for name, image_bboxes in decode_pool.put(image_name, seg_scores, link_scores, seg_offsets, image_data.shape, 
+                                                     config.seg_conf_threshold, config.link_conf_threshold):
+                write_result_as_txt(name, image_bboxes, txt_path)
+        for name, image_bboxes in decode_pool.flush():
+            write_result_as_txt(name, image_bboxes, txt_path)
+        decode_pool.close()
                 
         # create zip file for icdar2015
         cmd = 'cd %s;zip -j %s %s/*'%(dump_path, zip_path, txt_path);
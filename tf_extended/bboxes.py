@@ -233,6 +233,36 @@ def bboxes_matching(bboxes, gxs, gys, gignored, matching_threshold = 0.5, scope=
 #                             'Matching (NG, ND, TP, FP, n_ignored_det,GM): ')
         return n_gbboxes, tp_match, fp_match
 
+def np_bboxes_matching(bboxes, gxs, gys, gignored, matching_threshold = 0.5):
+    """Numpy version of `bboxes_matching`, for matching outside of the TF session.
+    Return: Tuple of:
+       n_gbboxes: the number of not ignored groundtruth boxes.
+       tp_match: (N,)-shaped boolean ndarray containing with True Positives.
+       fp_match: (N,)-shaped boolean ndarray containing with False Positives.
+    """
+    gignored = np.asarray(gignored, dtype = bool)
+    n_gbboxes = np.sum(np.logical_not(gignored))
+    n_bboxes = len(bboxes)
+    gmatch = np.zeros(np.shape(gignored), dtype = bool)
+    tp_match = np.zeros((n_bboxes, ), dtype = bool)
+    fp_match = np.zeros((n_bboxes, ), dtype = bool)
+    if len(gignored) == 0:
+        fp_match[:] = True
+        return n_gbboxes, tp_match, fp_match
+    
+    for i in xrange(n_bboxes):
+        jaccard = np_bboxes_jaccard(bboxes[i], gxs, gys)
+        idxmax = np.argmax(jaccard)
+        match = jaccard[idxmax] > matching_threshold
+        existing_match = gmatch[idxmax]
+        not_ignored = not gignored[idxmax]
+        # TP: match & no previous match and FP: previous match | no match.
+        # If ignored: no record, i.e FP=False and TP=False.
+        tp_match[i] = not_ignored and match and not existing_match
+        fp_match[i] = not_ignored and (existing_match or not match)
+        gmatch[idxmax] = gmatch[idxmax] or (not_ignored and match)
+    return n_gbboxes, tp_match, fp_match
+
 def bboxes_jaccard(bbox, gxs, gys):
     jaccard = tf.py_func(np_bboxes_jaccard, [bbox, gxs, gys], tf.float32)
     jaccard.set_shape([None, ])
@@ -0,0 +1,177 @@
+"""Checkpoints written in the background, with retention policies."""
+import os
+import threading
+import Queue
+
+import tensorflow as tf
+
+
+def select_checkpoints_to_keep(checkpoints, keep_last_n = 5, keep_every_n = 0, keep_best_n = 0):
+    """
+    Args:
+        checkpoints: a list of dicts with keys 'step', 'index' (the 1-based ordinal of the checkpoint)
+            and 'score' (None if not evaluated), in the order they have been written.
+        keep_last_n: keep the latest `keep_last_n` checkpoints.
+        keep_every_n: if larger than 0, keep every `keep_every_n`-th checkpoint, i.e., the ones whose index is a multiple of it.
+        keep_best_n: keep the `keep_best_n` checkpoints with the highest scores.
+    Return:
+        the set of the steps of the checkpoints to be kept.
+    """
+    to_keep = set()
+    if keep_last_n > 0:
+        to_keep.update([ckpt['step'] for ckpt in checkpoints[-keep_last_n:]])
+    if keep_every_n > 0:
+        to_keep.update([ckpt['step'] for ckpt in checkpoints if ckpt['index'] % keep_every_n == 0])
+    if keep_best_n > 0:
+        scored = [ckpt for ckpt in checkpoints if ckpt['score'] is not None]
+        scored = sorted(scored, key = lambda ckpt: ckpt['score'], reverse = True)
+        to_keep.update([ckpt['step'] for ckpt in scored[:keep_best_n]])
+    return to_keep
+
+
+class AsyncCheckpointSaver(object):
+    """Save checkpoints without blocking training.
+    The values of the variables are copied to host memory in the training thread,
+    and written in a background thread by a Saver of a separate graph, with the same variable names.
+    The checkpoints are compatible with the ones written by `tf.train.Saver` on the training graph.
+    Old checkpoints are removed according to the retention policies, see `select_checkpoints_to_keep`.
+    """
+    def __init__(self, variables, save_path, keep_last_n = 5, keep_every_n = 0, keep_best_n = 0):
+        self.variables = variables
+        self.save_path = save_path
+        self.checkpoint_dir = os.path.dirname(save_path)
+        self.keep_last_n = keep_last_n
+        self.keep_every_n = keep_every_n
+        self.keep_best_n = keep_best_n
+        self.checkpoints = []
+        self.written_steps = [] # the steps of all written checkpoints, including the removed ones
+        self.scores = {} # evaluation step -> score
+        self.lock = threading.Lock()
+        self._load_checkpoint_state()
+        self.last_step = self.written_steps[-1] if self.written_steps else None # the step of the last queued snapshot
+
+        # at most one snapshot waiting to be written and one being written are held in host memory.
+        self.queue = Queue.Queue(maxsize = 1)
+        self._build_writer()
+        self.thread = threading.Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _load_checkpoint_state(self):
+        """Take over the checkpoints listed in the checkpoint state of `checkpoint_dir`, e.g., the ones written 
+        before training is restarted, so that they are pruned by the retention policies too.
+        """
+        ckpt_state = tf.train.get_checkpoint_state(self.checkpoint_dir)
+        if ckpt_state is None:
+            return
+        for path in ckpt_state.all_model_checkpoint_paths:
+            if not tf.train.checkpoint_exists(path):
+                continue
+            step = int(path.rsplit('-', 1)[-1])
+            self.written_steps.append(step)
+            self.checkpoints.append({'step': step, 'path': path, 'score': None, 'index': len(self.written_steps)})
+        tf.logging.info('%d existing checkpoints found in %s'%(len(self.checkpoints), self.checkpoint_dir))
+
+    def _build_writer(self):
+        self.graph = tf.Graph()
+        with self.graph.as_default(), tf.device('/cpu:0'):
+            self.placeholders = []
+            assign_ops = []
+            var_list = {}
+            for var in self.variables:
+                dtype = var.dtype.base_dtype
+                shape = var.get_shape()
+                writer_var = tf.Variable(tf.zeros(shape, dtype = dtype), name = var.op.name)
+                placeholder = tf.placeholder(dtype, shape = shape)
+                self.placeholders.append(placeholder)
+                assign_ops.append(tf.assign(writer_var, placeholder))
+                var_list[var.op.name] = writer_var
+            self.assign_op = tf.group(*assign_ops)
+            # retention is done by this class, not by the Saver.
+            self.saver = tf.train.Saver(var_list = var_list, max_to_keep = None, write_version = 2)
+        self.sess = tf.Session(graph = self.graph, config = tf.ConfigProto(device_count = {'GPU': 0}))
+
+    def save(self, sess, step, wait = False):
+        """Snapshot the variables at `step`, and queue them for writing.
+        If `wait` is False, it is skipped if the last snapshot has not started being written yet. 
+        Otherwise, it waits for that. A step already saved is not saved again.
+        Return:
+            the path of the checkpoint, or None if skipped.
+        """
+        if step == self.last_step:
+            return None
+        if not wait and self.queue.full():
+            tf.logging.info('skip the checkpoint at step %d because the last one is still pending.'%(step))
+            return None
+        values = sess.run(self.variables)
+        self.last_step = step
+        self.queue.put((step, values))
+        return '%s-%d'%(self.save_path, step)
+
+    def report_score(self, step, score):
+        """Report an evaluation score, e.g., F-measure, of the model at `step`. 
+        A checkpoint takes the score of the earliest evaluation at or after its step and before the next checkpoint, 
+        so the evaluation interval had better be a multiple of the checkpoint interval.
+        It may be called before the checkpoint of the same step has been written.
+        """
+        with self.lock:
+            self.scores[step] = score
+            self._prune()
+
+    def close(self):
+        """Wait until all queued checkpoints have been written."""
+        self.queue.put(None)
+        self.thread.join()
+        self.sess.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            step, values = item
+            self.sess.run(self.assign_op, feed_dict = dict(zip(self.placeholders, values)))
+            path = self.saver.save(self.sess, self.save_path, global_step = step, write_meta_graph = False)
+            tf.logging.info('checkpoint written asynchronously: %s'%(path))
+            with self.lock:
+                self.written_steps.append(step)
+                self.checkpoints.append({'step': step, 'path': path, 'score': None, 'index': len(self.written_steps)})
+                self._prune()
+
+    def _assign_scores(self):
+        eval_steps = sorted(self.scores.keys())
+        for ckpt in self.checkpoints:
+            idx = ckpt['index'] # the next checkpoint is at self.written_steps[idx]
+            next_step = self.written_steps[idx] if idx < len(self.written_steps) else float('inf')
+            steps = [step for step in eval_steps if ckpt['step'] <= step < next_step]
+            if steps:
+                ckpt['score'] = self.scores[steps[0]]
+
+    def _prune(self):
+        self._assign_scores()
+        to_keep = select_checkpoints_to_keep(self.checkpoints, self.keep_last_n, self.keep_every_n, self.keep_best_n)
+        for ckpt in self.checkpoints:
+            if ckpt['step'] not in to_keep:
+                for path in tf.gfile.Glob(ckpt['path'] + '.*'):
+                    tf.gfile.Remove(path)
+                tf.logging.info('checkpoint removed: %s'%(ckpt['path']))
+        self.checkpoints = [ckpt for ckpt in self.checkpoints if ckpt['step'] in to_keep]
+        if self.checkpoints:
+            tf.train.update_checkpoint_state(self.checkpoint_dir, self.checkpoints[-1]['path'],
+                                    all_model_checkpoint_paths = [ckpt['path'] for ckpt in self.checkpoints])
+
+
+class AsyncSaver(tf.train.Saver):
+    """A `tf.train.Saver` which restores variables as usual, but writes checkpoints through an `AsyncCheckpointSaver`.
+    Given to `slim.learning.train`, the checkpoint saved by the supervisor at the end of training goes through 
+    the retention policies, instead of overwriting the checkpoint state with a list of its own.
+    """
+    def __init__(self, checkpoint_saver, **kwargs):
+        super(AsyncSaver, self).__init__(var_list = checkpoint_saver.variables, **kwargs)
+        self.checkpoint_saver = checkpoint_saver
+
+    def save(self, sess, save_path, global_step = None, *args, **kwargs):
+        """Queue a checkpoint at `global_step` for writing. `save_path` is ignored, the one of `checkpoint_saver` is used.
+        """
+        step = tf.train.global_step(sess, global_step)
+        return self.checkpoint_saver.save(sess, step, wait = True)
@@ -0,0 +1,59 @@
+"""Aggregation of gradients computed by multiple clones."""
+import tensorflow as tf
+
+
+def _make_buckets(variables, bucket_size):
+    """Split variables into groups of consecutive variables with the same dtype,
+    each with at most `bucket_size` elements, unless a single variable is larger than that.
+    """
+    buckets = []
+    bucket = []
+    num_elements = 0
+    for idx, var in enumerate(variables):
+        var_size = var.get_shape().num_elements()
+        if bucket and (num_elements + var_size > bucket_size or
+                       variables[bucket[-1]].dtype.base_dtype != var.dtype.base_dtype):
+            buckets.append(bucket)
+            bucket = []
+            num_elements = 0
+        bucket.append(idx)
+        num_elements += var_size
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+def bucketed_sum(clone_grads, bucket_size = 4 * 1024 * 1024, reduce_device = None):
+    """Sum the gradients of all clones bucket by bucket, instead of variable by variable.
+    On each clone, the gradients in a bucket are flattened and concatenated into one tensor.
+    The tensors of all clones are summed by a single `add_n` per bucket, and the sum is split back.
+    Args:
+        clone_grads: a list, one for each clone, of lists of (gradient, variable) pairs,
+            as returned by `Optimizer.compute_gradients`. All clones must have the same variables in the same order.
+        bucket_size: the maximal number of elements in a bucket.
+        reduce_device: the device where the sums are computed. If None, the device of the first clone's gradients.
+    Return:
+        a list of (summed gradient, variable) pairs.
+    """
+    variables = [v for _, v in clone_grads[0]]
+    for grads_and_vars in clone_grads[1:]:
+        assert [v for _, v in grads_and_vars] == variables
+    shapes = [v.get_shape() for v in variables]
+    sizes = [shape.num_elements() for shape in shapes]
+
+    summed_grads = [None] * len(variables)
+    for bucket_idx, bucket in enumerate(_make_buckets(variables, bucket_size)):
+        with tf.name_scope('gradient_bucket_%d'%(bucket_idx)):
+            flat_grads = []
+            for grads_and_vars in clone_grads:
+                grads = [tf.convert_to_tensor(grads_and_vars[idx][0]) for idx in bucket]
+                # packed on the device of the clone, so that only one tensor per bucket is transferred.
+                with tf.device(grads[0].device):
+                    flat_grads.append(tf.concat([tf.reshape(g, [-1]) for g in grads], axis = 0))
+
+            with tf.device(reduce_device or flat_grads[0].device):
+                flat_sum = tf.add_n(flat_grads)
+                grads = tf.split(flat_sum, [sizes[idx] for idx in bucket], axis = 0)
+                for idx, grad in zip(bucket, grads):
+                    summed_grads[idx] = tf.reshape(grad, shapes[idx])
+    return zip(summed_grads, variables)
@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.ops import variables
 from tensorflow.python.ops import array_ops
@@ -83,4 +84,49 @@ def precision_recall(num_gbboxes, tp, fp, scope=None):
 def fmean(pre, rec):
     """Compute f-mean with precision and recall
     """
-    return 2 * pre * rec / (pre + rec)
\ No newline at end of file
+    return 2 * pre * rec / (pre + rec)
+
+def np_precision_recall(num_gbboxes, tp, fp):
+    """Precision and recall calculated from the numbers of ground truth bboxes, true positives and false positives.
+    All arguments can be numpy arrays with the same shape.
+    """
+    num_gbboxes = np.asarray(num_gbboxes, dtype = np.float64)
+    tp = np.asarray(tp, dtype = np.float64)
+    fp = np.asarray(fp, dtype = np.float64)
+    precision = tp / np.maximum(tp + fp, 1)
+    recall = tp / np.maximum(num_gbboxes, 1)
+    return precision, recall
+
+def np_fmean(num_gbboxes, tp, fp):
+    """F-mean calculated from the numbers of ground truth bboxes, true positives and false positives.
+    All arguments can be numpy arrays with the same shape.
+    """
+    precision, recall = np_precision_recall(num_gbboxes, tp, fp)
+    return 2 * precision * recall / np.maximum(precision + recall, 1e-12)
+
+def np_bootstrap_fmean(counts, strata = None, num_bootstrap = 1000, confidence = 0.95, seed = 0):
+    """Stratified bootstrap confidence interval of F-mean.
+    Args:
+        counts: ndarray with shape = (N, 3), the number of ground truth bboxes, 
+            true positives and false positives of every image.
+        strata: the stratum of every image. Images are resampled with replacement within their strata.
+    Return:
+        fmean, lower bound, upper bound
+    """
+    counts = np.asarray(counts, dtype = np.int64)
+    fmean = np_fmean(*np.sum(counts, axis = 0))
+    if len(counts) < 2:
+        return fmean, 0.0, 1.0
+    if strata is None:
+        strata = np.zeros(len(counts))
+    rng = np.random.RandomState(seed)
+    sampled_counts = np.zeros((num_bootstrap, 3), dtype = np.int64)
+    strata_keys = [str(s) for s in strata]
+    for key in set(strata_keys):
+        stratum_counts = counts[[idx for idx, k in enumerate(strata_keys) if k == key], :]
+        sample_idxes = rng.randint(0, len(stratum_counts), size = (num_bootstrap, len(stratum_counts)))
+        sampled_counts += np.sum(stratum_counts[sample_idxes], axis = 1)
+    fmeans = np_fmean(sampled_counts[:, 0], sampled_counts[:, 1], sampled_counts[:, 2])
+    alpha = (1 - confidence) / 2 * 100
+    lower, upper = np.percentile(fmeans, [alpha, 100 - alpha])
+    return fmean, lower, upper
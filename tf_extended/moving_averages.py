@@ -0,0 +1,60 @@
+"""Exponential moving averages of variables, updated every few steps."""
+import tensorflow as tf
+
+
+class SparseMovingAverage(object):
+    """Exponential moving averages updated once every `every_n_steps` steps, with the decay `decay ** every_n_steps`,
+    so that the averages cover the same number of steps as the ones of `tf.train.ExponentialMovingAverage(decay)`
+    updated every step, at a fraction of the cost.
+    The shadow variables have the same names as the ones of `tf.train.ExponentialMovingAverage`,
+    so they are restored by its `variables_to_restore` for evaluation.
+    """
+    def __init__(self, decay, every_n_steps = 1, device = None, name = 'ExponentialMovingAverage'):
+        """
+        Args:
+            device: the device of the shadow variables, e.g., '/cpu:0'. If None, they are placed with their variables.
+        """
+        self.decay = decay
+        self.every_n_steps = every_n_steps
+        self.device = device
+        self.name = name
+        self.averages = {}
+        self.last_update_step = None
+
+    def average_name(self, var):
+        return var.op.name + '/' + self.name
+
+    def average(self, var):
+        return self.averages.get(var)
+
+    def apply(self, variables):
+        """Create the shadow variables, initialized with the values of `variables`."""
+        for var in variables:
+            with tf.device(self.device or var.device):
+                self.averages[var] = tf.get_variable(self.average_name(var), initializer = var.initialized_value(),
+                                                     trainable = False)
+                tf.add_to_collection(tf.GraphKeys.MOVING_AVERAGE_VARIABLES, var)
+        if self.last_update_step is None:
+            # a local variable, so it is neither saved nor restored, and no step after a restart matches its initial value.
+            self.last_update_step = tf.Variable(tf.constant(-1, dtype = tf.int64), trainable = False, 
+                                                collections = [tf.GraphKeys.LOCAL_VARIABLES], name = self.name + '_last_update_step')
+
+    def update(self, global_step):
+        """An op updating all averages if `global_step` is a multiple of `every_n_steps`, and doing nothing otherwise.
+        The averages are updated at most once for each value of `global_step`, which stays the same 
+        when a step is skipped, e.g., by a `LossScaleOptimizer` on overflow.
+        It reads `global_step` when it runs, so create it under the control dependency of the step's update.
+        """
+        decay = self.decay ** self.every_n_steps
+        step = tf.cast(global_step, tf.int64)
+        def do_update():
+            update_ops = []
+            for var, avg in self.averages.items():
+                with tf.device(avg.device):
+                    update_ops.append(tf.assign_sub(avg, (avg - tf.identity(var)) * (1 - decay)))
+            with tf.control_dependencies(update_ops):
+                return tf.group(tf.assign(self.last_update_step, step))
+        is_new_step = tf.not_equal(step, self.last_update_step)
+        if self.every_n_steps > 1:
+            is_new_step = tf.logical_and(is_new_step, tf.equal(tf.mod(step, self.every_n_steps), 0))
+        return tf.cond(is_new_step, do_update, tf.no_op)
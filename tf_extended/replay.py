@@ -0,0 +1,103 @@
+"""Replay of hard training images, selected by their losses."""
+import collections
+import heapq
+import random
+import threading
+
+import numpy as np
+
+
+class HardExampleReplay(object):
+    """A bounded-memory priority sampler of training records, keyed by integers, e.g., the hashes of image filenames.
+    Records flow through `sample` on their way from the reader to decoding. Each of them is held as pending
+    until its loss is reported by `report`, after being trained on. The records with the highest losses are kept
+    in a buffer of `capacity` records, and a fraction `replay_ratio` of the records passed on are replayed from it,
+    instead of the incoming ones. The loss of a replayed record is reported again, so it leaves the buffer once learned.
+    At most `capacity + pending_capacity` serialized records are held in memory.
+    """
+    def __init__(self, capacity, replay_ratio = 0.25, pending_capacity = 1000):
+        self.capacity = capacity
+        self.replay_ratio = replay_ratio
+        self.pending_capacity = pending_capacity
+        self.pending = collections.OrderedDict() # key -> record, the oldest first
+        self.records = {} # key -> (loss, record), the hard ones
+        self.heap = [] # (loss, key) of self.records, possibly with stale entries, the easiest first
+        self.keys = [] # the keys of self.records, for uniform sampling
+        self.num_replayed = 0
+        self.num_sampled = 0
+        self.lock = threading.Lock()
+
+    def sample(self, key, record):
+        """Pass on the incoming record, or replay a hard one.
+        Return:
+            the serialized record to be decoded.
+        """
+        key = int(key)
+        with self.lock:
+            self.num_sampled += 1
+            if self.keys and random.random() < self.replay_ratio:
+                self.num_replayed += 1
+                key = random.choice(self.keys)
+                return self.records[key][1]
+            self.pending[key] = record
+            while len(self.pending) > self.pending_capacity:
+                self.pending.popitem(last = False)
+            return record
+
+    def report(self, keys, losses):
+        """Report the losses of trained records, e.g., the images of a batch.
+        Return:
+            the number of records in the buffer.
+        """
+        with self.lock:
+            for key, loss in zip(keys, losses):
+                key, loss = int(key), float(loss)
+                if key in self.records:
+                    self.records[key] = (loss, self.records[key][1])
+                    heapq.heappush(self.heap, (loss, key))
+                elif key in self.pending:
+                    record = self.pending.pop(key)
+                    if len(self.records) < self.capacity or loss > self._min_loss():
+                        self._add(key, loss, record)
+                self._evict()
+            self._compact()
+            return np.int32(len(self.records))
+
+    def mean_loss(self):
+        """The mean loss of the records in the buffer, 0 if empty."""
+        with self.lock:
+            if not self.records:
+                return np.float32(0)
+            return np.float32(np.mean([loss for loss, _ in self.records.values()]))
+
+    def _add(self, key, loss, record):
+        self.records[key] = (loss, record)
+        self.keys.append(key)
+        heapq.heappush(self.heap, (loss, key))
+
+    def _pop_min(self):
+        """Pop the (loss, key) of the easiest record in the buffer from the heap, skipping stale entries."""
+        while self.heap:
+            loss, key = heapq.heappop(self.heap)
+            if key in self.records and self.records[key][0] == loss:
+                return loss, key
+        return None
+
+    def _min_loss(self):
+        item = self._pop_min()
+        if item is None:
+            return float('-inf')
+        heapq.heappush(self.heap, item)
+        return item[0]
+
+    def _evict(self):
+        while len(self.records) > self.capacity:
+            _, key = self._pop_min()
+            del self.records[key]
+            self.keys.remove(key)
+
+    def _compact(self):
+        # a loss reported again leaves a stale entry in the heap, so it is rebuilt once it has grown too large.
+        if len(self.heap) > 4 * max(self.capacity, 1):
+            self.heap = [(loss, key) for key, (loss, _) in self.records.items()]
+            heapq.heapify(self.heap)
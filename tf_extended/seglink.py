@@ -1,9 +1,12 @@
+import collections
+import multiprocessing
 import cv2
 import numpy as np
 import tensorflow as tf
 
 import config
 import util
+from tf_extended import bboxes as tfe_bboxes
 
 ############################################################################################################
 #                       seg_gt calculation                                                                 #
@@ -254,8 +257,9 @@ def match_anchor_to_text_boxes(anchors, xs, ys):
     return seg_labels, seg_locations
 
 # @util.dec.print_calling_in_short_for_tf
-def match_anchor_to_text_boxes_fast(anchors, xs, ys):
+def match_anchor_to_text_boxes_fast(anchors, xs, ys, image_shape = None):
     """Match anchors to text boxes. 
+       `anchors` must be the default anchors of `image_shape`, `config.image_shape` by default.
        Return:
            seg_labels: shape = (N,), the seg_labels of segments. each value is the index of matched box if >=0.  
            seg_locations: shape = (N, 5), the absolute location of segments. Only the match segments are correctly calculated.
@@ -287,7 +291,8 @@ def match_anchor_to_text_boxes_fast(anchors, xs, ys):
     
     # construct a bbox point map: keys are the poistion of all points in bbox contours, and 
     #    value being the bbox index
-    bbox_mask = np.ones(config.image_shape, dtype = np.int32) * (-1)
+    shape_config = config.get_shape_config(image_shape)
+    bbox_mask = np.ones(shape_config.image_shape, dtype = np.int32) * (-1)
     for bbox_idx in xrange(num_bboxes):
         bbox_points = zip(xs[bbox_idx, :], ys[bbox_idx, :])
         bbox_cnts = util.img.points_to_contours(bbox_points)
@@ -295,10 +300,10 @@ def match_anchor_to_text_boxes_fast(anchors, xs, ys):
     
     points_in_bbox_mask = np.where(bbox_mask >= 0)
     points_in_bbox_mask = set(zip(*points_in_bbox_mask))
-    points_in_bbox_mask = points_in_bbox_mask.intersection(config.default_anchor_center_set)
+    points_in_bbox_mask = points_in_bbox_mask.intersection(shape_config.default_anchor_center_set)
     
     for point in points_in_bbox_mask:
-        anchors_here = config.default_anchor_map[point]
+        anchors_here = shape_config.default_anchor_map[point]
         for anchor_idx in anchors_here:
             anchor = anchors[anchor_idx, :]
             bbox_idx = bbox_mask[point]
@@ -319,13 +324,14 @@ def match_anchor_to_text_boxes_fast(anchors, xs, ys):
 ############################################################################################################
 #                       link_gt calculation                                                                #
 ############################################################################################################
-def reshape_link_gt_by_layer(link_gt):
+def reshape_link_gt_by_layer(link_gt, image_shape = None):
+    feat_shapes = config.get_shape_config(image_shape).feat_shapes
     inter_layer_link_gts = {}
     cross_layer_link_gts = {}
     
     idx = 0;
     for layer_idx, layer_name in enumerate(config.feat_layers):
-        layer_shape = config.feat_shapes[layer_name]
+        layer_shape = feat_shapes[layer_name]
         lh, lw = layer_shape
         
         length = lh * lw * 8;
@@ -336,7 +342,7 @@ def reshape_link_gt_by_layer(link_gt):
         
     for layer_idx in xrange(1, len(config.feat_layers)):
         layer_name = config.feat_layers[layer_idx]
-        layer_shape = config.feat_shapes[layer_name]
+        layer_shape = feat_shapes[layer_name]
         lh, lw = layer_shape
         length = lh * lw * 4;
         layer_link_gt = link_gt[idx: idx + length]
@@ -347,11 +353,12 @@ def reshape_link_gt_by_layer(link_gt):
     assert idx == len(link_gt)
     return inter_layer_link_gts, cross_layer_link_gts
         
-def reshape_labels_by_layer(labels):
+def reshape_labels_by_layer(labels, image_shape = None):
+    feat_shapes = config.get_shape_config(image_shape).feat_shapes
     layer_labels = {}
     idx = 0;
     for layer_name in config.feat_layers:
-        layer_shape = config.feat_shapes[layer_name]
+        layer_shape = feat_shapes[layer_name]
         label_length = np.prod(layer_shape)
         
         layer_match_result = labels[idx: idx + label_length]
@@ -378,13 +385,14 @@ def is_valid_cord(x, y, w, h):
     """
     return x >=0 and x < w and y >= 0 and y < h;
 
-def cal_link_labels(labels):
-    layer_labels = reshape_labels_by_layer(labels)
+def cal_link_labels(labels, image_shape = None):
+    feat_shapes = config.get_shape_config(image_shape).feat_shapes
+    layer_labels = reshape_labels_by_layer(labels, image_shape)
     inter_layer_link_gts = []
     cross_layer_link_gts = []
     for layer_idx, layer_name in enumerate(config.feat_layers):
         layer_match_result = layer_labels[layer_name]
-        h, w = config.feat_shapes[layer_name]
+        h, w = feat_shapes[layer_name]
         
         # initalize link groundtruth for the current layer
         inter_layer_link_gt = np.ones((h, w, 8), dtype = np.int32) * (-1)
@@ -416,7 +424,7 @@ def cal_link_labels(labels):
                     # cross layer link_gt calculation
                     if layer_idx > 0:
                         previous_layer_name = config.feat_layers[layer_idx - 1];
-                        ph, pw = config.feat_shapes[previous_layer_name]
+                        ph, pw = feat_shapes[previous_layer_name]
                         previous_layer_match_result = layer_labels[previous_layer_name]
                         neighbours = get_cross_layer_neighbours(x, y)
                         for nidx, nxy in enumerate(neighbours):
@@ -440,14 +448,15 @@ def cal_link_labels(labels):
     return link_gt
 
 # @util.dec.print_calling_in_short_for_tf
-def encode_seg_offsets(seg_locs):
+def encode_seg_offsets(seg_locs, image_shape = None):
     """
     Args:
         seg_locs: a ndarray with shape = (N, 5). It contains the abolute values of segment locations 
+        image_shape: the input shape whose default boxes are used, `config.image_shape` by default.
     Return:
         seg_offsets, i.e., the offsets from default boxes. It is used as the final segment location ground truth.
     """
-    anchors = config.default_anchors
+    anchors = config.get_shape_config(image_shape).default_anchors
     anchor_cx, anchor_cy, anchor_w, anchor_h = (anchors[:, idx] for idx in range(4))
     seg_cx, seg_cy, seg_w, seg_h = (seg_locs[:, idx] for idx in range(4))
     
@@ -492,7 +501,7 @@ def decode_seg_offsets_pred(seg_offsets_pred):
     return seg_loc
 
 # @util.dec.print_calling_in_short_for_tf
-def get_all_seglink_gt(xs, ys, ignored):
+def get_all_seglink_gt(xs, ys, ignored, image_shape = None):
     
     # calculate ground truths. 
     # for matching results, i.e., seg_labels and link_labels, the values stands for the 
@@ -505,10 +514,10 @@ def get_all_seglink_gt(xs, ys, ignored):
     assert len(xs) == len(ignored), 'the length of xs and `ignored` must be the same, \
             but got %s and %s'%(len(xs), len(ignored))
             
-    anchors = config.default_anchors
-    seg_labels, seg_locations = match_anchor_to_text_boxes_fast(anchors, xs, ys);
-    link_labels = cal_link_labels(seg_labels)
-    seg_offsets = encode_seg_offsets(seg_locations)
+    anchors = config.get_shape_config(image_shape).default_anchors
+    seg_labels, seg_locations = match_anchor_to_text_boxes_fast(anchors, xs, ys, image_shape);
+    link_labels = cal_link_labels(seg_labels, image_shape)
+    seg_offsets = encode_seg_offsets(seg_locations, image_shape)
     
     
     # deal with ignored: use -2 to denotes ignored matchings temporarily
@@ -546,18 +555,23 @@ def get_all_seglink_gt(xs, ys, ignored):
     return seg_labels, seg_offsets, link_labels
     
 
-def tf_get_all_seglink_gt(xs, ys, ignored):
+def tf_get_all_seglink_gt(xs, ys, ignored, image_shape = None):
     """
     xs, ys: tensors reprensenting ground truth bbox, both with shape=(N, 4), values in 0~1
+    image_shape: the input shape, `config.image_shape` by default. Its tables must have been built by `config.init_config`.
     """
-    h_I, w_I = config.image_shape
+    shape_config = config.get_shape_config(image_shape)
+    h_I, w_I = shape_config.image_shape
     
     xs = xs * w_I
     ys = ys * h_I    
-    seg_labels, seg_offsets, link_labels = tf.py_func(get_all_seglink_gt, [xs, ys, ignored], [tf.int32, tf.float32, tf.int32]);
-    seg_labels.set_shape([config.num_anchors])
-    seg_offsets.set_shape([config.num_anchors, 5])
-    link_labels.set_shape([config.num_links])
+    # the shape is bound here instead of being read from config in the py_func, 
+    # because pipelines of different shapes run at the same time.
+    get_gt = lambda xs, ys, ignored: get_all_seglink_gt(xs, ys, ignored, shape_config.image_shape)
+    seg_labels, seg_offsets, link_labels = tf.py_func(get_gt, [xs, ys, ignored], [tf.int32, tf.float32, tf.int32]);
+    seg_labels.set_shape([shape_config.num_anchors])
+    seg_offsets.set_shape([shape_config.num_anchors, 5])
+    link_labels.set_shape([shape_config.num_links])
     return seg_labels, seg_offsets, link_labels;
 
 ############################################################################################################
@@ -813,4 +827,63 @@ def bboxes_to_xys(bboxes, image_shape):
             points[i_xy, :] = [x, y]
         points = np.reshape(points, -1)
         xys[bbox_idx, :] = points
-    return xys
\ No newline at end of file
+    return xys
+
+
+############################################################################################################
+#                       decoding in worker processes                                                       #
+############################################################################################################
+def decode_image(seg_scores, link_scores, seg_offsets_pred, image_shape, 
+                 seg_conf_threshold, link_conf_threshold, gxs = None, gys = None, gignored = None):
+    """Decode the network outputs of one image into bboxes, and match them with ground truth if given.
+    Return:
+        bboxes, if no ground truth given, else (bboxes, num_gt_bboxes, num_tp, num_fp)
+    """
+    bboxes = seglink_to_bbox(seg_scores, link_scores, seg_offsets_pred, image_shape, 
+                             seg_conf_threshold, link_conf_threshold)
+    if gxs is None:
+        return bboxes
+    num_gt_bboxes, tp, fp = tfe_bboxes.np_bboxes_matching(bboxes, gxs, gys, gignored)
+    return bboxes, num_gt_bboxes, np.sum(tp), np.sum(fp)
+
+def _decode_image_with_key(args):
+    key, args = args
+    return key, decode_image(*args)
+
+class DecodePool(object):
+    """Run `decode_image` in a pool of worker processes, while the TF session computes the next images.
+    Results are returned in the order their images are put.
+    The pool must be created after `config.init_config`, so the forked workers have the same config.
+    If `num_workers` == 0, images are decoded synchronously in the calling process.
+    """
+    def __init__(self, num_workers, max_pending = None):
+        self.num_workers = num_workers
+        self.max_pending = max_pending or num_workers * 2
+        self.pending = collections.deque()
+        self.pool = None
+        if num_workers > 0:
+            self.pool = multiprocessing.Pool(num_workers)
+    
+    def put(self, key, *args):
+        """Put the network outputs of an image.
+        Return: the (key, decoded result) pairs that are ready, in order.
+        """
+        if self.pool is None:
+            return [_decode_image_with_key((key, args))]
+        self.pending.append(self.pool.apply_async(_decode_image_with_key, [(key, args)]))
+        results = []
+        while len(self.pending) > self.max_pending or (len(self.pending) > 0 and self.pending[0].ready()):
+            results.append(self.pending.popleft().get())
+        return results
+    
+    def flush(self):
+        """Wait for all pending images and return their results in order.
+        """
+        results = [result.get() for result in self.pending]
+        self.pending.clear()
+        return results
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
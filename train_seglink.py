@@ -6,10 +6,11 @@ from tensorflow.python.ops import control_flow_ops
 
 from datasets import dataset_factory
 from preprocessing import ssd_vgg_preprocessing
-from tf_extended import seglink
+from tf_extended import seglink, metrics as tfe_metrics, bboxes as tfe_bboxes, gradients as tfe_gradients
+from tf_extended import checkpoints as tfe_checkpoints, replay as tfe_replay, moving_averages as tfe_moving_averages
 import util
 import cv2
-from nets import seglink_symbol, anchor_layer
+from nets import seglink_symbol, anchor_layer, net_factory
 
 
 slim = tf.contrib.slim
@@ -21,6 +22,16 @@ tf.app.flags.DEFINE_bool('train_with_ignored', False,
                            'whether to use ignored bbox (in ic15) in training.')
 tf.app.flags.DEFINE_float('seg_loc_loss_weight', 1.0, 'the loss weight of segment localization')
 tf.app.flags.DEFINE_float('link_cls_loss_weight', 1.0, 'the loss weight of linkage classification loss')
+tf.app.flags.DEFINE_string('link_ohnm_method', 'exact', 
+   'the method of hard negative mining on links. `exact` sorts all negative links; \
+   `histogram` picks the threshold from a fixed-bin histogram of negative scores, \
+   selecting slightly more negatives than the exact one, and reports the ratio in summary `link_ohnm_neg_ratio`.')
+tf.app.flags.DEFINE_integer('ohnm_num_bins', 1000, 'the number of histogram bins used by the `histogram` OHNM.')
+tf.app.flags.DEFINE_bool('sparse_link_loss', False, 
+   'whether to compute the link classification loss only on links touching a positive or hard negative segment, \
+   plus randomly sampled ones. The exact OHNM is done on the gathered links, so it requires `link_ohnm_method` exact.')
+tf.app.flags.DEFINE_float('link_neg_sample_rate', 0.01, 
+   'the fraction of the other links sampled into the sparse link loss.')
 
 tf.app.flags.DEFINE_string('train_dir', None, 
                            'the path to store checkpoints and eventfiles for summaries')
@@ -32,9 +43,31 @@ tf.app.flags.DEFINE_float('gpu_memory_fraction', -1,
                           'the gpu memory fraction to be used. If less than 0, allow_growth = True is used.')
 
 tf.app.flags.DEFINE_integer('batch_size', None, 'The number of samples in each batch.')
+tf.app.flags.DEFINE_string('recompute_blocks', None, 
+    'comma-separated vgg blocks, e.g., `conv1,conv2,conv3`, whose inner activations are recomputed \
+    in the backward pass instead of being kept in memory. Valid blocks: conv1, conv2, conv3, conv4, conv5, fc.')
+tf.app.flags.DEFINE_string('frozen_blocks', None, 
+    'comma-separated vgg blocks, e.g., `conv1,conv2`, that are not updated, e.g., when fine-tuning. \
+    Neither their gradients nor optimizer slots are created.')
+tf.app.flags.DEFINE_bool('use_xla_jit', False, 
+    'whether to compile the seglink layers and the loss with XLA JIT. Unsupported ops, e.g., py_func and summaries, \
+    are left out of the compiled clusters. See test/benchmark_jit.py for the effect on step time.')
 tf.app.flags.DEFINE_integer('num_gpus', 1, 'The number of gpus can be used.')
 tf.app.flags.DEFINE_integer('max_number_of_steps', 1000000, 'The maximum number of training steps.')
 tf.app.flags.DEFINE_integer('log_every_n_steps', 1, 'log frequency')
+tf.app.flags.DEFINE_integer('async_checkpoint_every_n_steps', 0, 
+    'If larger than 0, checkpoints are saved every this number of steps in a background thread, \
+    and pruned by the following retention policies. Otherwise, they are saved every 20 minutes by the supervisor.')
+tf.app.flags.DEFINE_integer('keep_last_n_checkpoints', 5, 'keep the latest n asynchronous checkpoints.')
+tf.app.flags.DEFINE_integer('keep_checkpoint_every_n', 0, 'keep every n-th asynchronous checkpoint, 0 to disable.')
+tf.app.flags.DEFINE_integer('keep_best_n_checkpoints', 0, 
+    'keep the n asynchronous checkpoints with the highest F-mean of in-process evaluation, see `eval_every_n_steps`. \
+    It is better to be a multiple of `async_checkpoint_every_n_steps`.')
+tf.app.flags.DEFINE_integer('variable_summary_every_n_steps', 100, 
+    'the frequency of the scalar summaries of every variable and its gradient. 0 to disable them. \
+    Losses and other cheap summaries are written every 60 seconds.')
+tf.app.flags.DEFINE_integer('histogram_summary_every_n_steps', 1000, 
+    'the frequency of the histograms of variables, gradients, segment scores and link scores. 0 to disable them.')
 tf.app.flags.DEFINE_bool("ignore_missing_vars", True, '')
 tf.app.flags.DEFINE_string('checkpoint_exclude_scopes', None, 'checkpoint_exclude_scopes')
 
@@ -42,10 +75,41 @@ tf.app.flags.DEFINE_string('checkpoint_exclude_scopes', None, 'checkpoint_exclud
 # Optimizer configs.
 # =========================================================================== #
 tf.app.flags.DEFINE_float('learning_rate', 0.001, 'learning rate.')
+tf.app.flags.DEFINE_string('learning_rate_decay_type', 'constant', 
+    'the schedule of the learning rate after warmup: `constant`, `step` or `cosine`. \
+    It is computed from the global step, so it is resumed from checkpoints.')
+tf.app.flags.DEFINE_string('learning_rate_decay_steps', None, 
+    'comma-separated global steps at which the `step` learning rate is multiplied by `learning_rate_decay_factor`.')
+tf.app.flags.DEFINE_float('learning_rate_decay_factor', 0.1, 'the decay factor of the `step` learning rate.')
+tf.app.flags.DEFINE_float('end_learning_rate_ratio', 0.0, 
+    'the ratio of the `cosine` learning rate at `max_number_of_steps` to the peak one.')
+tf.app.flags.DEFINE_integer('warmup_steps', 0, 
+    'the number of steps over which the learning rate grows linearly from `warmup_init_ratio` of the peak one to it.')
+tf.app.flags.DEFINE_float('warmup_init_ratio', 0.0, 'the ratio of the learning rate at step 0 to the peak one when warming up.')
+tf.app.flags.DEFINE_integer('base_batch_size', 0, 
+    'If larger than 0, the learning rate is scaled linearly by the global batch size, i.e., \
+    batch_size * num_accumulation_steps, over `base_batch_size`, the batch size at which `learning_rate` is tuned.')
 tf.app.flags.DEFINE_float('momentum', 0.9, 'The momentum for the MomentumOptimizer')
 tf.app.flags.DEFINE_float('weight_decay', 0.0005, 'The weight decay on the model weights.')
 tf.app.flags.DEFINE_bool('using_moving_average', False, 'Whether to use ExponentionalMovingAverage')
 tf.app.flags.DEFINE_float('moving_average_decay', 0.9999, 'The decay rate of ExponentionalMovingAverage')
+tf.app.flags.DEFINE_integer('moving_average_every_n_steps', 1, 
+    'If larger than 1, the moving averages are updated every this number of steps instead of every step, \
+    with the decay `moving_average_decay ** moving_average_every_n_steps`, so they cover about the same number of steps.')
+tf.app.flags.DEFINE_bool('moving_average_on_cpu', False, 
+    'Whether to keep the moving averages on cpu, saving gpu memory at the cost of copying the variables when updated.')
+tf.app.flags.DEFINE_string('compute_dtype', 'float32', 
+    'the dtype of convolutions, float32 or float16. The master weights and the loss are kept in float32. \
+    Dynamic loss scaling is used with float16, and steps with overflowed gradients are skipped.')
+tf.app.flags.DEFINE_float('init_loss_scale', 2 ** 15, 'the initial loss scale of float16 training.')
+tf.app.flags.DEFINE_integer('loss_scale_incr_every_n_steps', 1000, 
+    'the loss scale is doubled after this number of steps without overflow, and halved after 2 overflowed steps in a row.')
+tf.app.flags.DEFINE_float('gradient_bucket_mb', 0, 
+    'If larger than 0 and there are multiple clones, the gradients of all clones are packed into flat buckets \
+    of about this size in MB and summed bucket by bucket, instead of one add_n for each variable.')
+tf.app.flags.DEFINE_integer('num_accumulation_steps', 1, 
+    'The number of batches whose gradients are accumulated before being applied, \
+    i.e., the effective batch size is batch_size * num_accumulation_steps. A global step is counted per update.')
 
 # =========================================================================== #
 # I/O and preprocessing Flags.
@@ -56,30 +120,103 @@ tf.app.flags.DEFINE_integer(
 tf.app.flags.DEFINE_integer(
     'num_preprocessing_threads', 1,
     'The number of threads used to create the batches.')
+tf.app.flags.DEFINE_bool('use_tf_data', False, 
+    'Whether to build the input pipeline with the tf.data API instead of queue runners. \
+    If True, `num_readers` is the number of interleaved TFRecord files, and `num_preprocessing_threads` \
+    is the number of parallel calls of decoding, preprocessing and ground truth calculation.')
+tf.app.flags.DEFINE_integer('min_pos_segments', 0, 
+    'training samples with fewer positive segments after cropping are dropped before batching, \
+    so that every sample in a batch contributes gradients. The dropped ones are counted in summaries `input/*`.')
+tf.app.flags.DEFINE_integer('shuffle_buffer_size', 1000, 'The size of the shuffle buffer of the tf.data pipeline.')
+tf.app.flags.DEFINE_integer('replay_buffer_size', 0, 
+    'If larger than 0, the tf.data pipeline keeps this number of training records with the highest losses, \
+    keyed by the hash of `image/filename`, and replays them in place of a fraction `replay_ratio` of the incoming ones. \
+    Each image shape has its own input pipeline and buffer, while all aspect ratio buckets share a single one.')
+tf.app.flags.DEFINE_float('replay_ratio', 0.25, 'The fraction of training records replayed from the replay buffer.')
+tf.app.flags.DEFINE_integer('prefetch_buffer_size', 4, 'The number of batches prefetched by the tf.data pipeline.')
+tf.app.flags.DEFINE_integer('benchmark_input_steps', 0, 
+    'If larger than 0, only measure the throughput of the input pipeline for this number of batches and exit. \
+    Use it to tune the capacities of the input pipeline.')
 
 # =========================================================================== #
 # Dataset Flags.
 # =========================================================================== #
 tf.app.flags.DEFINE_string(
-    'dataset_name', None, 'The name of the dataset to load.')
+    'dataset_name', None, 'The name of the dataset to load. \
+    Comma-separated names of several datasets are mixed by `dataset_weights`, which requires `use_tf_data`.')
 tf.app.flags.DEFINE_string(
     'dataset_split_name', 'train', 'The name of the train/test split.')
 tf.app.flags.DEFINE_string(
-    'dataset_dir', None, 'The directory where the dataset files are stored.')
+    'dataset_dir', None, 'The directory where the dataset files are stored. \
+    Comma-separated, one for each of `dataset_name`, or a single one shared by all of them.')
+tf.app.flags.DEFINE_string('dataset_weights', None, 
+    'Comma-separated sampling weights of the datasets in `dataset_name`. \
+    By default, proportional to their numbers of samples, as if they were concatenated.')
 tf.app.flags.DEFINE_string(
     'model_name', 'seglink_vgg', 'The name of the architecture to train.')
 tf.app.flags.DEFINE_integer('train_image_width', 512, 'Train image size')
 tf.app.flags.DEFINE_integer('train_image_height', 512, 'Train image size')
+tf.app.flags.DEFINE_string('train_image_shapes', None, 
+   'extra image shapes for multi-scale training, comma-separated `HxW`, e.g., `384x384,768x768`. \
+   Each of them has its own input pipeline, and the shape of each step is picked at random among them and the default one.')
+tf.app.flags.DEFINE_string('aspect_ratio_buckets', None, 
+   'image shapes of aspect ratio buckets, comma-separated `HxW`, e.g., `384x768,512x512,768x384`. Requires `use_tf_data`. \
+   Every training image goes to the bucket with the closest aspect ratio, and is cropped and resized to its shape, \
+   so batches are built within a bucket, with little aspect distortion. Every bucket must match some training images. \
+   The images are grouped by bucket in a single input pipeline, and each batch is trained by the train op of its bucket, \
+   so every bucket is trained on by its share of images. \
+   The default shape `train_image_height`x`train_image_width` is still used by the evaluation tower.')
+
+# =========================================================================== #
+# In-process evaluation Flags.
+# =========================================================================== #
+tf.app.flags.DEFINE_integer('eval_every_n_steps', 0, 
+   'If larger than 0, an evaluation tower sharing weights with the trainer is added to the training graph, \
+   and a snapshot of the weights is evaluated on a fixed held-out subset every `eval_every_n_steps` steps in a side thread.')
+tf.app.flags.DEFINE_string('eval_dataset_name', None, 
+   'the dataset used for in-process evaluation. `dataset_name` is used if not set.')
+tf.app.flags.DEFINE_string('eval_dataset_split_name', 'test', 'the split used for in-process evaluation.')
+tf.app.flags.DEFINE_string('eval_dataset_dir', None, 
+   'the directory of the dataset used for in-process evaluation. `dataset_dir` is used if not set.')
+tf.app.flags.DEFINE_integer('eval_num_images', 100, 
+   'the number of held-out images, the first ones of the evaluation split, evaluated every time.')
+tf.app.flags.DEFINE_float('eval_seg_conf_threshold', 0.9, 'the segment threshold used in in-process evaluation')
+tf.app.flags.DEFINE_float('eval_link_conf_threshold', 0.7, 'the link threshold used in in-process evaluation')
 
 
 FLAGS = tf.app.flags.FLAGS
 
+def check_tf_version(min_version = '1.14'):
+    """Raise a clear error if any option used needs a more recent tensorflow than the installed one, 
+    e.g., tf.data with parallel_interleave and prefetch_to_device, recompute_grad, mixed precision or cosine_decay.
+    """
+    from distutils.version import LooseVersion
+    if LooseVersion(tf.__version__) >= LooseVersion(min_version):
+        return
+    options = [('--use_tf_data', FLAGS.use_tf_data), 
+               ('--recompute_blocks', FLAGS.recompute_blocks), 
+               ('--compute_dtype=%s'%(FLAGS.compute_dtype), FLAGS.compute_dtype != 'float32'), 
+               ('--learning_rate_decay_type=cosine', FLAGS.learning_rate_decay_type == 'cosine')]
+    used = [name for name, is_used in options if is_used]
+    if used:
+        raise ValueError('%s requires tensorflow >= %s, but %s is installed'%(', '.join(used), min_version, tf.__version__))
+
 def config_initialization():
     # image shape and feature layers shape inference
     image_shape = (FLAGS.train_image_height, FLAGS.train_image_width)
+    extra_image_shapes = get_extra_image_shapes()
     
     if not FLAGS.dataset_dir:
         raise ValueError('You must supply the dataset directory with --dataset_dir')
+    if len(get_dataset_names()) > 1 and not FLAGS.use_tf_data:
+        raise ValueError('mixing several datasets requires --use_tf_data')
+    if FLAGS.replay_buffer_size > 0 and not FLAGS.use_tf_data:
+        raise ValueError('--replay_buffer_size requires --use_tf_data')
+    if FLAGS.aspect_ratio_buckets and not FLAGS.use_tf_data:
+        raise ValueError('--aspect_ratio_buckets requires --use_tf_data')
+    if FLAGS.aspect_ratio_buckets and FLAGS.train_image_shapes:
+        raise ValueError('--aspect_ratio_buckets and --train_image_shapes can not be used together')
+    check_tf_version()
     tf.logging.set_verbosity(tf.logging.DEBUG)
     util.init_logger(log_file = 'log_train_seglink_%d_%d.log'%image_shape, log_path = FLAGS.train_dir, stdout = False, mode = 'a')
     
@@ -91,23 +228,149 @@ def config_initialization():
                        train_with_ignored = FLAGS.train_with_ignored,
                        seg_loc_loss_weight = FLAGS.seg_loc_loss_weight, 
                        link_cls_loss_weight = FLAGS.link_cls_loss_weight, 
+                       link_ohnm_method = FLAGS.link_ohnm_method,
+                       ohnm_num_bins = FLAGS.ohnm_num_bins,
+                       sparse_link_loss = FLAGS.sparse_link_loss,
+                       link_neg_sample_rate = FLAGS.link_neg_sample_rate,
+                       basenet_recompute_blocks = FLAGS.recompute_blocks.split(',') if FLAGS.recompute_blocks else None,
+                       basenet_frozen_blocks = FLAGS.frozen_blocks.split(',') if FLAGS.frozen_blocks else None,
+                       xla_jit = FLAGS.use_xla_jit,
+                       compute_dtype = FLAGS.compute_dtype,
+                       extra_image_shapes = extra_image_shapes
                        )
 
     batch_size = config.batch_size
     batch_size_per_gpu = config.batch_size_per_gpu
         
     tf.summary.scalar('batch_size', batch_size)
+    if FLAGS.num_accumulation_steps > 1:
+        tf.logging.info('accumulating gradients over %d batches, the effective batch size is %d'%(
+                                FLAGS.num_accumulation_steps, batch_size * FLAGS.num_accumulation_steps))
     tf.summary.scalar('batch_size_per_gpu', batch_size_per_gpu)
 
-    util.proc.set_proc_name(FLAGS.model_name + '_' + FLAGS.dataset_name)
+    util.proc.set_proc_name(FLAGS.model_name + '_' + get_dataset_scope_name())
     
-    dataset = dataset_factory.get_dataset(FLAGS.dataset_name, FLAGS.dataset_split_name, FLAGS.dataset_dir)
+    dataset_names = get_dataset_names()
+    if len(dataset_names) > 1:
+        dataset_dirs = FLAGS.dataset_dir.split(',')
+        if len(dataset_dirs) == 1:
+            dataset_dirs = dataset_dirs * len(dataset_names)
+        weights = [float(w) for w in FLAGS.dataset_weights.split(',')] if FLAGS.dataset_weights else None
+        dataset = dataset_factory.get_multi_dataset(dataset_names, FLAGS.dataset_split_name, dataset_dirs, weights)
+        tf.logging.info('mixing datasets %s with weights %s'%(dataset.names, dataset.weights))
+    else:
+        dataset = dataset_factory.get_dataset(FLAGS.dataset_name, FLAGS.dataset_split_name, FLAGS.dataset_dir)
     config.print_config(FLAGS, dataset)
     return dataset
 
-def create_dataset_batch_queue(dataset):
+def get_dataset_names():
+    return FLAGS.dataset_name.split(',') if FLAGS.dataset_name else []
+
+def get_dataset_scope_name():
+    """The name of the training datasets, to be used in op names."""
+    return '_'.join(get_dataset_names())
+
+def parse_image_shapes(shapes_str):
+    """Parse comma-separated `HxW` into a list of distinct (height, width) tuples."""
+    shapes = []
+    if not shapes_str:
+        return shapes
+    for shape in shapes_str.split(','):
+        h, w = shape.strip().lower().split('x')
+        shape = (int(h), int(w))
+        if shape not in shapes:
+            shapes.append(shape)
+    return shapes
+
+def get_aspect_ratio_buckets():
+    """The shapes of aspect ratio buckets, sorted by aspect ratio, i.e., width / height."""
+    return sorted(parse_image_shapes(FLAGS.aspect_ratio_buckets), key = lambda shape: shape[1] * 1.0 / shape[0])
+
+def get_train_image_shapes():
+    """The image shapes of training steps."""
+    default_shape = (FLAGS.train_image_height, FLAGS.train_image_width)
+    if FLAGS.aspect_ratio_buckets:
+        return get_aspect_ratio_buckets()
+    return [default_shape] + [shape for shape in parse_image_shapes(FLAGS.train_image_shapes) if shape != default_shape]
+
+def get_extra_image_shapes():
+    """The image shapes whose anchor and link tables are built besides the default one."""
+    default_shape = (FLAGS.train_image_height, FLAGS.train_image_width)
+    return [shape for shape in get_train_image_shapes() if shape != default_shape]
+
+def get_bucket_aspect_ratio_ranges(buckets):
+    """
+    Args:
+        buckets: the shapes of aspect ratio buckets, sorted by aspect ratio.
+    Return:
+        a list of (image_range, crop_range) pairs, one for each bucket. An image goes to the bucket whose `image_range` 
+        contains its aspect ratio, and the aspect ratio of its random crop is sampled from `crop_range`.
+        The boundaries between neighbouring buckets are the geometric means of their aspect ratios, 
+        and the outer crop bounds of the first and last buckets are as wide as the ones of unbucketed training.
+    """
+    aspect_ratios = [w * 1.0 / h for h, w in buckets]
+    boundaries = [np.sqrt(a * b) for a, b in zip(aspect_ratios[:-1], aspect_ratios[1:])]
+    lower = [0.] + boundaries
+    upper = boundaries + [np.inf]
+    ranges = []
+    for idx, aspect_ratio in enumerate(aspect_ratios):
+        min_crop, max_crop = ssd_vgg_preprocessing.CROP_ASPECT_RATIO_RANGE
+        crop_range = (max(lower[idx], aspect_ratio * min_crop), min(upper[idx], aspect_ratio * max_crop))
+        ranges.append(((lower[idx], upper[idx]), crop_range))
+    return ranges
+
+def create_local_counter(name):
+    """A local int64 counter on cpu. It is a resource variable, so that it can be updated inside tf.data functions."""
     with tf.device('/cpu:0'):
-        with tf.name_scope(FLAGS.dataset_name + '_data_provider'):
+        return tf.get_variable(name, shape = [], dtype = tf.int64, initializer = tf.zeros_initializer(), 
+                               trainable = False, collections = [tf.GraphKeys.LOCAL_VARIABLES], use_resource = True)
+
+def create_sample_counters():
+    """Local counters of the training samples produced by the input pipeline, 
+    and of the ones rejected for having too few positive segments.
+    They are resource variables, so that they can be updated inside tf.data functions.
+    They are created only once, and shared by the input pipelines of all image shapes.
+    """
+    counters = tf.get_collection('sample_counters')
+    if counters:
+        return tuple(counters)
+    num_samples = create_local_counter('num_input_samples')
+    num_rejected = create_local_counter('num_rejected_samples')
+    tf.add_to_collection('sample_counters', num_samples)
+    tf.add_to_collection('sample_counters', num_rejected)
+    tf.summary.scalar('input/num_rejected_samples', num_rejected.read_value())
+    tf.summary.scalar('input/rejected_sample_ratio', 
+                      tf.cast(num_rejected.read_value(), tf.float32) / tf.cast(tf.maximum(num_samples.read_value(), 1), tf.float32))
+    return num_samples, num_rejected
+
+def keep_sample(seg_label, counters):
+    """Whether a training sample has at least `FLAGS.min_pos_segments` positive segments. The counters are updated."""
+    num_samples, num_rejected = counters
+    if config.train_with_ignored:
+        pos_mask = seg_label >= 0
+    else:
+        pos_mask = tf.equal(seg_label, 1)
+    keep = tf.reduce_sum(tf.cast(pos_mask, tf.int32)) >= FLAGS.min_pos_segments
+    update_ops = [tf.assign_add(num_samples, 1), 
+                  tf.assign_add(num_rejected, 1 - tf.cast(keep, tf.int64))]
+    with tf.control_dependencies(update_ops):
+        return tf.identity(keep)
+    
+def get_pipeline_name(name, image_shape):
+    if image_shape is None or tuple(image_shape) == tuple(config.image_shape):
+        return name
+    return '%s_%dx%d'%(name, image_shape[0], image_shape[1])
+
+def get_image_key(filename):
+    """The int64 key of a training image, hashed from its filename. 
+    Unlike the filename, it can be batched and copied to gpus together with the other tensors of a sample.
+    """
+    return tf.string_to_hash_bucket_fast(filename, 2 ** 62)
+
+def create_dataset_batch_queue(dataset, image_shape = None):
+    image_shape = image_shape or config.image_shape
+    with tf.device('/cpu:0'):
+        with tf.name_scope(get_pipeline_name(get_dataset_scope_name() + '_data_provider', image_shape)):
             provider = slim.dataset_data_provider.DatasetDataProvider(
                 dataset,
                 num_readers=FLAGS.num_readers,
@@ -115,8 +378,8 @@ def create_dataset_batch_queue(dataset):
                 common_queue_min=30 * config.batch_size,
                 shuffle=True)
         # Get for SSD network: image, labels, bboxes.
-        [image, gignored, gbboxes, x1, x2, x3, x4, y1, y2, y3, y4] = provider.get([
-                                                         'image',
+        [image, filename, gignored, gbboxes, x1, x2, x3, x4, y1, y2, y3, y4] = provider.get([
+                                                         'image', 'filename',
                                                          'object/ignored',
                                                          'object/bbox', 
                                                          'object/oriented_bbox/x1',
@@ -134,110 +397,712 @@ def create_dataset_batch_queue(dataset):
         
         # Pre-processing image, labels and bboxes.
         image, gignored, gbboxes, gxs, gys = ssd_vgg_preprocessing.preprocess_image(image, gignored, gbboxes, gxs, gys, 
-                                                           out_shape = config.image_shape,
+                                                           out_shape = image_shape,
                                                            data_format = config.data_format, 
                                                            is_training = True)
         image = tf.identity(image, 'processed_image')
         
         # calculate ground truth
-        seg_label, seg_loc, link_label = seglink.tf_get_all_seglink_gt(gxs, gys, gignored)
+        seg_label, seg_loc, link_label = seglink.tf_get_all_seglink_gt(gxs, gys, gignored, image_shape)
         
         # batch them
-        b_image, b_seg_label, b_seg_loc, b_link_label = tf.train.batch(
-            [image, seg_label, seg_loc, link_label],
-            batch_size = config.batch_size_per_gpu,
-            num_threads= FLAGS.num_preprocessing_threads,
-            capacity = 50)
+        if FLAGS.min_pos_segments > 0:
+            b_image, b_seg_label, b_seg_loc, b_link_label, b_image_key = tf.train.maybe_batch(
+                [image, seg_label, seg_loc, link_label, get_image_key(filename)],
+                keep_input = keep_sample(seg_label, create_sample_counters()),
+                batch_size = config.batch_size_per_gpu,
+                num_threads= FLAGS.num_preprocessing_threads,
+                capacity = 50)
+        else:
+            b_image, b_seg_label, b_seg_loc, b_link_label, b_image_key = tf.train.batch(
+                [image, seg_label, seg_loc, link_label, get_image_key(filename)],
+                batch_size = config.batch_size_per_gpu,
+                num_threads= FLAGS.num_preprocessing_threads,
+                capacity = 50)
             
         batch_queue = slim.prefetch_queue.prefetch_queue(
-            [b_image, b_seg_label, b_seg_loc, b_link_label],
+            [b_image, b_seg_label, b_seg_loc, b_link_label, b_image_key],
             capacity = 50) 
     return batch_queue    
 
-def sum_gradients(clone_grads):                        
+class DatasetBatchQueue(object):
+    """Expose a tf.data iterator through the `dequeue` interface of the prefetch queue.
+    `replay_buffer`, if not None, is the `tfe_replay.HardExampleReplay` of the pipeline, to which the losses of its images are reported.
+    """
+    def __init__(self, iterator, replay_buffer = None):
+        self.iterator = iterator
+        self.replay_buffer = replay_buffer
+        
+    def dequeue(self):
+        return self.iterator.get_next()
+        
+def read_records(data_sources):
+    """A never ending tf.data dataset of the shuffled serialized records in `data_sources`."""
+    files = tf.data.Dataset.list_files(data_sources).shuffle(1000)
+    records = files.apply(tf.contrib.data.parallel_interleave(
+                            tf.data.TFRecordDataset, cycle_length = FLAGS.num_readers, sloppy = True))
+    return records.apply(tf.contrib.data.shuffle_and_repeat(FLAGS.shuffle_buffer_size))
+
+def read_dataset_records(dataset):
+    """The serialized training records of `dataset`, or of all datasets of a `dataset_factory.MultiDataset`, mixed by their weights."""
+    if isinstance(dataset, dataset_factory.MultiDataset):
+        # every dataset has its own readers and shuffle buffer, and never ends, 
+        # so the records are mixed by the weights all along the training.
+        return tf.contrib.data.sample_from_datasets(
+                        [read_records(d.data_sources) for d in dataset.datasets], weights = dataset.weights)
+    return read_records(dataset.data_sources)
+
+def replay_records(records, replay_buffer):
+    """Replace a fraction of `records` by the hard ones kept in `replay_buffer`."""
+    def replay(serialized):
+        filename = tf.parse_single_example(serialized, {'image/filename': tf.FixedLenFeature((), tf.string)})['image/filename']
+        record = tf.py_func(replay_buffer.sample, [get_image_key(filename), serialized], tf.string, stateful = True)
+        record.set_shape([])
+        return record
+    return records.map(replay, num_parallel_calls = FLAGS.num_preprocessing_threads)
+
+def decode_record(dataset, serialized):
+    """Decode a serialized training record into image, filename, gignored, gbboxes, gxs and gys."""
+    items = ['image', 'filename', 'object/ignored', 'object/bbox', 
+             'object/oriented_bbox/x1', 'object/oriented_bbox/x2',
+             'object/oriented_bbox/x3', 'object/oriented_bbox/x4',
+             'object/oriented_bbox/y1', 'object/oriented_bbox/y2',
+             'object/oriented_bbox/y3', 'object/oriented_bbox/y4']
+    [image, filename, gignored, gbboxes, x1, x2, x3, x4, y1, y2, y3, y4] = dataset.decoder.decode(serialized, items)
+    gxs = tf.transpose(tf.stack([x1, x2, x3, x4])) #shape = (N, 4)
+    gys = tf.transpose(tf.stack([y1, y2, y3, y4]))
+    return image, filename, gignored, gbboxes, gxs, gys
+
+def preprocess_sample(image, gignored, gbboxes, gxs, gys, image_shape, crop_aspect_ratio_range = None):
+    """Preprocess a decoded training image into `image_shape`, and calculate its ground truth.
+    Return: image, seg_label, seg_loc and link_label.
+    """
+    preprocess_kwargs = {}
+    if crop_aspect_ratio_range is not None:
+        preprocess_kwargs['crop_aspect_ratio_range'] = crop_aspect_ratio_range
+    image, gignored, gbboxes, gxs, gys = ssd_vgg_preprocessing.preprocess_image(image, gignored, gbboxes, gxs, gys, 
+                                                       out_shape = image_shape,
+                                                       data_format = config.data_format, 
+                                                       is_training = True, 
+                                                       **preprocess_kwargs)
+    seg_label, seg_loc, link_label = seglink.tf_get_all_seglink_gt(gxs, gys, gignored, image_shape)
+    return image, seg_label, seg_loc, link_label
+
+def create_dataset_batch_queue_tf_data(dataset, image_shape = None):
+    """
+    Args:
+        image_shape: the output shape of preprocessing, `config.image_shape` by default.
+    """
+    image_shape = image_shape or config.image_shape
+    batch_size = config.batch_size_per_gpu
+    
+    def decode_and_preprocess(serialized):
+        image, filename, gignored, gbboxes, gxs, gys = decode_record(dataset, serialized)
+        image, seg_label, seg_loc, link_label = preprocess_sample(image, gignored, gbboxes, gxs, gys, image_shape)
+        return image, seg_label, seg_loc, link_label, get_image_key(filename)
+    
+    def set_batch_shape(*tensors):
+        for t in tensors:
+            t.set_shape([batch_size] + t.get_shape().as_list()[1:])
+        return tensors
+        
+    pipeline_name = get_pipeline_name(get_dataset_scope_name() + '_tf_data', image_shape)
+    replay_buffer = None
+    with tf.device('/cpu:0'):
+        with tf.name_scope(pipeline_name):
+            records = read_dataset_records(dataset)
+            if FLAGS.replay_buffer_size > 0:
+                # the hard records are replayed after shuffling, so that they are spread over batches.
+                replay_buffer = tfe_replay.HardExampleReplay(FLAGS.replay_buffer_size, replay_ratio = FLAGS.replay_ratio)
+                records = replay_records(records, replay_buffer)
+            samples = records.map(decode_and_preprocess, num_parallel_calls = FLAGS.num_preprocessing_threads)
+            if FLAGS.min_pos_segments > 0:
+                counters = create_sample_counters()
+                samples = samples.filter(lambda image, seg_label, seg_loc, link_label, image_key: keep_sample(seg_label, counters))
+            # the repeated dataset never ends, so all batches are full.
+            batches = samples.batch(batch_size).map(set_batch_shape)
+            batches = batches.prefetch(FLAGS.prefetch_buffer_size)
+            if config.num_clones == 1 and 'gpu' in config.gpus[0].lower():
+                batches = batches.apply(tf.contrib.data.prefetch_to_device(config.gpus[0]))
+            
+            # one-shot iterators can not capture the py_func calculating ground truth,
+            # and the initializer is run by the local_init_op of slim.learning.train, together with table initializers.
+            iterator = batches.make_initializable_iterator()
+            tf.add_to_collection(tf.GraphKeys.TABLE_INITIALIZERS, iterator.initializer)
+    return DatasetBatchQueue(iterator, replay_buffer)
+
+class BucketBatchQueue(object):
+    """The batches of an aspect ratio bucket, held in local variables, one set for each call of `dequeue`, i.e., each clone.
+    They are filled by the load op of `create_bucket_load_op` before every run of the train ops of the bucket, 
+    so other ops reading them, e.g., summaries, do not pull any batch from the input pipeline.
+    """
+    def __init__(self, image_shape, dtypes, replay_buffer = None):
+        self.image_shape = image_shape
+        self.dtypes = dtypes
+        self.replay_buffer = replay_buffer
+        self.clone_batches = []
+    
+    def get_sample_shapes(self):
+        """The static shapes of image, seg_label, seg_loc, link_label and image_key of a sample."""
+        h, w = self.image_shape
+        image_shape = [3, h, w] if config.data_format == 'NCHW' else [h, w, 3]
+        shape_config = config.get_shape_config(self.image_shape)
+        return [image_shape, [shape_config.num_anchors], [shape_config.num_anchors, 5], [shape_config.num_links], []]
+        
+    def dequeue(self):
+        """Create the batch variables of a clone, on the current device."""
+        batch = []
+        for idx, (dtype, shape) in enumerate(zip(self.dtypes, self.get_sample_shapes())):
+            batch.append(tf.Variable(tf.zeros([config.batch_size_per_gpu] + shape, dtype = dtype), trainable = False, 
+                                     collections = [tf.GraphKeys.LOCAL_VARIABLES], name = 'bucket_batch_%d'%(idx)))
+        self.clone_batches.append(batch)
+        return [var.value() for var in batch]
+
+def create_bucket_pipeline(dataset, image_shapes, bucket_ranges):
+    """The tf.data pipeline of aspect ratio bucketed training.
+    The records are read once, and every image is preprocessed into the shape of its bucket. 
+    group_by_window then gathers the samples of each bucket into groups of `batch_size_per_gpu * num_clones`, 
+    i.e., one batch for each clone. The pipeline is pulled by the load op only, so it is throttled by training, 
+    and no image is dropped.
+    Args:
+        bucket_ranges: the (image_range, crop_range) pairs of the buckets, see `get_bucket_aspect_ratio_ranges`.
+    Return:
+        next_group: the tensors of the next group, led by the bucket index of every sample.
+        batch_queues: a `BucketBatchQueue` for each bucket.
+    """
+    group_size = config.batch_size_per_gpu * config.num_clones
+    # the ranges are consecutive, so the bucket of an image is the number of upper bounds not larger than its aspect ratio.
+    upper_bounds = [image_range[1] for image_range, _ in bucket_ranges[:-1]]
+    
+    def decode_and_preprocess(serialized):
+        image, filename, gignored, gbboxes, gxs, gys = decode_record(dataset, serialized)
+        shape = tf.shape(image)
+        aspect_ratio = tf.cast(shape[1], tf.float32) / tf.cast(shape[0], tf.float32)
+        bucket = tf.reduce_sum(tf.cast(aspect_ratio >= tf.constant(upper_bounds, dtype = tf.float32), tf.int32))
+        branches = []
+        for bucket_idx, (image_shape, (_, crop_range)) in enumerate(zip(image_shapes, bucket_ranges)):
+            preprocess_fn = lambda image_shape = image_shape, crop_range = crop_range: preprocess_sample(
+                                    image, gignored, gbboxes, gxs, gys, image_shape, crop_range)
+            branches.append((tf.equal(bucket, bucket_idx), preprocess_fn))
+        image, seg_label, seg_loc, link_label = tf.case(branches, exclusive = True)
+        return bucket, image, seg_label, seg_loc, link_label, get_image_key(filename)
+    
+    replay_buffer = None
+    with tf.device('/cpu:0'):
+        with tf.name_scope(get_dataset_scope_name() + '_buckets'):
+            # done after mixing, so that every dataset contributes to a bucket by its share of images in the bucket.
+            records = read_dataset_records(dataset)
+            if FLAGS.replay_buffer_size > 0:
+                # one buffer for all buckets, which replays a hard image into the bucket of its own aspect ratio.
+                replay_buffer = tfe_replay.HardExampleReplay(FLAGS.replay_buffer_size, replay_ratio = FLAGS.replay_ratio)
+                records = replay_records(records, replay_buffer)
+            samples = records.map(decode_and_preprocess, num_parallel_calls = FLAGS.num_preprocessing_threads)
+            if FLAGS.min_pos_segments > 0:
+                counters = create_sample_counters()
+                samples = samples.filter(lambda bucket, image, seg_label, seg_loc, link_label, image_key: 
+                                                keep_sample(seg_label, counters))
+            # the repeated dataset never ends, so every group is full.
+            groups = samples.apply(tf.contrib.data.group_by_window(
+                            key_func = lambda bucket, *sample: tf.cast(bucket, tf.int64), 
+                            reduce_func = lambda key, window: window.batch(group_size), 
+                            window_size = group_size))
+            groups = groups.prefetch(FLAGS.prefetch_buffer_size)
+            iterator = groups.make_initializable_iterator()
+            tf.add_to_collection(tf.GraphKeys.TABLE_INITIALIZERS, iterator.initializer)
+            next_group = iterator.get_next()
+    dtypes = list(groups.output_types)[1:]
+    batch_queues = [BucketBatchQueue(image_shape, dtypes, replay_buffer) for image_shape in image_shapes]
+    return next_group, batch_queues
+
+def create_bucket_load_op(next_group, batch_queues):
+    """Load the next group of the bucket pipeline into the batch variables of its bucket, one batch for each clone.
+    It must be created after the clones, which create the batch variables. 
+    Return: the load op, whose value is the index of the loaded bucket.
+    """
+    batch_size = config.batch_size_per_gpu
+    bucket = next_group[0][0]
+    group = next_group[1:]
+    def load(bucket_idx):
+        assign_ops = []
+        for clone_idx, batch in enumerate(batch_queues[bucket_idx].clone_batches):
+            for var, tensor in zip(batch, group):
+                value = tf.reshape(tensor[clone_idx * batch_size: (clone_idx + 1) * batch_size], var.get_shape())
+                assign_ops.append(tf.assign(var, value))
+        with tf.control_dependencies(assign_ops):
+            return tf.constant(bucket_idx)
+    for batch_queue in batch_queues:
+        assert len(batch_queue.clone_batches) == config.num_clones
+    with tf.name_scope(get_dataset_scope_name() + '_buckets'):
+        branches = [(tf.equal(bucket, bucket_idx), lambda bucket_idx = bucket_idx: load(bucket_idx)) 
+                        for bucket_idx in xrange(len(batch_queues))]
+        return tf.case(branches, exclusive = True, name = 'load')
+
+def benchmark_input_pipeline(batch, num_steps, images_per_step):
+    """Measure the throughput of the input pipeline, in images per second.
+    Args:
+        batch: the tensors of the next batch, or group of batches, of `images_per_step` images.
+    """
+    import time
+    with tf.Session(config = tf.ConfigProto(allow_soft_placement = True)) as sess:
+        sess.run([tf.local_variables_initializer(), tf.tables_initializer()])
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess = sess, coord = coord)
+        # warm up, filling the queues or buffers.
+        for _ in xrange(min(10, num_steps)):
+            sess.run(batch)
+        start_time = time.time()
+        for step in xrange(1, num_steps + 1):
+            sess.run(batch)
+            if step % 10 == 0 or step == num_steps:
+                images_per_sec = step * images_per_step / (time.time() - start_time)
+                tf.logging.info('input pipeline: %d batches, %.2f images/sec'%(step, images_per_sec))
+        coord.request_stop()
+        coord.join(threads)
+
+def sum_gradients(clone_grads, num_accumulation_steps = 1, do_summary = True):
+    """Sum the gradients of all clones, bucket by bucket if `gradient_bucket_mb` > 0. When gradients are accumulated over several batches, 
+    the sum is divided by `num_accumulation_steps`, so that the accumulated gradient is the one of 
+    the average loss over all these batches, just like the clone losses are averaged over clones.
+    """
+    if FLAGS.gradient_bucket_mb > 0 and len(clone_grads) > 1:
+        # the gradients are assumed to be float32, i.e., 4 bytes per element.
+        bucket_size = int(FLAGS.gradient_bucket_mb * 1024 * 1024 / 4)
+        summed_grads = []
+        for grad, v in tfe_gradients.bucketed_sum(clone_grads, bucket_size = bucket_size):
+            # named after the variables like the add_n ones below, for the summary tags.
+            with tf.device(grad.device):
+                summed_grads.append((tf.identity(grad, name = v.op.name + '_summed_gradients'), v))
+    else:
+        summed_grads = []
+        for grad_and_vars in zip(*clone_grads):
+            grads = []
+            var = grad_and_vars[0][1]
+            for g, v in grad_and_vars:
+                assert v == var
+                grads.append(g)
+            grad = tf.add_n(grads, name = v.op.name + '_summed_gradients')
+            summed_grads.append((grad, v))
+    
     averaged_grads = []
-    for grad_and_vars in zip(*clone_grads):
-        grads = []
-        var = grad_and_vars[0][1]
-        for g, v in grad_and_vars:
-            assert v == var
-            grads.append(g)
-        grad = tf.add_n(grads, name = v.op.name + '_summed_gradients')
+    for grad, v in summed_grads:
+        if num_accumulation_steps > 1:
+            grad = grad / num_accumulation_steps
         averaged_grads.append((grad, v))
+        if not do_summary:
+            continue
         
-        tf.summary.histogram("variables_and_gradients_" + grad.op.name, grad)
-        tf.summary.histogram("variables_and_gradients_" + v.op.name, v)
-        tf.summary.scalar("variables_and_gradients_" + grad.op.name+'_mean/var_mean', tf.reduce_mean(grad)/tf.reduce_mean(var))
-        tf.summary.scalar("variables_and_gradients_" + v.op.name+'_mean', tf.reduce_mean(var))
+        tf.summary.histogram("variables_and_gradients_" + grad.op.name, grad, collections = [config.HISTOGRAM_SUMMARIES])
+        tf.summary.histogram("variables_and_gradients_" + v.op.name, v, collections = [config.HISTOGRAM_SUMMARIES])
+        tf.summary.scalar("variables_and_gradients_" + grad.op.name+'_mean/var_mean', tf.reduce_mean(grad)/tf.reduce_mean(v), 
+                          collections = [config.VARIABLE_SUMMARIES])
+        tf.summary.scalar("variables_and_gradients_" + v.op.name+'_mean', tf.reduce_mean(v), 
+                          collections = [config.VARIABLE_SUMMARIES])
     return averaged_grads
 
 
-def create_clones(batch_queue):        
+def get_variables_to_train():
+    """All trainable variables except the ones in the frozen blocks of the base net."""
+    basenet_type = 'vgg'
+    frozen_scopes = net_factory.get_block_scopes(basenet_type, config.basenet_frozen_blocks)
+    frozen_scopes = ['%s/%s/'%(basenet_type, scope) for scope in frozen_scopes]
+    variables_to_train = []
+    for var in tf.trainable_variables():
+        if not any([(var.op.name + '/').startswith(scope) for scope in frozen_scopes]):
+            variables_to_train.append(var)
+    return variables_to_train
+
+def configure_learning_rate(global_step):
+    """The learning rate at `global_step`, with linear scaling, warmup and decay configured by flags."""
+    learning_rate = FLAGS.learning_rate
+    if FLAGS.base_batch_size > 0:
+        global_batch_size = config.batch_size * FLAGS.num_accumulation_steps
+        learning_rate = learning_rate * global_batch_size / FLAGS.base_batch_size
+    tf.logging.info('learning rate: %f after warmup of %d steps, decayed by the `%s` schedule'%(
+                                learning_rate, FLAGS.warmup_steps, FLAGS.learning_rate_decay_type))
+    
+    if FLAGS.learning_rate_decay_type == 'constant':
+        decayed_learning_rate = tf.constant(learning_rate)
+    elif FLAGS.learning_rate_decay_type == 'step':
+        if not FLAGS.learning_rate_decay_steps:
+            raise ValueError('the `step` learning rate requires --learning_rate_decay_steps')
+        boundaries = [int(step) for step in FLAGS.learning_rate_decay_steps.split(',')]
+        values = [learning_rate * FLAGS.learning_rate_decay_factor ** idx for idx in xrange(len(boundaries) + 1)]
+        decayed_learning_rate = tf.train.piecewise_constant(global_step, boundaries, values)
+    elif FLAGS.learning_rate_decay_type == 'cosine':
+        # the cosine curve starts after warmup, and ends at `max_number_of_steps`.
+        decay_steps = max(FLAGS.max_number_of_steps - FLAGS.warmup_steps, 1)
+        decayed_learning_rate = tf.train.cosine_decay(learning_rate, 
+                                tf.maximum(global_step - FLAGS.warmup_steps, 0), decay_steps, 
+                                alpha = FLAGS.end_learning_rate_ratio)
+    else:
+        raise ValueError('learning_rate_decay_type [%s] was not recognized'%(FLAGS.learning_rate_decay_type))
+    
+    if FLAGS.warmup_steps <= 0:
+        return tf.identity(decayed_learning_rate, name = 'learning_rate')
+    step = tf.cast(global_step, tf.float32)
+    warmup_learning_rate = learning_rate * (FLAGS.warmup_init_ratio + 
+                                (1 - FLAGS.warmup_init_ratio) * step / FLAGS.warmup_steps)
+    return tf.where(global_step < FLAGS.warmup_steps, warmup_learning_rate, decayed_learning_rate, name = 'learning_rate')
+
+def create_clones(batch_queues):
+    """
+    Args:
+        batch_queues: a list of (image_shape, batch_queue) pairs, the default image shape first.
+    Return:
+        a list of (train_op, accumulate_op) pairs, one for each image shape. 
+        They share the global step, the optimizer and its slots, the gradient accumulators and the moving averages.
+    """
+    variables_to_train = get_variables_to_train()
+    if config.basenet_frozen_blocks:
+        tf.logging.info('frozen blocks: %s, %d of %d trainable variables are to be trained'%(
+                   config.basenet_frozen_blocks, len(variables_to_train), len(tf.trainable_variables())))
     with tf.device('/cpu:0'):
         global_step = slim.create_global_step()
-        learning_rate = tf.constant(FLAGS.learning_rate, name='learning_rate')
+        learning_rate = configure_learning_rate(global_step)
         tf.summary.scalar('learning_rate', learning_rate)
         optimizer = tf.train.MomentumOptimizer(learning_rate, momentum=FLAGS.momentum, name='Momentum')
-        
-    # place clones
-    seglink_loss = 0; # for summary only
-    gradients = []
-    for clone_idx, gpu in enumerate(config.gpus):
-        do_summary = clone_idx == 0 # only summary on the first clone
-        with tf.variable_scope(tf.get_variable_scope(), reuse = True):# the variables has been created in config.init_config
-            with tf.name_scope(config.clone_scopes[clone_idx]) as clone_scope:
-                with tf.device(gpu) as clone_device:
-                    b_image, b_seg_label, b_seg_loc, b_link_label = batch_queue.dequeue()
-                    net = seglink_symbol.SegLinkNet(inputs = b_image, data_format = config.data_format)
-                    
-                    # build seglink loss
-                    net.build_loss(seg_labels = b_seg_label, 
-                                   seg_offsets = b_seg_loc, 
-                                   link_labels = b_link_label,
-                                   do_summary = do_summary)
-                    
-                    
-                    # gather seglink losses
-                    losses = tf.get_collection(tf.GraphKeys.LOSSES, clone_scope)
-                    assert len(losses) ==  3  # 3 is the number of seglink losses: seg_cls, seg_loc, link_cls
-                    total_clone_loss = tf.add_n(losses) / config.num_clones
-                    seglink_loss = seglink_loss + total_clone_loss
-
-                    # gather regularization loss and add to clone_0 only
-                    if clone_idx == 0:
-                        regularization_loss = tf.add_n(tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES))
-                        total_clone_loss = total_clone_loss + regularization_loss
-                    
-                    # compute clone gradients
-                    clone_gradients = optimizer.compute_gradients(total_clone_loss)# all variables will be updated.
-                    gradients.append(clone_gradients)
-                    
-    tf.summary.scalar('seglink_loss', seglink_loss)
-    tf.summary.scalar('regularization_loss', regularization_loss)
-    
-    # add all gradients together
-    # note that the gradients do not need to be averaged, because the average operation has been done on loss.
-    averaged_gradients = sum_gradients(gradients)
-    
-    update_op = optimizer.apply_gradients(averaged_gradients, global_step=global_step)
-    
-    train_ops = [update_op]
+        if config.compute_dtype == 'float16':
+            # the loss is multiplied by the loss scale before compute_gradients, and the gradients are divided by it.
+            # if any gradient is not finite, the whole update, including the increment of global_step, is skipped.
+            loss_scale_manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+                                    init_loss_scale = FLAGS.init_loss_scale, 
+                                    incr_every_n_steps = FLAGS.loss_scale_incr_every_n_steps)
+            optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(optimizer, loss_scale_manager)
+            tf.summary.scalar('loss_scale', loss_scale_manager.get_loss_scale())
     
     # moving average
+    create_ema_op = None
     if FLAGS.using_moving_average:
         tf.logging.info('using moving average in training, \
         with decay = %f'%(FLAGS.moving_average_decay))
-        ema = tf.train.ExponentialMovingAverage(FLAGS.moving_average_decay)
-        ema_op = ema.apply(tf.trainable_variables())
-        with tf.control_dependencies([update_op]):# ema after updating
-            train_ops.append(tf.group(ema_op))
-            
-    train_op = control_flow_ops.with_dependencies(train_ops, seglink_loss, name='train_op')
-    return train_op
+        if FLAGS.moving_average_every_n_steps > 1 or FLAGS.moving_average_on_cpu:
+            tf.logging.info('updating moving averages every %d steps, on %s'%(FLAGS.moving_average_every_n_steps, 
+                                'cpu' if FLAGS.moving_average_on_cpu else 'the devices of the variables'))
+            moving_averages = tfe_moving_averages.SparseMovingAverage(FLAGS.moving_average_decay, 
+                                every_n_steps = FLAGS.moving_average_every_n_steps, 
+                                device = '/cpu:0' if FLAGS.moving_average_on_cpu else None)
+            moving_averages.apply(tf.trainable_variables())
+            # the update ops are created for every train op, reading the global step after its update.
+            create_ema_op = lambda: moving_averages.update(global_step)
+        else:
+            ema = tf.train.ExponentialMovingAverage(FLAGS.moving_average_decay)
+            ema_update_op = ema.apply(tf.trainable_variables())
+            create_ema_op = lambda: tf.group(ema_update_op)
+    
+    accumulators = {}
+    shape_train_ops = []
+    for shape_idx, (image_shape, batch_queue) in enumerate(batch_queues):
+        # summaries are added for the default shape only, or running the summary op would pull batches from all pipelines.
+        do_shape_summary = shape_idx == 0
+        if shape_idx > 0:
+            tf.logging.info('building the clones of image shape %dx%d'%(image_shape[0], image_shape[1]))
+        
+        # place clones
+        seglink_loss = 0; # for summary only
+        gradients = []
+        image_keys = []
+        image_losses = []
+        for clone_idx, gpu in enumerate(config.gpus):
+            do_summary = do_shape_summary and clone_idx == 0 # only summary on the first clone
+            clone_scope_name = get_pipeline_name(config.clone_scopes[clone_idx], image_shape)
+            with tf.variable_scope(tf.get_variable_scope(), reuse = True):# the variables has been created in config.init_config
+                with tf.name_scope(clone_scope_name) as clone_scope:
+                    with tf.device(gpu) as clone_device:
+                        b_image, b_seg_label, b_seg_loc, b_link_label, b_image_key = batch_queue.dequeue()
+                        net = seglink_symbol.SegLinkNet(inputs = b_image, data_format = config.data_format, 
+                                                        do_summary = do_summary)
+                        
+                        # build seglink loss
+                        net.build_loss(seg_labels = b_seg_label, 
+                                       seg_offsets = b_seg_loc, 
+                                       link_labels = b_link_label,
+                                       do_summary = do_summary)
+                        image_keys.append(b_image_key)
+                        image_losses.append(net.image_losses)
+                        
+                        # gather seglink losses
+                        losses = tf.get_collection(tf.GraphKeys.LOSSES, clone_scope)
+                        assert len(losses) ==  3  # 3 is the number of seglink losses: seg_cls, seg_loc, link_cls
+                        total_clone_loss = tf.add_n(losses) / config.num_clones
+                        seglink_loss = seglink_loss + total_clone_loss
+    
+                        # gather regularization loss and add to clone_0 only
+                        if clone_idx == 0:
+                            regularization_loss = tf.add_n(tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES))
+                            total_clone_loss = total_clone_loss + regularization_loss
+                        
+                        # compute clone gradients
+                        # the variables in frozen blocks are excluded, so neither their gradients nor their optimizer slots are created.
+                        clone_gradients = optimizer.compute_gradients(total_clone_loss, var_list = variables_to_train)
+                        gradients.append(clone_gradients)
+        
+        if do_shape_summary:
+            tf.summary.scalar('seglink_loss', seglink_loss)
+            tf.summary.scalar('regularization_loss', regularization_loss)
+        
+        # add all gradients together
+        # note that the gradients do not need to be averaged over clones, because the average operation has been done on loss.
+        averaged_gradients = sum_gradients(gradients, FLAGS.num_accumulation_steps, do_summary = do_shape_summary)
+        
+        accumulate_op = None
+        if FLAGS.num_accumulation_steps > 1:
+            averaged_gradients, accumulate_op, reset_op = accumulate_gradients(averaged_gradients, accumulators)
+        
+        # the slots of the optimizer are created by the first call of apply_gradients, and reused by the others.
+        update_op = optimizer.apply_gradients(averaged_gradients, global_step=global_step)
+        
+        train_ops = [update_op]
+        if accumulate_op is not None:
+            with tf.control_dependencies([update_op]):
+                train_ops.append(reset_op)
+        
+        if create_ema_op is not None:
+            with tf.control_dependencies([update_op]):# ema after updating
+                train_ops.append(create_ema_op())
+        
+        replay_buffer = getattr(batch_queue, 'replay_buffer', None)
+        if replay_buffer is not None:
+            with tf.device('/cpu:0'):
+                # the losses are computed in the forward pass of this step, so they are not delayed by any update.
+                report_op = tf.py_func(replay_buffer.report, 
+                        [tf.concat(image_keys, axis = 0), tf.concat(image_losses, axis = 0)], tf.int32, stateful = True)
+                train_ops.append(report_op)
+                # the accumulated batches report their losses too, or their hard images would never be replayed.
+                if accumulate_op is not None:
+                    accumulate_op = tf.group(accumulate_op, report_op)
+                if do_shape_summary:
+                    tf.summary.scalar('input/replay_buffer_mean_loss', 
+                        tf.py_func(replay_buffer.mean_loss, [], tf.float32, stateful = True))
+                
+        train_op = control_flow_ops.with_dependencies(train_ops, seglink_loss, name='train_op')
+        shape_train_ops.append((train_op, accumulate_op))
+    return shape_train_ops
+
+def accumulate_gradients(grads_and_vars, accumulators = None):
+    """Create an accumulator for each gradient. 
+    If `accumulators` is given, a dict from variables to their accumulators, the existing ones are reused, and the new ones are added to it.
+    Return:
+        grads_and_vars: the accumulated gradients plus the gradients of the current batch, to be applied.
+        accumulate_op: add the gradients of the current batch into the accumulators, without updating any variable.
+        reset_op: zero the accumulators. It must be run after the accumulated gradients have been applied.
+    """
+    accumulated_grads_and_vars = []
+    accumulate_ops = []
+    reset_ops = []
+    with tf.name_scope('gradient_accumulation'):
+        for grad, var in grads_and_vars:
+            if accumulators is not None and var in accumulators:
+                accumulator = accumulators[var]
+            else:
+                with tf.device(var.device):
+                    # local variables are initialized by slim.learning.train, but not saved into checkpoints.
+                    accumulator = tf.Variable(tf.zeros(var.get_shape(), dtype = var.dtype.base_dtype), 
+                                              trainable = False, collections = [tf.GraphKeys.LOCAL_VARIABLES], 
+                                              name = var.op.name + '_accumulator')
+                if accumulators is not None:
+                    accumulators[var] = accumulator
+            with tf.device(var.device):
+                accumulate_ops.append(tf.assign_add(accumulator, grad))
+                accumulated_grads_and_vars.append((accumulator + grad, var))
+                reset_ops.append(tf.assign(accumulator, tf.zeros_like(accumulator)))
+    return accumulated_grads_and_vars, tf.group(*accumulate_ops), tf.group(*reset_ops)
+
+def read_held_out_records(dataset, num_images):
+    """The serialized examples of the first `num_images` images in `dataset`, read once into memory, 
+    so that every in-process evaluation runs on the same images.
+    """
+    from tensorflow.contrib.slim.python.slim.data import parallel_reader
+    records = []
+    for path in sorted(parallel_reader.get_data_files(dataset.data_sources)):
+        for serialized in tf.python_io.tf_record_iterator(path):
+            if len(records) >= num_images:
+                return records
+            records.append(serialized)
+    return records
 
+def create_snapshot_getter(snapshots):
+    """A custom getter returning, instead of each variable, a local variable holding a snapshot of it.
+    `snapshots` is a dict from the variables to their snapshots, filled by the getter.
+    """
+    def snapshot_getter(getter, name, *args, **kwargs):
+        var = getter(name, *args, **kwargs)
+        if var not in snapshots:
+            # local variables are initialized by slim.learning.train, but not saved into checkpoints.
+            with tf.name_scope(None):
+                snapshots[var] = tf.Variable(tf.zeros(var.get_shape(), dtype = var.dtype.base_dtype), 
+                                             trainable = False, collections = [tf.GraphKeys.LOCAL_VARIABLES], 
+                                             name = 'eval_snapshot/' + name)
+        return snapshots[var]
+    return snapshot_getter
+
+def create_eval_tower():
+    """Build an evaluation tower with the weights of the training clones, on a fixed set of held-out images.
+    The tower reads a snapshot of the weights, taken by `snapshot_op`, so that training can go on 
+    while an evaluation is running.
+    Return:
+        serialized: the placeholder of the serialized example of one held-out image.
+        records: the serialized examples of the held-out images.
+        eval_tensors: the number of ground truth bboxes, true positives and false positives on the image.
+        snapshot_op: copy the current weights into the snapshot.
+    """
+    # the first one of the mixed training datasets by default
+    eval_dataset_name = FLAGS.eval_dataset_name or get_dataset_names()[0]
+    eval_dataset_dir = FLAGS.eval_dataset_dir or FLAGS.dataset_dir.split(',')[0]
+    dataset = dataset_factory.get_dataset(eval_dataset_name, FLAGS.eval_dataset_split_name, eval_dataset_dir)
+    records = read_held_out_records(dataset, FLAGS.eval_num_images)
+    tf.logging.info('%d held-out images of %s_%s for in-process evaluation'%(len(records), 
+                                                    eval_dataset_name, FLAGS.eval_dataset_split_name))
+    
+    snapshots = {}
+    with tf.name_scope('eval_tower'):
+        with tf.device('/cpu:0'):
+            serialized = tf.placeholder(dtype = tf.string, shape = [])
+            [image, shape, gignored, gbboxes, x1, x2, x3, x4, y1, y2, y3, y4] = dataset.decoder.decode(serialized, [
+                                                             'image', 'shape',
+                                                             'object/ignored',
+                                                             'object/bbox', 
+                                                             'object/oriented_bbox/x1',
+                                                             'object/oriented_bbox/x2',
+                                                             'object/oriented_bbox/x3',
+                                                             'object/oriented_bbox/x4',
+                                                             'object/oriented_bbox/y1',
+                                                             'object/oriented_bbox/y2',
+                                                             'object/oriented_bbox/y3',
+                                                             'object/oriented_bbox/y4'
+                                                             ])
+            gxs = tf.transpose(tf.stack([x1, x2, x3, x4])) * tf.cast(shape[1], tf.float32)
+            gys = tf.transpose(tf.stack([y1, y2, y3, y4])) * tf.cast(shape[0], tf.float32)
+            image, _, _, _, _ = ssd_vgg_preprocessing.preprocess_image(image, None, None, None, None, 
+                                                               out_shape = config.image_shape,
+                                                               data_format = config.data_format, 
+                                                               is_training = False)
+        with tf.variable_scope(tf.get_variable_scope(), reuse = True, 
+                               custom_getter = create_snapshot_getter(snapshots)):
+            with tf.device(config.gpus[0]):
+                # no summary, or the evaluation would be run every time the summary ops of training run.
+                net = seglink_symbol.SegLinkNet(inputs = tf.expand_dims(image, 0), data_format = config.data_format, 
+                                                do_summary = False)
+        bboxes_pred = seglink.tf_seglink_to_bbox(net.seg_scores, net.link_scores, net.seg_offsets, 
+                                                  tf.expand_dims(shape, 0), 
+                                                  seg_conf_threshold = FLAGS.eval_seg_conf_threshold, 
+                                                  link_conf_threshold = FLAGS.eval_link_conf_threshold)
+        num_gt_bboxes, tp, fp = tfe_bboxes.bboxes_matching(bboxes_pred, gxs, gys, gignored)
+        num_tp = tf.reduce_sum(tf.cast(tp, tf.int32))
+        num_fp = tf.reduce_sum(tf.cast(fp, tf.int32))
+        
+        snapshot_ops = []
+        for var, snapshot in snapshots.items():
+            with tf.device(snapshot.device):
+                snapshot_ops.append(tf.assign(snapshot, var))
+        snapshot_op = tf.group(*snapshot_ops, name = 'snapshot')
+    return serialized, records, [num_gt_bboxes, num_tp, num_fp], snapshot_op
+
+
+class PeriodicEvaluator(object):
+    """Snapshot the weights every `every_n_steps` steps, evaluate the snapshot on the held-out images in a side thread, 
+    and write precision, recall and F-mean to the summary writer of training.
+    """
+    def __init__(self, eval_tower, summary_writer, every_n_steps, checkpoint_saver = None):
+        """
+        Args:
+            eval_tower: (serialized, records, eval_tensors, snapshot_op), as returned by `create_eval_tower`.
+        """
+        self.serialized, self.records, self.eval_tensors, self.snapshot_op = eval_tower
+        self.checkpoint_saver = checkpoint_saver
+        self.summary_writer = summary_writer
+        self.every_n_steps = every_n_steps
+        self.thread = None
+        self.last_eval_step = -1
+        
+    def after_step(self, sess, step):
+        if step % self.every_n_steps != 0 or step == self.last_eval_step:
+            return
+        if self.thread is not None and self.thread.is_alive():
+            tf.logging.info('skip the evaluation at step %d because the last one is still running.'%(step))
+            return
+        import threading
+        self.last_eval_step = step
+        # taken in the training thread, so the evaluated weights are exactly the ones of this step.
+        sess.run(self.snapshot_op)
+        self.thread = threading.Thread(target = self._run, args = (sess, step))
+        self.thread.daemon = True
+        self.thread.start()
     
+    def _run(self, sess, step):
+        counts = np.zeros((3, ), dtype = np.int64)
+        for record in self.records:
+            counts += sess.run(self.eval_tensors, feed_dict = {self.serialized: record})
+        num_gt_bboxes, num_tp, num_fp = counts
+        precision, recall = tfe_metrics.np_precision_recall(num_gt_bboxes, num_tp, num_fp)
+        fmean = tfe_metrics.np_fmean(num_gt_bboxes, num_tp, num_fp)
+        tf.logging.info('evaluation at step %d: recall = %f, precision = %f, fmean = %f'%(step, recall, precision, fmean))
+        summary = tf.Summary(value = [
+                    tf.Summary.Value(tag = 'eval/Recall', simple_value = recall),
+                    tf.Summary.Value(tag = 'eval/Precision', simple_value = precision),
+                    tf.Summary.Value(tag = 'eval/F-mean', simple_value = fmean)])
+        self.summary_writer.add_summary(summary, step)
+        self.summary_writer.flush()
+        if self.checkpoint_saver is not None:
+            self.checkpoint_saver.report_score(step, fmean)
+
+
+class PeriodicSummary(object):
+    """Run a summary op every `every_n_steps` steps, and write the result to the summary writer of training.
+    """
+    def __init__(self, summary_op, summary_writer, every_n_steps):
+        self.summary_op = summary_op
+        self.summary_writer = summary_writer
+        self.every_n_steps = every_n_steps
+        self.last_summary_step = -1
+        
+    def after_step(self, sess, step):
+        if step % self.every_n_steps != 0 or step == self.last_summary_step:
+            return
+        self.last_summary_step = step
+        self.summary_writer.add_summary(sess.run(self.summary_op), step)
+
+class PeriodicCheckpoint(object):
+    """Snapshot the variables every `every_n_steps` steps, to be written by a `tfe_checkpoints.AsyncCheckpointSaver`.
+    """
+    def __init__(self, checkpoint_saver, every_n_steps):
+        self.checkpoint_saver = checkpoint_saver
+        self.every_n_steps = every_n_steps
+        self.last_checkpoint_step = -1
+        
+    def after_step(self, sess, step):
+        if step % self.every_n_steps != 0 or step == self.last_checkpoint_step:
+            return
+        self.last_checkpoint_step = step
+        self.checkpoint_saver.save(sess, step)
+        
     
-def train(train_op):
+class ShapeSampler(object):
+    """Pick the image shape of each batch uniformly at random."""
+    def __init__(self, num_shapes):
+        self.num_shapes = num_shapes
+        
+    def sample(self, sess):
+        return np.random.randint(self.num_shapes)
+
+class BucketSampler(object):
+    """Load the next group of batches of the aspect ratio bucket pipeline into the batch variables of its bucket, 
+    and return the index of the bucket. The bucket of each batch is the one of the images read next, 
+    so every bucket is trained on by its share of images.
+    """
+    def __init__(self, load_op):
+        self.load_op = load_op
+        
+    def sample(self, sess):
+        return sess.run(self.load_op)
+
+def train(train_ops, eval_tower = None, shape_sampler = None):
+    """
+    Args:
+        train_ops: a list of (train_op, accumulate_op) pairs, one for each image shape, as returned by `create_clones`.
+        eval_tower: the in-process evaluation tower returned by `create_eval_tower`, or None.
+        shape_sampler: a `ShapeSampler` or `BucketSampler` picking the image shape of each batch. Uniformly at random by default.
+    """
+    shape_sampler = shape_sampler or ShapeSampler(len(train_ops))
     summary_op = tf.summary.merge_all()
     sess_config = tf.ConfigProto(log_device_placement = False, allow_soft_placement = True)
     if FLAGS.gpu_memory_fraction < 0:
@@ -248,18 +1113,63 @@ def train(train_op):
     init_fn = util.tf.get_init_fn(checkpoint_path = FLAGS.checkpoint_path, train_dir = FLAGS.train_dir, 
                           ignore_missing_vars = FLAGS.ignore_missing_vars, checkpoint_exclude_scopes = FLAGS.checkpoint_exclude_scopes)
     saver = tf.train.Saver(max_to_keep = 500, write_version = 2)
+    summary_writer = tf.summary.FileWriter(FLAGS.train_dir)
+    
+    step_hooks = []
+    checkpoint_saver = None
+    save_interval_secs = 1200
+    if FLAGS.async_checkpoint_every_n_steps > 0:
+        # the same variables as the ones saved by `saver`
+        checkpoint_saver = tfe_checkpoints.AsyncCheckpointSaver(tf.global_variables(), 
+                                    util.io.join_path(FLAGS.train_dir, 'model.ckpt'), 
+                                    keep_last_n = FLAGS.keep_last_n_checkpoints, 
+                                    keep_every_n = FLAGS.keep_checkpoint_every_n, 
+                                    keep_best_n = FLAGS.keep_best_n_checkpoints)
+        step_hooks.append(PeriodicCheckpoint(checkpoint_saver, FLAGS.async_checkpoint_every_n_steps))
+        save_interval_secs = 0 # no periodic saving by the supervisor. 
+        # the final checkpoint saved by the supervisor is written by checkpoint_saver too.
+        saver = tfe_checkpoints.AsyncSaver(checkpoint_saver, write_version = 2)
+    for key, every_n_steps in [(config.VARIABLE_SUMMARIES, FLAGS.variable_summary_every_n_steps), 
+                               (config.HISTOGRAM_SUMMARIES, FLAGS.histogram_summary_every_n_steps)]:
+        level_summary_op = tf.summary.merge_all(key = key)
+        if level_summary_op is not None and every_n_steps > 0:
+            step_hooks.append(PeriodicSummary(level_summary_op, summary_writer, every_n_steps))
+    if eval_tower is not None:
+        step_hooks.append(PeriodicEvaluator(eval_tower, summary_writer, 
+                                    every_n_steps = FLAGS.eval_every_n_steps, 
+                                    checkpoint_saver = checkpoint_saver))
+    
+    def train_step_fn(sess, default_train_op, global_step, train_step_kwargs):
+        # the gradients of the first `num_accumulation_steps - 1` batches are accumulated, 
+        # and applied together with the ones of the last batch by train_op. 
+        # The accumulators are shared by all shapes, so every batch has its own shape.
+        for _ in xrange(FLAGS.num_accumulation_steps - 1):
+            _, accumulate_op = train_ops[shape_sampler.sample(sess)]
+            sess.run(accumulate_op)
+        train_op, _ = train_ops[shape_sampler.sample(sess)]
+        total_loss, should_stop = slim.learning.train_step(sess, train_op, global_step, train_step_kwargs)
+        if step_hooks:
+            np_global_step = sess.run(global_step)
+            for hook in step_hooks:
+                hook.after_step(sess, np_global_step)
+        return total_loss, should_stop
+    
     slim.learning.train(
-            train_op,
+            train_ops[0][0],
             logdir = FLAGS.train_dir,
             init_fn = init_fn,
             summary_op = summary_op,
             number_of_steps = FLAGS.max_number_of_steps,
             log_every_n_steps = FLAGS.log_every_n_steps,
+            train_step_fn = train_step_fn,
+            summary_writer = summary_writer,
             save_summaries_secs = 60,
             saver = saver,
-            save_interval_secs = 1200,
+            save_interval_secs = save_interval_secs,
             session_config = sess_config
     )
+    if checkpoint_saver is not None:
+        checkpoint_saver.close()
 
 
 def main(_):
@@ -267,9 +1177,39 @@ def main(_):
     # but I need to print all configurations in this method, including dataset information. 
     dataset = config_initialization()   
     
-    batch_queue = create_dataset_batch_queue(dataset)
-    train_op = create_clones(batch_queue)
-    train(train_op)
+    # every image shape has its own input pipeline, all of which keep preprocessing concurrently.
+    batch_queues = []
+    image_shapes = get_train_image_shapes()
+    if FLAGS.aspect_ratio_buckets:
+        bucket_ranges = get_bucket_aspect_ratio_ranges(image_shapes)
+        for image_shape, (image_range, crop_range) in zip(image_shapes, bucket_ranges):
+            tf.logging.info('aspect ratio bucket %dx%d: image aspect ratio in [%f, %f), crop aspect ratio in [%f, %f]'%(
+                            image_shape + image_range + crop_range))
+        # the records are read once by a single pipeline, which groups the images by bucket.
+        next_group, bucket_queues = create_bucket_pipeline(dataset, image_shapes, bucket_ranges)
+        batch_queues = zip(image_shapes, bucket_queues)
+        if FLAGS.benchmark_input_steps > 0:
+            benchmark_input_pipeline(next_group, FLAGS.benchmark_input_steps, config.batch_size_per_gpu * config.num_clones)
+            return
+    else:
+        for image_shape in image_shapes:
+            if FLAGS.use_tf_data:
+                batch_queue = create_dataset_batch_queue_tf_data(dataset, image_shape)
+            else:
+                batch_queue = create_dataset_batch_queue(dataset, image_shape)
+            batch_queues.append((image_shape, batch_queue))
+        if FLAGS.benchmark_input_steps > 0:
+            benchmark_input_pipeline(batch_queues[0][1].dequeue(), FLAGS.benchmark_input_steps, config.batch_size_per_gpu)
+            return
+        
+    train_ops = create_clones(batch_queues)
+    shape_sampler = None
+    if FLAGS.aspect_ratio_buckets:
+        shape_sampler = BucketSampler(create_bucket_load_op(next_group, bucket_queues))
+    eval_tower = None
+    if FLAGS.eval_every_n_steps > 0:
+        eval_tower = create_eval_tower()
+    train(train_ops, eval_tower, shape_sampler)
     
     
 if __name__ == '__main__':